@@ -25,9 +25,12 @@ import logging
 
 from functools import partial
 from threading import BoundedSemaphore
+from threading import local
 
 from twisted.enterprise import adbapi
+from twisted.internet import threads
 from twisted.python import log
+from twisted.python.threadpool import ThreadPool
 from zope.proxy import ProxyBase, setProxiedObject
 from pysqlcipher.dbapi2 import OperationalError
 from pysqlcipher.dbapi2 import DatabaseError
@@ -56,9 +59,14 @@ How many times a SQLCipher query should be retried in case of timeout.
 """
 SQLCIPHER_MAX_RETRIES = 10
 
+"""
+How many read-only connections a reader/writer connection pool should use.
+"""
+SQLCIPHER_READERS = 4
+
 
 def getConnectionPool(opts, openfun=None, driver="pysqlcipher",
-                      sync_enc_pool=None):
+                      sync_enc_pool=None, readers=None):
     """
     Return a connection pool.
 
@@ -72,16 +80,31 @@ def getConnectionPool(opts, openfun=None, driver="pysqlcipher",
     :param driver:
         The connection driver.
     :type driver: str
+    :param readers:
+        The number of read-only connections of a reader/writer pool. If 0, a
+        pool of read-write connections is returned instead. Defaults to
+        SQLCIPHER_READERS, or to 0 if write-ahead logging is disabled by the
+        performance profile, because then readers would block on writers.
+    :type readers: int
 
     :return: A U1DB connection pool.
     :rtype: U1DBConnectionPool
     """
     if openfun is None and driver == "pysqlcipher":
         openfun = partial(set_init_pragmas, opts=opts)
-    return U1DBConnectionPool(
+    if readers is None:
+        readers = SQLCIPHER_READERS
+        if not opts.profile.wal:
+            readers = 0
+    kwargs = {}
+    pool_class = U1DBConnectionPool
+    if readers:
+        pool_class = U1DBReadWriteConnectionPool
+        kwargs = {'cp_min': 1, 'cp_max': readers}
+    return pool_class(
         "%s.dbapi2" % driver, opts=opts, sync_enc_pool=sync_enc_pool,
         database=opts.path, check_same_thread=False, cp_openfun=openfun,
-        timeout=SQLCIPHER_CONNECTION_TIMEOUT)
+        timeout=SQLCIPHER_CONNECTION_TIMEOUT, **kwargs)
 
 
 class U1DBConnection(adbapi.Connection):
@@ -203,12 +226,42 @@ class U1DBConnectionPool(adbapi.ConnectionPool):
             'self._runU1DBQuery(Transaction(...), *args, **kw)', or a Failure.
         :rtype: twisted.internet.defer.Deferred
         """
-        meth = "u1db_%s" % meth
+        return self._runWithRetries(
+            self.runInteraction, self._runU1DBQuery, "u1db_%s" % meth,
+            *args, **kw)
+
+    def runReadQuery(self, *args, **kw):
+        """
+        Execute an SQL query that only reads from the database.
+
+        In this pool it is the same as runQuery.
+
+        :return: a Deferred which will fire the return value of a DB-API
+            cursor's 'fetchall' method, or a Failure.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        return self.runQuery(*args, **kw)
+
+    def _runWithRetries(self, run, interaction, *args, **kw):
+        """
+        Run an interaction, retrying it up to SQLCIPHER_MAX_RETRIES times if
+        it times out waiting for the database lock.
+
+        :param run: The method that runs the interaction in a thread.
+        :type run: callable
+        :param interaction:
+            A callable object whose first argument is an
+            L{adbapi.Transaction}.
+        :type interaction: callable
+
+        :return: a Deferred which will fire the return value of
+            'interaction(Transaction(...), *args, **kw)', or a Failure.
+        :rtype: twisted.internet.defer.Deferred
+        """
         semaphore = BoundedSemaphore(SQLCIPHER_MAX_RETRIES - 1)
 
         def _run_interaction():
-            return self.runInteraction(
-                self._runU1DBQuery, meth, *args, **kw)
+            return run(interaction, *args, **kw)
 
         def _errback(failure):
             failure.trap(OperationalError)
@@ -292,3 +345,123 @@ class U1DBConnectionPool(adbapi.ConnectionPool):
         for u1db in self._u1dbconnections.values():
             self._close(u1db)
         self.connections.clear()
+
+
+class U1DBReadWriteConnectionPool(U1DBConnectionPool):
+    """
+    A pool of read-only connections to an U1DB database, which run queries in
+    parallel, and one read-write connection, which runs writes one at a time
+    in the order they were requested.
+
+    With write-ahead logging, readers never block on the writer, and the
+    writes of the pool never compete with each other for the database lock.
+    They still compete with other connections to the same database, like the
+    ones used by the sync, so they are retried when the lock times out, as in
+    U1DBConnectionPool.
+
+    U1DB queries are run on a read-only connection if their method is in
+    READ_METHODS, and raw queries on a read-only connection if they are run
+    with runReadQuery. Raw queries run with runQuery, operations and
+    interactions may write, so they are run on the writer connection.
+    """
+
+    """
+    The U1DB wrapper methods that only read from the database.
+    """
+    READ_METHODS = frozenset([
+        'get_doc', 'get_docs', 'get_all_docs', 'get_doc_conflicts',
+        'get_from_index', 'get_range_from_index', 'get_index_keys',
+        'get_count_from_index', 'list_indexes',
+    ])
+
+    def __init__(self, *args, **kwargs):
+        """
+        Initialize the connection pool.
+        """
+        U1DBConnectionPool.__init__(self, *args, **kwargs)
+        # the connection opened during initialization may have to create the
+        # database schema, so only connections opened from now on are
+        # read-only, except for the one of the writer thread.
+        self._local = local()
+        openfun = self.openfun
+
+        def _openfun(conn):
+            if openfun is not None:
+                openfun(conn)
+            if not getattr(self._local, 'writer', False):
+                conn.cursor().execute('PRAGMA query_only=ON')
+
+        self.openfun = _openfun
+        self.writerpool = ThreadPool(1, 1, name='U1DBWriter')
+
+    def start(self):
+        """
+        Start the reader and writer threads.
+        """
+        if not self.running:
+            self.writerpool.start()
+        U1DBConnectionPool.start(self)
+
+    def runU1DBQuery(self, meth, *args, **kw):
+        """
+        Execute a U1DB query in a thread, using a read-only connection if the
+        query does not write to the database, or the writer connection
+        otherwise. Writes are retried up to SQLCIPHER_MAX_RETRIES times if
+        they time out waiting for the database lock.
+
+        :param meth: The U1DB wrapper method name.
+        :type meth: str
+
+        :return: a Deferred which will fire the return value of
+            'self._runU1DBQuery(Transaction(...), *args, **kw)', or a Failure.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        if meth in self.READ_METHODS:
+            return self._runReadInteraction(
+                self._runU1DBQuery, "u1db_%s" % meth, *args, **kw)
+        return self._runWithRetries(
+            self.runInteraction, self._runU1DBQuery, "u1db_%s" % meth,
+            *args, **kw)
+
+    def runReadQuery(self, *args, **kw):
+        """
+        Execute an SQL query on a read-only connection. Queries that write to
+        the database fail, and should be run with runQuery instead.
+
+        :return: a Deferred which will fire the return value of a DB-API
+            cursor's 'fetchall' method, or a Failure.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        return self._runReadInteraction(self._runQuery, *args, **kw)
+
+    def runInteraction(self, interaction, *args, **kw):
+        """
+        Queue an interaction to be run on the writer connection.
+
+        :param interaction:
+            A callable object whose first argument is an
+            L{adbapi.Transaction}.
+        :type interaction: callable
+        :return: a Deferred which will fire the return value of
+            'interaction(Transaction(...), *args, **kw)', or a Failure.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        return threads.deferToThreadPool(
+            self._reactor, self.writerpool,
+            self._runWriteInteraction, interaction, *args, **kw)
+
+    def _runReadInteraction(self, interaction, *args, **kw):
+        return threads.deferToThreadPool(
+            self._reactor, self.threadpool,
+            self._runInteraction, interaction, *args, **kw)
+
+    def _runWriteInteraction(self, interaction, *args, **kw):
+        self._local.writer = True
+        return self._runInteraction(interaction, *args, **kw)
+
+    def finalClose(self):
+        """
+        A final close, only called by the shutdown trigger.
+        """
+        self.writerpool.stop()
+        U1DBConnectionPool.finalClose(self)
@@ -125,7 +125,10 @@ class Soledad(object):
 
     def __init__(self, uuid, passphrase, secrets_path, local_db_path,
                  server_url, cert_file, shared_db=None,
-                 auth_token=None, defer_encryption=False, syncable=True):
+                 auth_token=None, defer_encryption=False, syncable=True,
+                 compression=None, enc_method=None, encoding=None,
+                 sqlcipher_profile=None, worker_pool_size=None,
+                 worker_pool_idle_timeout=None):
         """
         Initialize configuration, cryptographic keys and dbs.
 
@@ -172,6 +175,53 @@ class Soledad(object):
             with remote replicas (default is ``True``)
         :type syncable: bool
 
+        :param compression:
+            The method used to compress documents before encrypting them for
+            syncing, one of ``leap.soledad.common.crypto.CompressionMethods``.
+            If ``None`` (the default), documents are not compressed.
+            Compressed documents can not be read by clients older than this
+            release.
+        :type compression: str
+
+        :param enc_method:
+            The method used to encrypt documents for syncing, one of
+            ``leap.soledad.common.crypto.EncryptionMethods``. If ``None``
+            (the default), AES-256-CTR with an HMAC is used, which every
+            client can read. AES-256-GCM is faster, but should only be
+            enabled once every device of the user runs a release that can
+            decrypt it.
+        :type enc_method: str
+
+        :param encoding:
+            The encoding of the ciphertext of documents encrypted for
+            syncing, one of ``leap.soledad.common.crypto.EncodingMethods``.
+            If ``None`` (the default), AES-256-CTR documents are hex encoded
+            and AES-256-GCM documents base64 encoded. Base64 makes documents
+            a third smaller than hex, but AES-256-CTR documents encoded with
+            it can not be read by clients older than this release.
+        :type encoding: str
+
+        :param sqlcipher_profile:
+            The performance profile of the local databases, either the name
+            of a preset (e.g. ``'laptop'``, ``'low-memory'`` or
+            ``'bulk-import'``) or a
+            ``leap.soledad.client.pragmas.PerformanceProfile``. It is applied
+            to every connection to the local and sync databases.
+        :type sqlcipher_profile: str or PerformanceProfile
+
+        :param worker_pool_size:
+            The number of worker processes used to encrypt and decrypt large
+            documents. If ``None`` (the default), one per CPU is used. The
+            pool is shared by all Soledad instances in the process, so a
+            different value stops and replaces the running pool.
+        :type worker_pool_size: int
+
+        :param worker_pool_idle_timeout:
+            The number of seconds the pool of workers may stay idle before
+            its processes are shut down. If ``None``, the default of
+            ``leap.soledad.client.encdecpool.WorkerPool`` is used.
+        :type worker_pool_idle_timeout: float
+
         :raise BootstrapSequenceError:
             Raised when the secret initialization sequence (i.e. retrieval
             from server or generation and storage on server) has failed for
@@ -183,6 +233,10 @@ class Soledad(object):
         self._local_db_path = local_db_path
         self._server_url = server_url
         self._defer_encryption = defer_encryption
+        self._compression = compression
+        self._enc_method = enc_method
+        self._encoding = encoding
+        self._sqlcipher_profile = sqlcipher_profile
         self._secrets_path = None
         self._sync_enc_pool = None
 
@@ -196,6 +250,10 @@ class Soledad(object):
 
         self._init_config_with_defaults()
         self._init_working_dirs()
+        if worker_pool_size is not None \
+                or worker_pool_idle_timeout is not None:
+            encdecpool.configure_worker_pool(
+                size=worker_pool_size, idle_timeout=worker_pool_idle_timeout)
 
         self._secrets_path = secrets_path
 
@@ -206,7 +264,11 @@ class Soledad(object):
         # propagated upwards.
         self._init_secrets()
 
-        self._crypto = SoledadCrypto(self._secrets.remote_storage_secret)
+        self._crypto = SoledadCrypto(
+            self._secrets.remote_storage_secret,
+            compression=self._compression,
+            enc_method=self._enc_method,
+            encoding=self._encoding)
         self._init_u1db_sqlcipher_backend()
 
         if syncable:
@@ -276,6 +338,7 @@ class Soledad(object):
             is_raw_key=True, create=True,
             defer_encryption=self._defer_encryption,
             sync_db_key=sync_db_key,
+            profile=self._sqlcipher_profile,
         )
         self._sqlcipher_opts = opts
 
@@ -285,6 +348,14 @@ class Soledad(object):
         self._initialize_sync_db(opts)
         self._dbpool = adbapi.getConnectionPool(
             opts, sync_enc_pool=self._sync_enc_pool)
+        if self._defer_encryption:
+            # re-enqueue in the background the documents that were waiting
+            # for encryption when soledad was last closed.
+            d = self._sync_enc_pool.recover_backlog(self.get_docs)
+            d.addErrback(
+                lambda f: logger.warning(
+                    "Could not recover encryption backlog: %s"
+                    % f.getErrorMessage()))
 
     def _init_u1db_syncer(self):
         """
@@ -310,12 +381,15 @@ class Soledad(object):
         self._dbpool.close()
         if getattr(self, '_dbsyncer', None):
             self._dbsyncer.close()
+        # stop the encrypter pool before closing the sync database, so that
+        # it can write its pending backlog entries.
+        if self._defer_encryption:
+            self._sync_enc_pool.stop()
         # close the sync database
         if self._sync_db:
             self._sync_db.close()
         self._sync_db = None
-        if self._defer_encryption:
-            self._sync_enc_pool.stop()
+        self._crypto.close()
 
     #
     # ILocalStorage
@@ -371,6 +445,44 @@ class Soledad(object):
         """
         return self._defer("delete_doc", doc)
 
+    def put_docs(self, docs):
+        """
+        Update many documents in a single transaction.
+
+        This is much faster than calling `put_doc` for each document, as all
+        documents are written with a single commit. A failure to put one of
+        the documents (because of a conflict, for example) does not prevent
+        the others from being put.
+
+        Like `put_doc`, this method converts the documents' contents to
+        unicode in-place.
+
+        :param docs: A list of documents with new content.
+        :type docs: list of leap.soledad.common.document.SoledadDocument
+        :return: A deferred whose callback will be invoked with a list of
+            (success, result) tuples, one for each document, where result is
+            either the new revision identifier or the error that prevented
+            the document from being put.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        for doc in docs:
+            doc.content = _convert_to_unicode(doc.content)
+        return self._defer("put_docs", docs)
+
+    def delete_docs(self, docs):
+        """
+        Mark many documents as deleted in a single transaction.
+
+        :param docs: A list of documents to be deleted.
+        :type docs: list of leap.soledad.common.document.SoledadDocument
+        :return: A deferred whose callback will be invoked with a list of
+            (success, result) tuples, one for each document, where result is
+            either the new revision identifier or the error that prevented
+            the document from being deleted.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        return self._defer("delete_docs", docs)
+
     def get_doc(self, doc_id, include_deleted=False):
         """
         Get the JSON string for the given document.
@@ -452,6 +564,29 @@ class Soledad(object):
         return self._defer(
             "create_doc", _convert_to_unicode(content), doc_id=doc_id)
 
+    def create_docs(self, contents, doc_ids=None):
+        """
+        Create many new documents in a single transaction.
+
+        This is much faster than calling `create_doc` for each document, as
+        all documents are written with a single commit. A failure to create
+        one of the documents does not prevent the others from being created.
+
+        :param contents: A list of Python dictionaries.
+        :type contents: list of dict
+        :param doc_ids: An optional list of document identifiers, with None
+            for the documents that should get a new identifier.
+        :type doc_ids: list of str
+        :return: A deferred whose callback will be invoked with a list of
+            (success, result) tuples, one for each document, where result is
+            either the new document or the error that prevented the document
+            from being created.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        return self._defer(
+            "create_docs", map(_convert_to_unicode, contents),
+            doc_ids=doc_ids)
+
     def create_doc_from_json(self, json, doc_id=None):
         """
         Create a new document.
@@ -652,7 +787,7 @@ class Soledad(object):
     # ISyncableStorage
     #
 
-    def sync(self, defer_decryption=True):
+    def sync(self, defer_decryption=True, max_concurrent_requests=None):
         """
         Synchronize documents with the server replica.
 
@@ -664,6 +799,11 @@ class Soledad(object):
             syncing.
         :type defer_decryption: bool
 
+        :param max_concurrent_requests:
+            The maximum number of concurrent requests for receiving documents.
+            If None, a default value is used.
+        :type max_concurrent_requests: int
+
         :return: A deferred lock that will run the actual sync process when
                  the lock is acquired, and which will fire with with the local
                  generation before the synchronization was performed.
@@ -671,10 +811,11 @@ class Soledad(object):
         """
         d = self.sync_lock.run(
             self._sync,
-            defer_decryption)
+            defer_decryption,
+            max_concurrent_requests)
         return d
 
-    def _sync(self, defer_decryption):
+    def _sync(self, defer_decryption, max_concurrent_requests):
         """
         Synchronize documents with the server replica.
 
@@ -683,6 +824,10 @@ class Soledad(object):
             syncing.
         :type defer_decryption: bool
 
+        :param max_concurrent_requests:
+            The maximum number of concurrent requests for receiving documents.
+        :type max_concurrent_requests: int
+
         :return: A deferred whose callback will be invoked with the local
             generation before the synchronization was performed.
         :rtype: twisted.internet.defer.Deferred
@@ -691,7 +836,8 @@ class Soledad(object):
         d = self._dbsyncer.sync(
             sync_url,
             creds=self._creds,
-            defer_decryption=defer_decryption)
+            defer_decryption=defer_decryption,
+            max_concurrent_requests=max_concurrent_requests)
 
         def _sync_callback(local_gen):
             self._last_received_docs = docs = self._dbsyncer.received_docs
@@ -821,7 +967,10 @@ class Soledad(object):
             encr.TABLE_NAME, encr.FIELD_NAMES))
         sql_decr_table_query = (maybe_create % (
             decr.TABLE_NAME, decr.FIELD_NAMES))
-        return (sql_encr_table_query, sql_decr_table_query)
+        sql_backlog_table_query = (maybe_create % (
+            encr.BACKLOG_TABLE_NAME, encr.BACKLOG_FIELD_NAMES))
+        return (sql_encr_table_query, sql_decr_table_query,
+                sql_backlog_table_query)
 
     #
     # ISecretsStorage
@@ -18,12 +18,19 @@
 Cryptographic utilities for Soledad.
 """
 import os
+import base64
 import binascii
 import hmac
 import hashlib
 import json
+import zlib
 import logging
+import threading
 
+from collections import OrderedDict
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from pycryptopp.cipher.aes import AES
 
 from leap.soledad.common import soledad_assert
@@ -36,6 +43,28 @@ logger = logging.getLogger(__name__)
 
 MAC_KEY_LENGTH = 64
 
+# Documents whose serialization is smaller than this number of bytes are not
+# compressed before encryption, even if compression is enabled.
+COMPRESSION_THRESHOLD = 1024
+
+# The method used to encrypt documents unless another one is chosen. Clients
+# that predate AES-256 in GCM mode cannot decrypt documents encrypted with
+# it, so it must only be enabled once all devices of a user run a client that
+# supports it. Until then, documents are encrypted with AES-256 in CTR mode,
+# authenticated with HMAC and hex encoded, as before.
+DEFAULT_ENC_METHOD = crypto.EncryptionMethods.AES_256_CTR
+
+# The encoding of the ciphertext and MAC of documents encrypted with each
+# method, unless another one is chosen. Base64 is a third smaller than hex,
+# but clients that predate the encoding key decode AES-256-CTR documents as
+# hex, so base64 must only be chosen for them once all devices of a user run
+# a client that reads the encoding key. Those clients cannot decrypt
+# AES-256-GCM documents at all, so these are base64 encoded by default.
+DEFAULT_ENCODINGS = {
+    crypto.EncryptionMethods.AES_256_CTR: crypto.EncodingMethods.HEX,
+    crypto.EncryptionMethods.AES_256_GCM: crypto.EncodingMethods.BASE64,
+}
+
 
 def encrypt_sym(data, key):
     """
@@ -85,6 +114,93 @@ def decrypt_sym(data, key, iv):
         key=key, iv=binascii.a2b_base64(iv)).process(data)
 
 
+def encrypt_sym_aead(data, key, associated_data):
+    """
+    Encrypt and authenticate data using AES-256 cipher in GCM mode.
+
+    :param data: The data to be encrypted.
+    :type data: str
+    :param key: The key used to encrypt data (must be 256 bits long).
+    :type key: str
+    :param associated_data: Data that is authenticated but not encrypted.
+    :type associated_data: str
+
+    :return: A tuple with the initialization vector, the encrypted data and
+             the authentication tag.
+    :rtype: (str, str, str)
+    """
+    soledad_assert_type(key, str)
+    soledad_assert(
+        len(key) == 32,  # 32 x 8 = 256 bits.
+        'Wrong key size: %s bits (must be 256 bits long).' %
+        (len(key) * 8))
+
+    iv = os.urandom(12)
+    encrypted = AESGCM(key).encrypt(iv, data, associated_data)
+    # the authentication tag is appended to the ciphertext
+    ciphertext, tag = encrypted[:-16], encrypted[-16:]
+    return binascii.b2a_base64(iv), ciphertext, tag
+
+
+def decrypt_sym_aead(data, key, iv, tag, associated_data):
+    """
+    Authenticate and decrypt some data previously encrypted using AES-256
+    cipher in GCM mode.
+
+    :param data: The data to be decrypted.
+    :type data: str
+    :param key: The symmetric key used to decrypt data (must be 256 bits
+                long).
+    :type key: str
+    :param iv: The initialization vector.
+    :type iv: str
+    :param tag: The authentication tag.
+    :type tag: str
+    :param associated_data: Data that was authenticated but not encrypted.
+    :type associated_data: str
+
+    :return: The decrypted data.
+    :rtype: str
+
+    :raise crypto.WrongMacError: Raised when the data could not be
+        authenticated.
+    """
+    soledad_assert_type(key, str)
+    soledad_assert(
+        len(key) == 32,  # 32 x 8 = 256 bits.
+        'Wrong key size: %s (must be 256 bits long).' % len(key))
+    try:
+        return AESGCM(key).decrypt(
+            binascii.a2b_base64(iv), data + tag, associated_data)
+    except InvalidTag:
+        logger.warning("Wrong authentication tag while decrypting doc...")
+        raise crypto.WrongMacError("Could not authenticate document's "
+                                   "contents.")
+
+
+def doc_passphrase(doc_id, secret):
+    """
+    Generate a passphrase for symmetric encryption of the contents of a
+    document whose id is C{doc_id}.
+
+    See C{SoledadCrypto.doc_passphrase}.
+
+    :param doc_id: The id of the document.
+    :type doc_id: str
+
+    :param secret: The Soledad storage secret
+    :type secret: str
+
+    :return: The passphrase.
+    :rtype: str
+    """
+    soledad_assert(secret is not None)
+    return hmac.new(
+        secret[MAC_KEY_LENGTH:],
+        doc_id,
+        hashlib.sha256).digest()
+
+
 def doc_mac_key(doc_id, secret):
     """
     Generate a key for calculating a MAC for a document whose id is
@@ -110,22 +226,147 @@ def doc_mac_key(doc_id, secret):
         hashlib.sha256).digest()
 
 
+def compress(data, method):
+    """
+    Compress data using the given method.
+
+    :param data: The data to be compressed.
+    :type data: str
+    :param method: The compression method, one of crypto.CompressionMethods.
+    :type method: str
+
+    :return: The compressed data.
+    :rtype: str
+
+    :raise crypto.UnknownCompressionMethodError: Raised when C{method} is
+        unknown.
+    """
+    if method == crypto.CompressionMethods.ZLIB:
+        return zlib.compress(data)
+    raise crypto.UnknownCompressionMethodError(method)
+
+
+def decompress(data, method):
+    """
+    Decompress data previously compressed with C{compress}.
+
+    :param data: The data to be decompressed.
+    :type data: str
+    :param method: The compression method, one of crypto.CompressionMethods.
+    :type method: str
+
+    :return: The decompressed data.
+    :rtype: str
+
+    :raise crypto.UnknownCompressionMethodError: Raised when C{method} is
+        unknown.
+    """
+    if method == crypto.CompressionMethods.ZLIB:
+        return zlib.decompress(data)
+    raise crypto.UnknownCompressionMethodError(method)
+
+
 class SoledadCrypto(object):
     """
     General cryptographic functionality encapsulated in a
     object that can be passed along.
     """
-    def __init__(self, secret):
+
+    """
+    Maximum number of documents whose derived keys are kept in memory.
+    """
+    KEY_CACHE_SIZE = 1000
+
+    def __init__(self, secret, compression=None, enc_method=None,
+                 encoding=None):
         """
         Initialize the crypto object.
 
         :param secret: The Soledad remote storage secret.
         :type secret: str
+        :param compression: The method used to compress document's contents
+                            before encryption, one of
+                            crypto.CompressionMethods, or None to disable
+                            compression.
+        :type compression: str
+        :param enc_method: The method used to encrypt document's contents,
+                           one of crypto.EncryptionMethods. Defaults to
+                           DEFAULT_ENC_METHOD.
+        :type enc_method: str
+        :param encoding: The encoding of the ciphertext and MAC of encrypted
+                         documents, one of crypto.EncodingMethods. Defaults
+                         to the one of C{enc_method} in DEFAULT_ENCODINGS.
+        :type encoding: str
         """
         self._secret = secret
+        self._compression = compression
+        self._enc_method = enc_method or DEFAULT_ENC_METHOD
+        self._encoding = encoding or DEFAULT_ENCODINGS[self._enc_method]
+        self._keys = OrderedDict()
+        self._keys_lock = threading.Lock()
+
+    def doc_keys(self, doc_id):
+        """
+        Return the encryption and MAC keys of a document.
+
+        Derived keys are kept in a LRU cache of at most KEY_CACHE_SIZE
+        documents, because the same documents are encrypted and decrypted
+        again on every sync in which they change.
+
+        :param doc_id: The id of the document.
+        :type doc_id: str
+
+        :return: A tuple with the encryption key, as returned by
+                 C{doc_passphrase}, and the MAC key, as returned by
+                 C{doc_mac_key}.
+        :rtype: (str, str)
+        """
+        entry = self._get_cache_entry(doc_id)
+        return entry[0], entry[1]
+
+    def doc_cipher(self, doc_id):
+        """
+        Return an AES-256-GCM cipher context for the encryption key of a
+        document.
+
+        Cipher contexts are kept in the same cache as the derived keys.
+
+        :param doc_id: The id of the document.
+        :type doc_id: str
+
+        :return: The cipher context.
+        :rtype: cryptography.hazmat.primitives.ciphers.aead.AESGCM
+        """
+        entry = self._get_cache_entry(doc_id)
+        if entry[2] is None:
+            entry[2] = AESGCM(entry[0])
+        return entry[2]
+
+    def _get_cache_entry(self, doc_id):
+        with self._keys_lock:
+            entry = self._keys.pop(doc_id, None)
+            if entry is None:
+                soledad_assert(self._secret is not None)
+                entry = [
+                    doc_passphrase(doc_id, self._secret),
+                    doc_mac_key(doc_id, self._secret),
+                    None]
+                if len(self._keys) >= self.KEY_CACHE_SIZE:
+                    self._keys.popitem(last=False)
+            self._keys[doc_id] = entry
+            return entry
 
     def doc_mac_key(self, doc_id):
-        return doc_mac_key(doc_id, self._secret)
+        """
+        Generate a key for calculating a MAC for a document.
+
+        :param doc_id: The id of the document.
+        :type doc_id: str
+
+        :return: The key.
+        :rtype: str
+        """
+        return self.doc_keys(doc_id)[1]
 
     def doc_passphrase(self, doc_id):
         """
@@ -144,27 +385,20 @@ class SoledadCrypto(object):
         :return: The passphrase.
         :rtype: str
         """
-        soledad_assert(self._secret is not None)
-        return hmac.new(
-            self._secret[MAC_KEY_LENGTH:],
-            doc_id,
-            hashlib.sha256).digest()
+        return self.doc_keys(doc_id)[0]
 
     def encrypt_doc(self, doc):
         """
-        Wrapper around encrypt_docstr that accepts the document as argument.
+        Wrapper around encrypt_docs that accepts the document as argument.
 
         :param doc: the document.
         :type doc: SoledadDocument
         """
-        key = self.doc_passphrase(doc.doc_id)
-
-        return encrypt_docstr(
-            doc.get_json(), doc.doc_id, doc.rev, key, self._secret)
+        return self.encrypt_docs([(doc.doc_id, doc.rev, doc.get_json())])[0]
 
     def decrypt_doc(self, doc):
         """
-        Wrapper around decrypt_doc_dict that accepts the document as argument.
+        Wrapper around decrypt_docs that accepts the document as argument.
 
         :param doc: the document.
         :type doc: SoledadDocument
@@ -172,28 +406,128 @@ class SoledadCrypto(object):
         :return: json string with the decrypted document
         :rtype: str
         """
-        key = self.doc_passphrase(doc.doc_id)
-        return decrypt_doc_dict(
-            doc.content, doc.doc_id, doc.rev, key, self._secret)
+        return self.decrypt_docs([(doc.doc_id, doc.rev, doc.content)])[0]
+
+    def encrypt_docs(self, docs):
+        """
+        Encrypt the contents of many documents.
+
+        See C{encrypt_docs}.
+
+        :param docs: A list of (doc_id, doc_rev, docstr) tuples.
+        :type docs: list
+
+        :return: The JSON serializations of the encrypted contents, in the
+                 same order as C{docs}.
+        :rtype: list
+        """
+        return encrypt_docs(
+            docs, self._secret, compression=self._compression,
+            keys=self.doc_keys, ciphers=self.doc_cipher,
+            enc_method=self._enc_method, encoding=self._encoding)
+
+    def decrypt_docs(self, docs):
+        """
+        Decrypt the contents of many documents.
+
+        See C{decrypt_docs}.
+
+        :param docs: A list of (doc_id, doc_rev, doc_dict) tuples.
+        :type docs: list
+
+        :return: The JSON serializations of the decrypted contents, in the
+                 same order as C{docs}.
+        :rtype: list
+        """
+        return decrypt_docs(
+            docs, self._secret, keys=self.doc_keys, ciphers=self.doc_cipher)
+
+    def close(self):
+        """
+        Forget the storage secret and the keys derived from it.
+
+        Python does not allow overwriting the memory of immutable strings, so
+        this only drops the references held by this object.
+        """
+        with self._keys_lock:
+            self._keys.clear()
+        self._secret = None
 
     @property
     def secret(self):
         return self._secret
 
+    @property
+    def compression(self):
+        return self._compression
+
+    @property
+    def enc_method(self):
+        return self._enc_method
+
+    @property
+    def encoding(self):
+        return self._encoding
+
 
 #
 # Crypto utilities for a SoledadDocument.
 #
 
+def encode_binary(data, encoding):
+    """
+    Encode binary data so it can be stored in a JSON serialization.
+
+    :param data: The data to be encoded.
+    :type data: str
+    :param encoding: The encoding method, one of crypto.EncodingMethods.
+    :type encoding: str
+
+    :return: The encoded data.
+    :rtype: str
+
+    :raise crypto.UnknownEncodingMethodError: Raised when C{encoding} is
+        unknown.
+    """
+    if encoding == crypto.EncodingMethods.BASE64:
+        return base64.b64encode(data)
+    if encoding == crypto.EncodingMethods.HEX:
+        return binascii.b2a_hex(data)
+    raise crypto.UnknownEncodingMethodError(encoding)
+
+
+def decode_binary(data, encoding):
+    """
+    Decode binary data previously encoded with C{encode_binary}.
+
+    :param data: The data to be decoded.
+    :type data: str
+    :param encoding: The encoding method, one of crypto.EncodingMethods.
+    :type encoding: str
+
+    :return: The decoded data.
+    :rtype: str
+
+    :raise crypto.UnknownEncodingMethodError: Raised when C{encoding} is
+        unknown.
+    """
+    if encoding == crypto.EncodingMethods.BASE64:
+        return base64.b64decode(data)
+    if encoding == crypto.EncodingMethods.HEX:
+        return binascii.a2b_hex(data)
+    raise crypto.UnknownEncodingMethodError(encoding)
+
+
 def mac_doc(doc_id, doc_rev, ciphertext, enc_scheme, enc_method, enc_iv,
-            mac_method, secret):
+            mac_method, secret, compression=None, mac_key=None):
     """
     Calculate a MAC for C{doc} using C{ciphertext}.
 
     Current MAC method used is HMAC, with the following parameters:
 
         * key: sha256(storage_secret, doc_id)
-        * msg: doc_id + doc_rev + ciphertext
+        * msg: doc_id + doc_rev + ciphertext + enc_scheme + enc_method +
+               enc_iv [+ compression]
         * digestmod: sha256
 
     :param doc_id: The id of the document.
@@ -212,6 +546,12 @@ def mac_doc(doc_id, doc_rev, ciphertext, enc_scheme, enc_method, enc_iv,
     :type mac_method: str
     :param secret: The Soledad storage secret
     :type secret: str
+    :param compression: The compression method applied before encryption,
+                        if any.
+    :type compression: str
+    :param mac_key: The MAC key of the document, if already derived from
+                    C{secret}.
+    :type mac_key: str
 
     :return: The calculated MAC.
     :rtype: str
@@ -230,28 +570,73 @@ def mac_doc(doc_id, doc_rev, ciphertext, enc_scheme, enc_method, enc_iv,
         enc_scheme=enc_scheme,
         enc_method=enc_method,
         enc_iv=enc_iv)
+    if compression is not None:
+        content += compression
+    if mac_key is None:
+        mac_key = doc_mac_key(doc_id, secret)
     return hmac.new(
-        doc_mac_key(doc_id, secret),
+        mac_key,
         content,
         hashlib.sha256).digest()
 
 
-def encrypt_docstr(docstr, doc_id, doc_rev, key, secret):
+def doc_associated_data(doc_id, doc_rev, compression=None):
+    """
+    Build the associated data authenticated along with a document's contents
+    when it is encrypted with an AEAD encryption method.
+
+    :param doc_id: The id of the document.
+    :type doc_id: str
+    :param doc_rev: The revision of the document.
+    :type doc_rev: str
+    :param compression: The compression method applied before encryption,
+                        if any.
+    :type compression: str
+
+    :return: The associated data.
+    :rtype: str
+    """
+    parts = [doc_id, doc_rev, compression or '']
+    return '\0'.join(
+        part.encode('utf-8') if isinstance(part, unicode) else part
+        for part in parts)
+
+
+def encrypt_docstr(docstr, doc_id, doc_rev, key, secret, compression=None,
+                   enc_method=DEFAULT_ENC_METHOD, mac_key=None,
+                   encoding=None):
     """
     Encrypt C{doc}'s content.
 
-    Encrypt doc's contents using AES-256 CTR mode and return a valid JSON
+    Encrypt doc's contents using C{enc_method} and return a valid JSON
     string representing the following:
 
         {
             crypto.ENC_JSON_KEY: '<encrypted doc JSON string>',
             crypto.ENC_SCHEME_KEY: 'symkey',
-            crypto.ENC_METHOD_KEY: crypto.EncryptionMethods.AES_256_CTR,
+            crypto.ENC_METHOD_KEY: crypto.EncryptionMethods.AES_256_GCM,
             crypto.ENC_IV_KEY: '<the initial value used to encrypt>',
+            crypto.ENC_ENCODING_KEY: crypto.EncodingMethods.BASE64,
             MAC_KEY: '<mac>'
-            crypto.MAC_METHOD_KEY: 'hmac'
+            crypto.MAC_METHOD_KEY: 'aead'
         }
 
+    With AES-256 GCM mode, the document is encrypted and authenticated in a
+    single pass, with the document id and revision as associated data, and
+    the authentication tag is stored as the MAC. With AES-256 CTR mode (the
+    default, see DEFAULT_ENC_METHOD), a separate HMAC is calculated by
+    C{mac_doc}.
+
+    The ciphertext and the MAC are stored using C{encoding}, which is
+    recorded under crypto.ENC_ENCODING_KEY. By default, it is base64 for GCM
+    mode and hex for CTR mode, so that clients that predate the encoding key
+    can decrypt the document (see DEFAULT_ENCODINGS).
+
+    If C{compression} is given and the document is at least
+    COMPRESSION_THRESHOLD bytes long, the document is compressed before
+    encryption and the method is stored under crypto.ENC_COMPRESSION_KEY.
+    Compression is skipped if it does not make the document smaller.
+
     :param docstr: A representation of the document to be encrypted.
     :type docstr: str or unicode.
 
@@ -267,18 +652,53 @@ def encrypt_docstr(docstr, doc_id, doc_rev, key, secret):
     :param secret: The Soledad storage secret (used for MAC auth).
     :type secret: str
 
+    :param compression: The compression method, one of
+                        crypto.CompressionMethods, or None to disable
+                        compression.
+    :type compression: str
+
+    :param enc_method: The encryption method, one of
+                       crypto.EncryptionMethods.
+    :type enc_method: str
+
+    :param mac_key: The MAC key of the document, if already derived from
+                    C{secret}.
+    :type mac_key: str
+
+    :param encoding: The encoding of the ciphertext and MAC, one of
+                     crypto.EncodingMethods, or None to use the default of
+                     C{enc_method}.
+    :type encoding: str
+
     :return: The JSON serialization of the dict representing the encrypted
              content.
     :rtype: str
+
+    :raise crypto.UnknownEncryptionMethodError: Raised when C{enc_method} is
+        unknown.
     """
     enc_scheme = crypto.EncryptionSchemes.SYMKEY
-    enc_method = crypto.EncryptionMethods.AES_256_CTR
-    mac_method = crypto.MacMethods.HMAC
-    enc_iv, ciphertext = encrypt_sym(
-        str(docstr),  # encryption/decryption routines expect str
-        key)
-    mac = binascii.b2a_hex(  # store the mac as hex.
-        mac_doc(
+    if encoding is None:
+        encoding = DEFAULT_ENCODINGS.get(
+            enc_method, crypto.EncodingMethods.HEX)
+    plaintext = str(docstr)  # encryption/decryption routines expect str
+    if compression is not None and len(plaintext) >= COMPRESSION_THRESHOLD:
+        compressed = compress(plaintext, compression)
+        if len(compressed) < len(plaintext):
+            plaintext = compressed
+        else:
+            compression = None
+    else:
+        compression = None
+    if enc_method == crypto.EncryptionMethods.AES_256_GCM:
+        mac_method = crypto.MacMethods.AEAD
+        enc_iv, ciphertext, mac = encrypt_sym_aead(
+            plaintext, key,
+            doc_associated_data(doc_id, doc_rev, compression))
+    elif enc_method == crypto.EncryptionMethods.AES_256_CTR:
+        mac_method = crypto.MacMethods.HMAC
+        enc_iv, ciphertext = encrypt_sym(plaintext, key)
+        mac = mac_doc(
             doc_id,
             doc_rev,
             ciphertext,
@@ -286,24 +706,33 @@ def encrypt_docstr(docstr, doc_id, doc_rev, key, secret):
             enc_method,
             enc_iv,
             mac_method,
-            secret))
+            secret,
+            compression,
+            mac_key)
+    else:
+        raise crypto.UnknownEncryptionMethodError(enc_method)
     # Return a representation for the encrypted content. In the following, we
-    # convert binary data to hexadecimal representation so the JSON
-    # serialization does not complain about what it tries to serialize.
-    hex_ciphertext = binascii.b2a_hex(ciphertext)
+    # encode binary data so the JSON serialization does not complain about
+    # what it tries to serialize.
     logger.debug("Encrypting doc: %s" % doc_id)
-    return json.dumps({
-        crypto.ENC_JSON_KEY: hex_ciphertext,
+    enc_dict = {
+        crypto.ENC_JSON_KEY: encode_binary(ciphertext, encoding),
         crypto.ENC_SCHEME_KEY: enc_scheme,
         crypto.ENC_METHOD_KEY: enc_method,
         crypto.ENC_IV_KEY: enc_iv,
-        crypto.MAC_KEY: mac,
+        crypto.ENC_ENCODING_KEY: encoding,
+        crypto.MAC_KEY: encode_binary(mac, encoding),
         crypto.MAC_METHOD_KEY: mac_method,
-    })
+    }
+    if compression is not None:
+        enc_dict[crypto.ENC_COMPRESSION_KEY] = compression
+    return json.dumps(enc_dict)
 
 
 def _verify_doc_mac(doc_id, doc_rev, ciphertext, enc_scheme, enc_method,
-                    enc_iv, mac_method, secret, doc_mac):
+                    enc_iv, mac_method, secret, doc_mac,
+                    encoding=crypto.EncodingMethods.HEX, compression=None,
+                    mac_key=None):
     """
     Verify that C{doc_mac} is a correct MAC for the given document.
 
@@ -325,6 +754,14 @@ def _verify_doc_mac(doc_id, doc_rev, ciphertext, enc_scheme, enc_method,
     :type secret: str
     :param doc_mac: The MAC to be verified against.
     :type doc_mac: str
+    :param encoding: The encoding of the stored MAC.
+    :type encoding: str
+    :param compression: The compression method applied before encryption,
+                        if any.
+    :type compression: str
+    :param mac_key: The MAC key of the document, if already derived from
+                    C{secret}.
+    :type mac_key: str
 
     :raise crypto.UnknownMacMethodError: Raised when C{mac_method} is unknown.
     :raise crypto.WrongMacError: Raised when MAC could not be verified.
@@ -337,13 +774,14 @@ def _verify_doc_mac(doc_id, doc_rev, ciphertext, enc_scheme, enc_method,
         enc_method,
         enc_iv,
         mac_method,
-        secret)
+        secret,
+        compression,
+        mac_key)
     # we compare mac's hashes to avoid possible timing attacks that might
     # exploit python's builtin comparison operator behaviour, which fails
     # immediatelly when non-matching bytes are found.
     doc_mac_hash = hashlib.sha256(
-        binascii.a2b_hex(  # the mac is stored as hex
-            doc_mac)).digest()
+        decode_binary(doc_mac, encoding)).digest()
     calculated_mac_hash = hashlib.sha256(calculated_mac).digest()
 
     if doc_mac_hash != calculated_mac_hash:
@@ -352,7 +790,7 @@ def _verify_doc_mac(doc_id, doc_rev, ciphertext, enc_scheme, enc_method,
                                    "contents.")
 
 
-def decrypt_doc_dict(doc_dict, doc_id, doc_rev, key, secret):
+def decrypt_doc_dict(doc_dict, doc_id, doc_rev, key, secret, mac_key=None):
     """
     Decrypt a symmetrically encrypted C{doc}'s content.
 
@@ -365,14 +803,23 @@ def decrypt_doc_dict(doc_dict, doc_id, doc_rev, key, secret):
             crypto.ENC_SCHEME_KEY: '<enc_scheme>',
             crypto.ENC_METHOD_KEY: '<enc_method>',
             crypto.ENC_IV_KEY: '<initial value used to encrypt>',  # (optional)
+            crypto.ENC_ENCODING_KEY: '<encoding>',  # (optional)
+            crypto.ENC_COMPRESSION_KEY: '<compression>',  # (optional)
             MAC_KEY: '<mac>'
             crypto.MAC_METHOD_KEY: 'hmac'
         }
 
     C{enc_blob} is the encryption of the JSON serialization of the document's
-    content. For now Soledad just deals with documents whose C{enc_scheme} is
-    crypto.EncryptionSchemes.SYMKEY and C{enc_method} is
-    crypto.EncryptionMethods.AES_256_CTR.
+    content. C{enc_blob} and C{mac} are stored using C{encoding}, which
+    defaults to crypto.EncodingMethods.HEX for documents encrypted before the
+    encoding was recorded. If C{compression} is present, the decrypted
+    content is decompressed with that method.
+
+    For now Soledad just deals with documents whose C{enc_scheme} is
+    crypto.EncryptionSchemes.SYMKEY and C{enc_method} is either
+    crypto.EncryptionMethods.AES_256_GCM, in which case C{mac} is the
+    authentication tag, or crypto.EncryptionMethods.AES_256_CTR, in which
+    case C{mac} is verified separately.
 
     :param doc_dict: The content of the document to be decrypted.
     :type doc_dict: dict
@@ -389,6 +836,10 @@ def decrypt_doc_dict(doc_dict, doc_id, doc_rev, key, secret):
     :param secret: The Soledad storage secret.
     :type secret: str
 
+    :param mac_key: The MAC key of the document, if already derived from
+                    C{secret}.
+    :type mac_key: str
+
     :return: The JSON serialization of the decrypted content.
     :rtype: str
 
@@ -406,20 +857,221 @@ def decrypt_doc_dict(doc_dict, doc_id, doc_rev, key, secret):
     ])
     soledad_assert(expected_keys.issubset(set(doc_dict.keys())))
 
-    ciphertext = binascii.a2b_hex(doc_dict[crypto.ENC_JSON_KEY])
+    encoding = doc_dict.get(
+        crypto.ENC_ENCODING_KEY, crypto.EncodingMethods.HEX)
+    ciphertext = decode_binary(doc_dict[crypto.ENC_JSON_KEY], encoding)
     enc_scheme = doc_dict[crypto.ENC_SCHEME_KEY]
     enc_method = doc_dict[crypto.ENC_METHOD_KEY]
     enc_iv = doc_dict[crypto.ENC_IV_KEY]
     doc_mac = doc_dict[crypto.MAC_KEY]
     mac_method = doc_dict[crypto.MAC_METHOD_KEY]
+    compression = doc_dict.get(crypto.ENC_COMPRESSION_KEY)
 
     soledad_assert(enc_scheme == crypto.EncryptionSchemes.SYMKEY)
 
-    _verify_doc_mac(
-        doc_id, doc_rev, ciphertext, enc_scheme, enc_method,
-        enc_iv, mac_method, secret, doc_mac)
+    if enc_method == crypto.EncryptionMethods.AES_256_GCM:
+        if mac_method != crypto.MacMethods.AEAD:
+            raise crypto.UnknownMacMethodError
+        plaintext = decrypt_sym_aead(
+            ciphertext, key, enc_iv, decode_binary(doc_mac, encoding),
+            doc_associated_data(doc_id, doc_rev, compression))
+    elif enc_method == crypto.EncryptionMethods.AES_256_CTR:
+        _verify_doc_mac(
+            doc_id, doc_rev, ciphertext, enc_scheme, enc_method,
+            enc_iv, mac_method, secret, doc_mac, encoding, compression,
+            mac_key)
+        plaintext = decrypt_sym(ciphertext, key, enc_iv)
+    else:
+        raise crypto.UnknownEncryptionMethodError(enc_method)
+    if compression is not None:
+        plaintext = decompress(plaintext, compression)
+    return plaintext
+
+
+def _aead_cipher(key):
+    soledad_assert_type(key, str)
+    soledad_assert(
+        len(key) == 32,  # 32 x 8 = 256 bits.
+        'Wrong key size: %s bits (must be 256 bits long).' %
+        (len(key) * 8))
+    return AESGCM(key)
+
+
+def _doc_cipher(secret):
+    """
+    Return a function that builds the AES-256-GCM cipher context of a
+    document from the storage secret.
+    """
+    return lambda doc_id: _aead_cipher(doc_passphrase(doc_id, secret))
+
+
+# The constant part of the envelope of documents encrypted by encrypt_docs,
+# without the closing brace.
+_AEAD_ENVELOPE_PREFIX = json.dumps({
+    crypto.ENC_SCHEME_KEY: crypto.EncryptionSchemes.SYMKEY,
+    crypto.ENC_METHOD_KEY: crypto.EncryptionMethods.AES_256_GCM,
+    crypto.ENC_ENCODING_KEY: crypto.EncodingMethods.BASE64,
+    crypto.MAC_METHOD_KEY: crypto.MacMethods.AEAD,
+})[:-1]
+
+_AEAD_ENVELOPE_TEMPLATE = (
+    _AEAD_ENVELOPE_PREFIX +
+    ', "%s": "%%s", "%s": "%%s", "%s": "%%s"%%s}'
+    % (crypto.ENC_JSON_KEY, crypto.ENC_IV_KEY, crypto.MAC_KEY))
+
+_AEAD_COMPRESSION_FIELD = ', "%s": "%%s"' % crypto.ENC_COMPRESSION_KEY
+
+
+def encrypt_docs(docs, secret, compression=None, keys=None, ciphers=None,
+                 enc_method=DEFAULT_ENC_METHOD, encoding=None):
+    """
+    Encrypt the contents of many documents.
+
+    This produces the same envelopes as C{encrypt_docstr}. With AES-256 in
+    GCM mode and base64 encoding, it avoids the per-document overhead of the
+    latter: cipher contexts are reused when C{ciphers} caches them, and
+    envelopes are built from a preformatted template instead of being
+    serialized with C{json.dumps}.
 
-    return decrypt_sym(ciphertext, key, enc_iv)
+    :param docs: A list of (doc_id, doc_rev, docstr) tuples.
+    :type docs: list
+    :param secret: The Soledad storage secret.
+    :type secret: str
+    :param compression: The compression method, one of
+                        crypto.CompressionMethods, or None to disable
+                        compression.
+    :type compression: str
+    :param keys: A function that returns the encryption and MAC keys of a
+                 document given its id, like C{SoledadCrypto.doc_keys}. If
+                 not given, keys are derived from C{secret}.
+    :type keys: callable
+    :param ciphers: A function that returns the AES-256-GCM cipher context
+                    of a document given its id, like
+                    C{SoledadCrypto.doc_cipher}. If not given, cipher
+                    contexts are derived from C{secret}.
+    :type ciphers: callable
+    :param enc_method: The encryption method, one of
+                       crypto.EncryptionMethods.
+    :type enc_method: str
+    :param encoding: The encoding of the ciphertext and MAC, one of
+                     crypto.EncodingMethods, or None to use the default of
+                     C{enc_method}.
+    :type encoding: str
+
+    :return: The JSON serializations of the encrypted contents, in the same
+             order as C{docs}.
+    :rtype: list
+    """
+    soledad_assert(secret is not None)
+    if encoding is None:
+        encoding = DEFAULT_ENCODINGS.get(
+            enc_method, crypto.EncodingMethods.HEX)
+    if enc_method != crypto.EncryptionMethods.AES_256_GCM \
+            or encoding != crypto.EncodingMethods.BASE64:
+        if keys is None:
+            def keys(doc_id):
+                return (doc_passphrase(doc_id, secret),
+                        doc_mac_key(doc_id, secret))
+        envelopes = []
+        for doc_id, doc_rev, docstr in docs:
+            key, mac_key = keys(doc_id)
+            envelopes.append(encrypt_docstr(
+                docstr, doc_id, doc_rev, key, secret,
+                compression=compression, enc_method=enc_method,
+                mac_key=mac_key, encoding=encoding))
+        return envelopes
+    if ciphers is None:
+        ciphers = _doc_cipher(secret)
+    urandom = os.urandom
+    b64encode = base64.b64encode
+    template = _AEAD_ENVELOPE_TEMPLATE
+    envelopes = []
+    for doc_id, doc_rev, docstr in docs:
+        plaintext = str(docstr)  # encryption routines expect str
+        doc_compression = None
+        if compression is not None \
+                and len(plaintext) >= COMPRESSION_THRESHOLD:
+            compressed = compress(plaintext, compression)
+            if len(compressed) < len(plaintext):
+                plaintext = compressed
+                doc_compression = compression
+        iv = urandom(12)
+        encrypted = ciphers(doc_id).encrypt(
+            iv, plaintext,
+            doc_associated_data(doc_id, doc_rev, doc_compression))
+        # the authentication tag is appended to the ciphertext
+        envelopes.append(template % (
+            b64encode(encrypted[:-16]),
+            b64encode(iv),
+            b64encode(encrypted[-16:]),
+            _AEAD_COMPRESSION_FIELD % doc_compression
+            if doc_compression is not None else ''))
+    return envelopes
+
+
+def decrypt_docs(docs, secret, keys=None, ciphers=None):
+    """
+    Decrypt the contents of many documents.
+
+    Documents encrypted with AES-256 in GCM mode are decrypted reusing the
+    cipher contexts returned by C{ciphers}. Other documents are decrypted by
+    C{decrypt_doc_dict}.
+
+    :param docs: A list of (doc_id, doc_rev, doc_dict) tuples.
+    :type docs: list
+    :param secret: The Soledad storage secret.
+    :type secret: str
+    :param keys: A function that returns the encryption and MAC keys of a
+                 document given its id, like C{SoledadCrypto.doc_keys}. If
+                 not given, keys are derived from C{secret}.
+    :type keys: callable
+    :param ciphers: A function that returns the AES-256-GCM cipher context
+                    of a document given its id, like
+                    C{SoledadCrypto.doc_cipher}. If not given, cipher
+                    contexts are derived from C{secret}.
+    :type ciphers: callable
+
+    :return: The JSON serializations of the decrypted contents, in the same
+             order as C{docs}.
+    :rtype: list
+
+    :raise crypto.WrongMacError: Raised when a document could not be
+        authenticated.
+    """
+    soledad_assert(secret is not None)
+    if ciphers is None:
+        ciphers = _doc_cipher(secret)
+    gcm = crypto.EncryptionMethods.AES_256_GCM
+    plaintexts = []
+    for doc_id, doc_rev, doc_dict in docs:
+        if doc_dict.get(crypto.ENC_METHOD_KEY) != gcm \
+                or doc_dict.get(crypto.MAC_METHOD_KEY) \
+                != crypto.MacMethods.AEAD:
+            if keys is not None:
+                key, mac_key = keys(doc_id)
+            else:
+                key, mac_key = doc_passphrase(doc_id, secret), None
+            plaintexts.append(decrypt_doc_dict(
+                doc_dict, doc_id, doc_rev, key, secret, mac_key=mac_key))
+            continue
+        encoding = doc_dict.get(
+            crypto.ENC_ENCODING_KEY, crypto.EncodingMethods.HEX)
+        compression = doc_dict.get(crypto.ENC_COMPRESSION_KEY)
+        try:
+            plaintext = ciphers(doc_id).decrypt(
+                binascii.a2b_base64(doc_dict[crypto.ENC_IV_KEY]),
+                decode_binary(doc_dict[crypto.ENC_JSON_KEY], encoding) +
+                decode_binary(doc_dict[crypto.MAC_KEY], encoding),
+                doc_associated_data(doc_id, doc_rev, compression))
+        except InvalidTag:
+            logger.warning(
+                "Wrong authentication tag while decrypting doc...")
+            raise crypto.WrongMacError("Could not authenticate document's "
+                                       "contents.")
+        if compression is not None:
+            plaintext = decompress(plaintext, compression)
+        plaintexts.append(plaintext)
+    return plaintexts
 
 
 def is_symmetrically_encrypted(doc):
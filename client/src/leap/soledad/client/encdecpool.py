@@ -23,24 +23,623 @@ during synchronization.
 
 
 import multiprocessing
-import Queue
+import threading
+import time
+import os
 import json
 import logging
 
+from collections import deque
+from collections import OrderedDict
+
 from twisted.internet import reactor
 from twisted.internet import defer
+from twisted.internet import threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 from twisted.python import log
 
 from leap.soledad.common.document import SoledadDocument
 from leap.soledad.common import soledad_assert
+from leap.soledad.common.crypto import ENC_JSON_KEY
+from leap.soledad.common.crypto import ENC_METHOD_KEY
+from leap.soledad.common.crypto import EncryptionMethods
 
+from leap.soledad.client.crypto import DEFAULT_ENC_METHOD
+from leap.soledad.client.crypto import SoledadCrypto
 from leap.soledad.client.crypto import encrypt_docstr
-from leap.soledad.client.crypto import decrypt_doc_dict
 
 
 logger = logging.getLogger(__name__)
 
 
+#
+# Setup of the workers
+#
+
+# The crypto object of a worker process, kept between tasks so that it is
+# only rebuilt when a task for a different Soledad instance arrives, and so
+# that its cache of derived document keys stays warm. It is never set in the
+# main process, where tasks use the crypto object of their Soledad instance.
+_worker_crypto = None
+
+
+def get_worker_crypto(secret, compression=None, enc_method=None,
+                      encoding=None):
+    """
+    Get a crypto object for the given storage secret in a worker process.
+
+    :param secret: The Soledad storage secret.
+    :type secret: str
+    :param compression: The compression method to apply before encryption,
+                        if any.
+    :type compression: str
+    :param enc_method: The encryption method. Defaults to
+                       DEFAULT_ENC_METHOD.
+    :type enc_method: str
+    :param encoding: The encoding of encrypted documents. Defaults to the
+                     one of the encryption method.
+    :type encoding: str
+
+    :return: The crypto object.
+    :rtype: leap.soledad.client.crypto.SoledadCrypto
+    """
+    global _worker_crypto
+    enc_method = enc_method or DEFAULT_ENC_METHOD
+    crypto = _worker_crypto
+    if crypto is None or crypto.secret != secret \
+            or crypto.compression != compression \
+            or crypto.enc_method != enc_method \
+            or (encoding is not None and crypto.encoding != encoding):
+        crypto = _worker_crypto = SoledadCrypto(
+            secret, compression=compression, enc_method=enc_method,
+            encoding=encoding)
+    return crypto
+
+
+def run_task(task, args):
+    """
+    Run a task in a worker and return either its result or the exception it
+    raised.
+
+    Callbacks passed to `multiprocessing.Pool.apply_async` are not called if
+    the task raises, so tasks are wrapped by this function to make sure the
+    caller is always notified.
+
+    :param task: The task to run.
+    :type task: callable
+    :param args: The arguments for the task.
+    :type args: tuple
+
+    :return: A tuple with a success flag and the result of the task or the
+             exception raised by it.
+    :rtype: tuple(bool, object)
+    """
+    try:
+        return True, task(*args)
+    except Exception as e:
+        return False, e
+
+
+#
+# Process-wide pool of workers
+#
+
+class WorkerPool(object):
+    """
+    A lazily started pool of worker processes shared by the encrypter and
+    decrypter pools of all Soledad instances in this process.
+
+    Worker processes are forked when the first task is submitted and are
+    shut down after the pool has been idle for IDLE_TIMEOUT seconds. Tasks
+    are queued per requester and dispatched to the workers in round-robin
+    order, so that a large sync of one account does not starve the syncs of
+    other accounts.
+
+    Tasks are submitted from the reactor thread and their results are
+    delivered in the reactor thread.
+    """
+
+    """
+    Number of worker processes.
+    """
+    SIZE = multiprocessing.cpu_count()
+
+    """
+    Number of seconds the pool may stay idle before its worker processes are
+    shut down.
+    """
+    IDLE_TIMEOUT = 60
+
+    def __init__(self, size=None, idle_timeout=None):
+        """
+        Initialize the pool of workers.
+
+        :param size: The number of worker processes.
+        :type size: int
+        :param idle_timeout: The number of seconds the pool may stay idle
+                             before its worker processes are shut down.
+        :type idle_timeout: float
+        """
+        self._size = size or self.SIZE
+        self._idle_timeout = idle_timeout or self.IDLE_TIMEOUT
+        self._pool = None
+        self._lock = threading.Lock()
+        self._idle_timer = None
+        # queued tasks by requester, in round-robin order
+        self._queues = OrderedDict()
+        # deferreds of the tasks running in the workers
+        self._in_flight = set()
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle_timeout(self):
+        return self._idle_timeout
+
+    @property
+    def running(self):
+        return self._pool is not None
+
+    def apply(self, requester, task, args):
+        """
+        Run a task in the pool of workers.
+
+        :param requester: The object on behalf of which the task is run, used
+                          to share the workers fairly.
+        :type requester: object
+        :param task: The task to run.
+        :type task: callable
+        :param args: The arguments for the task.
+        :type args: tuple
+
+        :return: A deferred that will fire with the result of the task, or
+                 fail with the exception it raised.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        d = defer.Deferred()
+        self._queues.setdefault(requester, deque()).append((task, args, d))
+        self._dispatch()
+        return d
+
+    def cancel(self, requester):
+        """
+        Drop the tasks queued on behalf of a requester.
+
+        Deferreds of dropped tasks fail with CancelledError. Tasks already
+        running in the workers are not affected.
+
+        :param requester: The requester.
+        :type requester: object
+        """
+        self._cancel_queued(self._queues.pop(requester, ()))
+
+    def _cancel_queued(self, queue):
+        for _, _, d in queue:
+            d.errback(defer.CancelledError())
+
+    def _dispatch(self):
+        """
+        Send queued tasks to the workers, taking one task from each requester
+        in turn, while there are idle workers.
+        """
+        while self._queues and len(self._in_flight) < self._size:
+            requester, queue = self._queues.popitem(last=False)
+            task, args, d = queue.popleft()
+            if queue:
+                self._queues[requester] = queue
+            self._submit(task, args, d)
+
+    def _submit(self, task, args, d):
+        with self._lock:
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+            if self._pool is None:
+                logger.debug("Starting pool of %d workers" % self._size)
+                self._pool = multiprocessing.Pool(self._size)
+            pool = self._pool
+
+            def _callback(result):
+                reactor.callFromThread(self._task_done, pool, d, result)
+
+            self._in_flight.add(d)
+            pool.apply_async(run_task, (task, args), callback=_callback)
+
+    def _task_done(self, pool, d, result):
+        with self._lock:
+            if pool is not self._pool:
+                # the pool was stopped while the task was running, and the
+                # deferred of the task has already failed.
+                return
+            self._in_flight.discard(d)
+        self._dispatch()
+        with self._lock:
+            if not self._in_flight and self._idle_timer is None:
+                self._idle_timer = threading.Timer(
+                    self._idle_timeout, self._shrink)
+                self._idle_timer.daemon = True
+                self._idle_timer.start()
+        success, value = result
+        if success:
+            d.callback(value)
+        else:
+            d.errback(Failure(value))
+
+    def _shrink(self):
+        """
+        Shut down the worker processes if the pool is still idle.
+
+        This runs in the idle timer thread, so it does not block the reactor
+        while waiting for the workers to exit.
+        """
+        with self._lock:
+            if self._in_flight or self._pool is None:
+                return
+            pool, self._pool = self._pool, None
+            self._idle_timer = None
+        logger.debug("Shutting down idle pool of workers")
+        pool.close()
+        pool.join()
+
+    def stop(self):
+        """
+        Terminate the worker processes and drop all queued tasks.
+
+        Deferreds of running and queued tasks fail with CancelledError.
+        """
+        with self._lock:
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+            pool, self._pool = self._pool, None
+            in_flight, self._in_flight = self._in_flight, set()
+        queues = self._queues.values()
+        self._queues.clear()
+        if pool is not None:
+            pool.terminate()
+        for d in in_flight:
+            d.errback(defer.CancelledError())
+        for queue in queues:
+            self._cancel_queued(queue)
+
+
+_worker_pool = None
+
+
+def get_worker_pool():
+    """
+    Get the pool of workers shared by all Soledad instances in this process,
+    creating it if needed.
+
+    :return: The pool of workers.
+    :rtype: WorkerPool
+    """
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = WorkerPool()
+    return _worker_pool
+
+
+def configure_worker_pool(size=None, idle_timeout=None):
+    """
+    Configure the pool of workers shared by all Soledad instances in this
+    process.
+
+    A running pool is stopped and replaced if its configuration differs, so
+    this should be called before any sync starts. Soledad calls it when
+    initialized with ``worker_pool_size`` or ``worker_pool_idle_timeout``.
+
+    :param size: The number of worker processes.
+    :type size: int
+    :param idle_timeout: The number of seconds the pool may stay idle before
+                         its worker processes are shut down.
+    :type idle_timeout: float
+    """
+    global _worker_pool
+    pool = WorkerPool(size=size, idle_timeout=idle_timeout)
+    if _worker_pool is not None:
+        if (_worker_pool.size, _worker_pool.idle_timeout) \
+                == (pool.size, pool.idle_timeout):
+            return
+        _worker_pool.stop()
+    _worker_pool = pool
+
+
+#
+# Dispatching of crypto tasks
+#
+
+class CryptoDispatcher(object):
+    """
+    Choose where to run each crypto task, based on the size of the document
+    and on how busy each place is.
+
+    Tiny documents are handled inline in the reactor thread, because handing
+    them to another thread or process costs more than the cipher itself.
+    Medium documents encrypted with a method in THREAD_ENC_METHODS go to a
+    thread pool: AES-GCM runs in OpenSSL without holding the GIL, so threads
+    give real parallelism without the cost of pickling documents to another
+    process. AES-CTR with HMAC spends most of its time in code that holds
+    the GIL, so those documents skip the thread pool. Other documents go to
+    the shared pool of worker processes.
+
+    The size thresholds of each encryption method are calibrated by
+    `calibrate()`, which times the encryption of documents of increasing size
+    with that method in this machine, in a thread. The default thresholds are
+    used until the calibration finishes.
+    """
+
+    INLINE = 'inline'
+    THREAD = 'thread'
+    PROCESS = 'process'
+
+    """
+    Encryption methods whose ciphers do not hold the GIL, so that running
+    them in the thread pool is worth it.
+    """
+    THREAD_ENC_METHODS = frozenset([EncryptionMethods.AES_256_GCM])
+
+    """
+    Number of threads of the thread pool.
+    """
+    THREADS = multiprocessing.cpu_count()
+
+    """
+    Number of tasks that may be waiting in or for the thread pool before
+    medium documents are sent to the worker processes.
+    """
+    MAX_PENDING_THREADS = 4 * THREADS
+
+    """
+    Time in seconds that a task may take to run inline in the reactor
+    thread.
+    """
+    INLINE_MAX_SECONDS = 0.001
+
+    """
+    Time in seconds that a task may take to run in the thread pool. Longer
+    tasks are sent to the worker processes.
+    """
+    THREAD_MAX_SECONDS = 0.02
+
+    """
+    Document sizes, in bytes, used by `calibrate()`.
+    """
+    CALIBRATION_SIZES = [2 ** n for n in xrange(8, 23, 2)]
+
+    def __init__(self, inline_max_bytes=1024, thread_max_bytes=256 * 1024):
+        """
+        Initialize the dispatcher.
+
+        :param inline_max_bytes: The size of the largest document processed
+                                 inline, until the encryption method of the
+                                 document is calibrated.
+        :type inline_max_bytes: int
+        :param thread_max_bytes: The size of the largest document processed
+                                 in the thread pool, until the encryption
+                                 method of the document is calibrated.
+        :type thread_max_bytes: int
+        """
+        self.inline_max_bytes = inline_max_bytes
+        self.thread_max_bytes = thread_max_bytes
+        # calibrated thresholds, by encryption method
+        self._thresholds = {}
+        self._calibrating = set()
+        self._threadpool = None
+        self._pending_threads = 0
+
+    def calibrate(self, enc_method=DEFAULT_ENC_METHOD):
+        """
+        Set the size thresholds of an encryption method by timing the
+        encryption of documents of increasing size with it in a thread, so
+        that the reactor is not blocked.
+
+        Each encryption method is only calibrated once.
+
+        :param enc_method: The encryption method, one of
+                           crypto.EncryptionMethods.
+        :type enc_method: str
+
+        :return: A deferred that will fire when the thresholds have been set.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        if enc_method in self._thresholds or enc_method in self._calibrating:
+            return defer.succeed(None)
+        self._calibrating.add(enc_method)
+        d = threads.deferToThread(self._measure_thresholds, enc_method)
+        d.addCallback(self._set_thresholds, enc_method)
+        d.addBoth(self._calibration_done, enc_method)
+        return d
+
+    def _measure_thresholds(self, enc_method):
+        """
+        Time the encryption of documents of increasing size.
+
+        :param enc_method: The encryption method, one of
+                           crypto.EncryptionMethods.
+        :type enc_method: str
+
+        :return: The size of the largest document to be processed inline,
+                 and of the largest document to be processed in the thread
+                 pool, which is 0 for methods not in THREAD_ENC_METHODS.
+        :rtype: tuple(int, int)
+        """
+        key = os.urandom(32)
+        secret = os.urandom(64)
+        threaded = enc_method in self.THREAD_ENC_METHODS
+        inline_max = thread_max = 0
+        for size in self.CALIBRATION_SIZES:
+            docstr = json.dumps({'content': 'x' * size})
+            elapsed = []
+            for _ in xrange(3):
+                start = time.time()
+                encrypt_docstr(
+                    docstr, 'doc-id', 'doc-rev', key, secret,
+                    enc_method=enc_method)
+                elapsed.append(time.time() - start)
+            if min(elapsed) <= self.INLINE_MAX_SECONDS:
+                inline_max = size
+            elif not threaded or min(elapsed) > self.THREAD_MAX_SECONDS:
+                break
+            if threaded:
+                thread_max = size
+        return inline_max, thread_max
+
+    def _set_thresholds(self, thresholds, enc_method):
+        inline_max, thread_max = thresholds
+        self._thresholds[enc_method] = thresholds
+        logger.debug(
+            "Crypto dispatch thresholds for %s: inline up to %d bytes, "
+            "threads up to %d bytes" % (enc_method, inline_max, thread_max))
+
+    def _calibration_done(self, result, enc_method):
+        self._calibrating.discard(enc_method)
+        return result
+
+    def thresholds(self, enc_method=DEFAULT_ENC_METHOD):
+        """
+        Return the size thresholds of an encryption method.
+
+        :param enc_method: The encryption method, one of
+                           crypto.EncryptionMethods.
+        :type enc_method: str
+
+        :return: The size of the largest document to be processed inline,
+                 and of the largest document to be processed in the thread
+                 pool.
+        :rtype: tuple(int, int)
+        """
+        return self._thresholds.get(
+            enc_method, (self.inline_max_bytes, self.thread_max_bytes))
+
+    def choose(self, size, enc_method=DEFAULT_ENC_METHOD):
+        """
+        Choose where to run a crypto task.
+
+        :param size: The size of the document, in bytes.
+        :type size: int
+        :param enc_method: The method the document is encrypted with, one of
+                           crypto.EncryptionMethods.
+        :type enc_method: str
+
+        :return: One of INLINE, THREAD or PROCESS.
+        :rtype: str
+        """
+        inline_max, thread_max = self.thresholds(enc_method)
+        if size <= inline_max:
+            return self.INLINE
+        if enc_method in self.THREAD_ENC_METHODS \
+                and size <= thread_max \
+                and self._pending_threads < self.MAX_PENDING_THREADS:
+            return self.THREAD
+        return self.PROCESS
+
+    def run(self, tier, requester, task, crypto, docs):
+        """
+        Run a crypto task.
+
+        Tasks run inline or in the thread pool use the crypto object of the
+        Soledad instance. Only the worker processes build crypto objects of
+        their own from the storage secret.
+
+        :param tier: Where to run the task, one of INLINE, THREAD or
+                     PROCESS.
+        :type tier: str
+        :param requester: The object on behalf of which the task is run, used
+                          to share the worker processes fairly.
+        :type requester: object
+        :param task: The task to run, either encrypt_docs_task or
+                     decrypt_docs_task.
+        :type task: callable
+        :param crypto: The crypto object of the Soledad instance.
+        :type crypto: leap.soledad.client.crypto.SoledadCrypto
+        :param docs: The documents for the task.
+        :type docs: list
+
+        :return: A deferred that will fire with the result of the task.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        if tier == self.INLINE:
+            return defer.maybeDeferred(
+                task, crypto.secret, crypto.compression, crypto.enc_method,
+                crypto.encoding, docs, crypto=crypto)
+        if tier == self.THREAD:
+            self._pending_threads += 1
+            d = threads.deferToThreadPool(
+                reactor, self._get_threadpool(), task, crypto.secret,
+                crypto.compression, crypto.enc_method, crypto.encoding, docs,
+                crypto=crypto)
+            d.addBoth(self._thread_done)
+            return d
+        return get_worker_pool().apply(
+            requester, task,
+            (crypto.secret, crypto.compression, crypto.enc_method,
+             crypto.encoding, docs))
+
+    def encrypt_doc(self, requester, crypto, doc):
+        """
+        Encrypt a document where it is cheapest to do it.
+
+        :param requester: The object on behalf of which the document is
+                          encrypted.
+        :type requester: object
+        :param crypto: The crypto object of the Soledad instance.
+        :type crypto: leap.soledad.client.crypto.SoledadCrypto
+        :param doc: The document to be encrypted.
+        :type doc: SoledadDocument
+
+        :return: A deferred that will fire with the encrypted content of the
+                 document.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        docstr = doc.get_json()
+        d = self.run(
+            self.choose(len(docstr), crypto.enc_method), requester,
+            encrypt_docs_task, crypto, [(doc.doc_id, doc.rev, docstr)])
+        d.addCallback(lambda results: results[0][2])
+        return d
+
+    def _thread_done(self, result):
+        self._pending_threads -= 1
+        return result
+
+    def _get_threadpool(self):
+        if self._threadpool is None:
+            self._threadpool = ThreadPool(
+                minthreads=1, maxthreads=self.THREADS,
+                name='soledad-crypto')
+            self._threadpool.start()
+            reactor.addSystemEventTrigger(
+                'during', 'shutdown', self._threadpool.stop)
+        return self._threadpool
+
+
+_crypto_dispatcher = None
+
+
+def get_crypto_dispatcher(enc_method=DEFAULT_ENC_METHOD):
+    """
+    Get the crypto dispatcher shared by all Soledad instances in this
+    process, creating it if needed. The dispatcher is calibrated for the
+    given encryption method in the background, if it was not yet.
+
+    :param enc_method: The encryption method used by the caller, one of
+                       crypto.EncryptionMethods.
+    :type enc_method: str
+
+    :return: The crypto dispatcher.
+    :rtype: CryptoDispatcher
+    """
+    global _crypto_dispatcher
+    if _crypto_dispatcher is None:
+        _crypto_dispatcher = CryptoDispatcher()
+    _crypto_dispatcher.calibrate(enc_method).addErrback(log.err)
+    return _crypto_dispatcher
+
+
 #
 # Encrypt/decrypt pools of workers
 #
@@ -50,8 +649,10 @@ class SyncEncryptDecryptPool(object):
     Base class for encrypter/decrypter pools.
     """
 
-    # TODO implement throttling to reduce cpu usage??
-    WORKERS = multiprocessing.cpu_count()
+    """
+    Maximum number of documents sent to a worker in a single task.
+    """
+    BATCH_SIZE = 32
 
     def __init__(self, crypto, sync_db):
         """
@@ -66,8 +667,11 @@ class SyncEncryptDecryptPool(object):
         self._crypto = crypto
         self._sync_db = sync_db
         self._pool = None
-        self._delayed_call = None
+        self._dispatcher = get_crypto_dispatcher(
+            crypto.enc_method if crypto is not None else DEFAULT_ENC_METHOD)
         self._started = False
+        # documents waiting to be sent to the workers, by task
+        self._batches = {}
 
     def start(self):
         self._create_pool()
@@ -75,36 +679,147 @@ class SyncEncryptDecryptPool(object):
 
     def stop(self):
         self._started = False
+        batches, self._batches = self._batches, {}
+        for batch in batches.values():
+            self._cancel_batch([d for _, d in batch])
         self._destroy_pool()
-        # maybe cancel the next delayed call
-        if self._delayed_call \
-                and not self._delayed_call.called:
-            self._delayed_call.cancel()
 
     @property
     def running(self):
         return self._started
 
     def _create_pool(self):
-        self._pool = multiprocessing.Pool(self.WORKERS)
+        soledad_assert(self._crypto is not None, "need a crypto object")
+        self._pool = get_worker_pool()
+
+    def _run_crypto_task(self, task, args, size, enc_method):
+        """
+        Run a crypto task for a document where it is cheapest to do it.
+
+        :param task: A task that receives the storage secret, the compression
+                     and encryption methods, the encoding and a list of
+                     documents, and returns the list of results, in the same
+                     order.
+        :type task: callable
+        :param args: The document to be processed.
+        :type args: tuple
+        :param size: The size of the document, in bytes.
+        :type size: int
+        :param enc_method: The method the document is or will be encrypted
+                           with.
+        :type enc_method: str
+
+        :return: A deferred that will fire with the result of the task for
+                 this document.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        tier = self._dispatcher.choose(size, enc_method)
+        if tier == CryptoDispatcher.PROCESS:
+            return self._apply_batched(task, args)
+        d = self._dispatcher.run(tier, self, task, self._crypto, [args])
+        d.addCallback(lambda results: results[0])
+        return d
 
-    def _destroy_pool(self):
+    def _apply_batched(self, task, args):
         """
-        Cleanly close the pool of workers.
+        Schedule a document to be processed by a task in the pool of workers.
+
+        Documents are sent to the workers in batches of at most BATCH_SIZE
+        documents, to reduce the overhead of inter-process communication. A
+        batch is sent as soon as it is full, or on the next iteration of the
+        reactor.
+
+        :param task: A task that receives a list of documents and returns the
+                     list of results, in the same order.
+        :type task: callable
+        :param args: The document to be processed.
+        :type args: tuple
+
+        :return: A deferred that will fire in the reactor thread with the
+                 result of the task for this document.
+        :rtype: twisted.internet.defer.Deferred
         """
-        logger.debug("Closing %s" % (self.__class__.__name__,))
-        self._pool.close()
-        try:
-            self._pool.join()
-        except Exception:
-            pass
+        d = defer.Deferred()
+        batch = self._batches.setdefault(task, [])
+        batch.append((args, d))
+        if len(batch) >= self.BATCH_SIZE:
+            self._flush_batch(task)
+        elif len(batch) == 1:
+            reactor.callLater(0, self._flush_batch, task)
+        return d
+
+    def _flush_batch(self, task):
+        """
+        Send the batch of documents waiting for a task to the workers.
+
+        :param task: The task.
+        :type task: callable
+        """
+        batch = self._batches.pop(task, None)
+        if not batch:
+            return
+        deferreds = [d for _, d in batch]
+        if not self.running:
+            self._cancel_batch(deferreds)
+            return
+        docs = [args for args, _ in batch]
+        args = (self._crypto.secret, self._crypto.compression,
+                self._crypto.enc_method, self._crypto.encoding, docs)
+        d = self._pool.apply(self, task, args)
+        d.addCallbacks(
+            self._batch_done, self._batch_failed,
+            callbackArgs=(deferreds,), errbackArgs=(deferreds,))
+
+    def _batch_done(self, results, deferreds):
+        """
+        Fire the deferreds of a batch with the results of the task.
+
+        :param results: The results of the task, one for each document.
+        :type results: list
+        :param deferreds: The deferreds of the documents in the batch.
+        :type deferreds: list
+        """
+        if not self.running:
+            self._cancel_batch(deferreds)
+            return
+        for d, result in zip(deferreds, results):
+            d.callback(result)
+
+    def _batch_failed(self, failure, deferreds):
+        """
+        Fail the deferreds of a batch with the failure of the task.
+
+        :param failure: The failure of the task.
+        :type failure: twisted.python.failure.Failure
+        :param deferreds: The deferreds of the documents in the batch.
+        :type deferreds: list
+        """
+        if not self.running:
+            self._cancel_batch(deferreds)
+            return
+        for d in deferreds:
+            d.errback(failure)
+
+    def _cancel_batch(self, deferreds):
+        """
+        Fail the deferreds of a batch that will not be processed because the
+        pool was stopped.
+
+        :param deferreds: The deferreds of the documents in the batch.
+        :type deferreds: list
+        """
+        for d in deferreds:
+            d.errback(defer.CancelledError())
 
-    def terminate(self):
+    def _destroy_pool(self):
         """
-        Terminate the pool of workers.
+        Release the shared pool of workers, dropping the batches that were
+        not sent to the workers yet.
         """
-        logger.debug("Terminating %s" % (self.__class__.__name__,))
-        self._pool.terminate()
+        logger.debug("Closing %s" % (self.__class__.__name__,))
+        if self._pool is not None:
+            self._pool.cancel(self)
+            self._pool = None
 
     def _runOperation(self, query, *args):
         """
@@ -136,28 +851,52 @@ class SyncEncryptDecryptPool(object):
         """
         return self._sync_db.runQuery(query, *args)
 
+    def _runInteraction(self, interaction, *args):
+        """
+        Run an interaction on the sync db, in a single transaction.
+
+        :param interaction: A callable that receives a cursor as its first
+                            argument.
+        :type interaction: callable
+        :param args: Further arguments for the interaction.
+        :type args: list
+
+        :return: A deferred that will fire with the result of the
+                 interaction.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        return self._sync_db.runInteraction(interaction, *args)
+
 
-def encrypt_doc_task(doc_id, doc_rev, content, key, secret):
+def encrypt_docs_task(secret, compression, enc_method, encoding, docs,
+                      crypto=None):
     """
-    Encrypt the content of the given document.
+    Encrypt the contents of a batch of documents in a worker.
 
-    :param doc_id: The document id.
-    :type doc_id: str
-    :param doc_rev: The document revision.
-    :type doc_rev: str
-    :param content: The serialized content of the document.
-    :type content: str
-    :param key: The encryption key.
-    :type key: str
-    :param secret: The Soledad storage secret (used for MAC auth).
+    :param secret: The Soledad storage secret.
     :type secret: str
-
-    :return: A tuple containing the doc id, revision and encrypted content.
-    :rtype: tuple(str, str, str)
+    :param compression: The compression method to apply before encryption,
+                        if any.
+    :type compression: str
+    :param enc_method: The encryption method.
+    :type enc_method: str
+    :param encoding: The encoding of the encrypted documents.
+    :type encoding: str
+    :param docs: A list of (doc_id, doc_rev, content) tuples.
+    :type docs: list
+    :param crypto: The crypto object to use, when running in the main
+                   process. Worker processes use a crypto object of their
+                   own.
+    :type crypto: leap.soledad.client.crypto.SoledadCrypto
+
+    :return: A list of (doc_id, doc_rev, encrypted_content) tuples.
+    :rtype: list
     """
-    encrypted_content = encrypt_docstr(
-        content, doc_id, doc_rev, key, secret)
-    return doc_id, doc_rev, encrypted_content
+    if crypto is None:
+        crypto = get_worker_crypto(secret, compression, enc_method, encoding)
+    encrypted = crypto.encrypt_docs(docs)
+    return [(doc_id, doc_rev, content)
+            for (doc_id, doc_rev, _), content in zip(docs, encrypted)]
 
 
 class SyncEncrypterPool(SyncEncryptDecryptPool):
@@ -168,68 +907,333 @@ class SyncEncrypterPool(SyncEncryptDecryptPool):
     TABLE_NAME = "docs_tosync"
     FIELD_NAMES = "doc_id PRIMARY KEY, rev, content"
 
-    ENCRYPT_LOOP_PERIOD = 2
+    """
+    Table of documents waiting for encryption, kept so that they can be
+    enqueued again after a restart.
+    """
+    BACKLOG_TABLE_NAME = "docs_toencrypt"
+    BACKLOG_FIELD_NAMES = "doc_id PRIMARY KEY, rev"
+
+    """
+    Maximum number of documents waiting in the encryption queue. Documents
+    changed while the queue is full are encrypted at sync time instead.
+    """
+    MAX_QUEUED_DOCS = 1000
+
+    """
+    Maximum number of documents taken from the encryption queue and being
+    encrypted at the same time.
+    """
+    MAX_ENCRYPTING_DOCS = 256
 
     def __init__(self, *args, **kwargs):
         """
         Initialize the sync encrypter pool.
         """
         SyncEncryptDecryptPool.__init__(self, *args, **kwargs)
-        self._encr_queue = defer.DeferredQueue()
-        # TODO delete already synced files from database
+        # documents waiting for encryption, by doc id. Documents are enqueued
+        # from the database threads, so access is protected by a lock.
+        self._encr_queue = OrderedDict()
+        self._encr_queue_lock = threading.Lock()
+        self._encrypting = 0
+        # revisions to be written to the backlog table, by doc id, also
+        # protected by the queue lock. They are written by a flush scheduled
+        # when the first one is added, or by an encryption result written
+        # before that.
+        self._backlog_writes = {}
+        # writes to the sync db run one after the other, so that a backlog
+        # entry is never written after the encryption result that removes it.
+        self._write_lock = defer.DeferredLock()
+        # recovery of the backlog, done in pages as the queue drains: the
+        # callable used to get the documents, the last recovered doc id and
+        # whether a page is being recovered.
+        self._backlog_get_docs = None
+        self._backlog_recovered_to = ''
+        self._recovering_backlog = False
 
     def start(self):
         """
         Start the encrypter pool.
         """
         SyncEncryptDecryptPool.start(self)
+        # the counter of documents being encrypted is not reset, because
+        # encryptions started before a stop still decrement it when they end
         logger.debug("Starting the encryption loop...")
-        reactor.callWhenRunning(self._maybe_encrypt_and_recurse)
+        reactor.callWhenRunning(self._process_encryption_queue)
 
     def stop(self):
         """
         Stop the encrypter pool.
         """
-        # close the sync queue
-        if self._encr_queue:
-            q = self._encr_queue
-            for d in q.pending:
-                d.cancel()
-            del q
-            self._encr_queue = None
-
+        # drop the documents waiting for encryption, they will be encrypted
+        # at sync time, or enqueued again from the backlog table on the next
+        # start.
+        with self._encr_queue_lock:
+            self._encr_queue.clear()
+            flush = bool(self._backlog_writes)
+        self._backlog_get_docs = None
         SyncEncryptDecryptPool.stop(self)
+        if flush:
+            self._flush_backlog_writes()
 
     def enqueue_doc_for_encryption(self, doc):
         """
         Enqueue a document for encryption.
 
+        If a previous revision of the document is still waiting in the queue,
+        it is replaced by the new one, keeping its place in the queue. If the
+        queue is full, the document is not enqueued and will be encrypted at
+        sync time.
+
+        This may be called from any thread.
+
+        The document is also recorded in the backlog table, so it is enqueued
+        again by `recover_backlog` if Soledad is restarted before it is
+        encrypted. Backlog entries added in the same reactor iteration are
+        written in a single transaction.
+
+        :param doc: The document to be encrypted.
+        :type doc: SoledadDocument
+
+        :return: Whether the document was enqueued.
+        :rtype: bool
+        """
+        with self._encr_queue_lock:
+            flush = not self._backlog_writes
+            self._backlog_writes[doc.doc_id] = doc.rev
+        if flush:
+            reactor.callFromThread(self._flush_backlog_writes)
+        return self._enqueue(doc)
+
+    def enqueue_docs_for_encryption(self, docs):
+        """
+        Enqueue many documents for encryption at once.
+
+        This behaves like calling `enqueue_doc_for_encryption` for each
+        document, but takes the queue lock and wakes up the reactor only
+        once for the whole batch.
+
+        This may be called from any thread.
+
+        :param docs: The documents to be encrypted.
+        :type docs: list of SoledadDocument
+
+        :return: The number of documents enqueued.
+        :rtype: int
+        """
+        if not docs:
+            return 0
+        enqueued = 0
+        with self._encr_queue_lock:
+            queued = len(self._encr_queue)
+            flush = not self._backlog_writes
+            for doc in docs:
+                self._backlog_writes[doc.doc_id] = doc.rev
+                if doc.doc_id not in self._encr_queue \
+                        and len(self._encr_queue) >= self.MAX_QUEUED_DOCS:
+                    logger.debug(
+                        "Encryption queue full, not enqueueing %s"
+                        % doc.doc_id)
+                    continue
+                self._encr_queue[doc.doc_id] = doc
+                enqueued += 1
+        if flush:
+            reactor.callFromThread(self._flush_backlog_writes)
+        if queued == 0 and enqueued:
+            reactor.callFromThread(self._process_encryption_queue)
+        return enqueued
+
+    def _enqueue(self, doc):
+        """
+        Put a document in the encryption queue, if there is room for it.
+
         :param doc: The document to be encrypted.
         :type doc: SoledadDocument
+
+        :return: Whether the document was enqueued.
+        :rtype: bool
+        """
+        with self._encr_queue_lock:
+            queued = len(self._encr_queue)
+            if doc.doc_id not in self._encr_queue \
+                    and queued >= self.MAX_QUEUED_DOCS:
+                logger.debug(
+                    "Encryption queue full, not enqueueing %s" % doc.doc_id)
+                return False
+            self._encr_queue[doc.doc_id] = doc
+        if queued == 0:
+            reactor.callFromThread(self._process_encryption_queue)
+        return True
+
+    def _process_encryption_queue(self):
+        """
+        Take documents from the encryption queue and encrypt them, keeping at
+        most MAX_ENCRYPTING_DOCS documents being encrypted at the same time.
+
+        Encrypted documents are stored in the sync db, from where they will be
+        read by the SoledadSyncTarget during the sync_exchange.
+        """
+        if not self.running:
+            return
+        docs = []
+        with self._encr_queue_lock:
+            while self._encr_queue \
+                    and self._encrypting + len(docs) \
+                    < self.MAX_ENCRYPTING_DOCS:
+                _, doc = self._encr_queue.popitem(last=False)
+                docs.append(doc)
+            drained = not self._encr_queue
+        self._encrypting += len(docs)
+        for doc in docs:
+            self._encrypt_doc(doc)
+        if drained and self._backlog_get_docs is not None:
+            self._recover_backlog_page().addErrback(log.err)
+
+    def _write(self, interaction):
+        """
+        Run a write interaction on the sync db, after all previous writes of
+        this pool have finished.
+
+        :param interaction: A callable that receives a cursor.
+        :type interaction: callable
+
+        :return: A deferred that will fire with the result of the
+                 interaction.
+        :rtype: twisted.internet.defer.Deferred
         """
-        try:
-            self._encr_queue.put(doc)
-        except Queue.Full:
-            # do not asynchronously encrypt this file if the queue is full
-            pass
+        return self._write_lock.run(self._runInteraction, interaction)
+
+    def _write_backlog(self, cursor, written=None):
+        """
+        Write the revisions enqueued since the last write to the backlog
+        table.
+
+        This runs inside a write interaction.
+
+        :param cursor: The cursor of the interaction.
+        :type cursor: pysqlcipher.dbapi2.Cursor
+        :param written: The (doc_id, rev) of a document whose encryption
+                        result is written in the same interaction, and so
+                        does not need a backlog entry.
+        :type written: tuple(str, str)
+        """
+        with self._encr_queue_lock:
+            writes, self._backlog_writes = self._backlog_writes, {}
+        if written is not None:
+            doc_id, rev = written
+            if writes.get(doc_id) == rev:
+                del writes[doc_id]
+        if writes:
+            query = "INSERT OR REPLACE INTO %s VALUES (?, ?)" \
+                % self.BACKLOG_TABLE_NAME
+            cursor.executemany(query, writes.items())
+
+    def _flush_backlog_writes(self):
+        """
+        Write the revisions enqueued since the last write to the backlog
+        table, in a single transaction.
+
+        :return: A deferred that will fire when the revisions have been
+                 written.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        d = self._write(self._write_backlog)
+        d.addErrback(log.err)
+        return d
+
+    @defer.inlineCallbacks
+    def recover_backlog(self, get_docs):
+        """
+        Enqueue again the documents that were waiting for encryption when
+        Soledad was last closed.
+
+        Backlog entries whose revision was already encrypted, superseded or
+        deleted are removed. Only as many documents as fit in the encryption
+        queue are enqueued, the next ones are enqueued each time the queue
+        drains.
+
+        :param get_docs: A callable that receives a list of document ids and
+                         returns a deferred that will fire with the
+                         documents, like `Soledad.get_docs`.
+        :type get_docs: callable
+
+        :return: A deferred that will fire when the documents have been
+                 enqueued.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        backlog = self.BACKLOG_TABLE_NAME
+        query = "DELETE FROM %s WHERE EXISTS (SELECT 1 FROM %s AS s " \
+            "WHERE s.doc_id = %s.doc_id AND s.rev = %s.rev)" \
+            % (backlog, self.TABLE_NAME, backlog, backlog)
+        yield self._write(lambda cursor: cursor.execute(query))
+        self._backlog_get_docs = get_docs
+        self._backlog_recovered_to = ''
+        yield self._recover_backlog_page()
 
     @defer.inlineCallbacks
-    def _maybe_encrypt_and_recurse(self):
+    def _recover_backlog_page(self):
         """
-        Process one document from the encryption queue.
+        Enqueue the next backlog entries, in the order of their doc ids, as
+        long as there is room in the encryption queue.
+
+        Entries whose revision is not the current one of the document are
+        removed. Entries whose document does not fit in the queue are kept,
+        and recovered when the queue drains.
 
-        Asynchronously encrypt a document that will then be stored in the sync
-        db. Processed documents will be read by the SoledadSyncTarget during
-        the sync_exchange.
+        :return: A deferred that will fire when the documents have been
+                 enqueued.
+        :rtype: twisted.internet.defer.Deferred
         """
+        get_docs = self._backlog_get_docs
+        if get_docs is None or self._recovering_backlog:
+            return
+        with self._encr_queue_lock:
+            room = self.MAX_QUEUED_DOCS - len(self._encr_queue)
+        if room <= 0:
+            return
+        self._recovering_backlog = True
         try:
-            while self.running:
-                doc = yield self._encr_queue.get()
-                self._encrypt_doc(doc)
-        except defer.QueueUnderflow:
-            self._delayed_call = reactor.callLater(
-                self.ENCRYPT_LOOP_PERIOD,
-                self._maybe_encrypt_and_recurse)
+            backlog = self.BACKLOG_TABLE_NAME
+            rows = yield self._runQuery(
+                "SELECT doc_id, rev FROM %s WHERE doc_id > ? "
+                "ORDER BY doc_id LIMIT ?" % backlog,
+                (self._backlog_recovered_to, room))
+            docs = yield get_docs(
+                [doc_id for doc_id, _ in rows], check_for_conflicts=False)
+            docs = dict((doc.doc_id, doc) for doc in docs)
+            recovered = 0
+            stale = []
+            full = False
+            for doc_id, rev in rows:
+                doc = docs.get(doc_id)
+                if doc is None or doc.rev != rev:
+                    stale.append((doc_id, rev))
+                elif not self._enqueue(doc):
+                    full = True
+                    break
+                else:
+                    recovered += 1
+                self._backlog_recovered_to = doc_id
+            if stale:
+                query = "DELETE FROM %s WHERE doc_id=? AND rev=?" % backlog
+                yield self._write(
+                    lambda cursor: cursor.executemany(query, stale))
+            if not full and len(rows) < room:
+                # every entry has been handled
+                self._backlog_get_docs = None
+            logger.debug(
+                "Recovered %d documents waiting for encryption" % recovered)
+        finally:
+            self._recovering_backlog = False
+        # the queue may have drained while this page was being recovered
+        with self._encr_queue_lock:
+            drained = not self._encr_queue
+        if drained:
+            yield self._recover_backlog_page()
+
+    def _encryption_done(self, _):
+        self._encrypting -= 1
+        self._process_encryption_queue()
 
     def _encrypt_doc(self, doc):
         """
@@ -237,20 +1241,38 @@ class SyncEncrypterPool(SyncEncryptDecryptPool):
 
         :param doc: The document with contents to be encrypted.
         :type doc: SoledadDocument
+        """
+        # encrypt asynchronously
+        docstr = doc.get_json()
+        d = self._run_crypto_task(
+            encrypt_docs_task, (doc.doc_id, doc.rev, docstr), len(docstr),
+            self._crypto.enc_method)
+        d.addCallback(self._encrypt_doc_cb)
+        d.addErrback(log.err)
+        d.addCallback(self._encryption_done)
 
-        :param workers: Whether to defer the decryption to the multiprocess
-                        pool of workers. Useful for debugging purposes.
-        :type workers: bool
+    def encrypt_doc(self, doc):
+        """
+        Symmetrically encrypt a document in the pool of workers and return
+        the encrypted content, without storing it in the sync db.
+
+        This is used during sync for documents that were not encrypted in
+        advance, so that encryption does not block the reactor and may happen
+        while other documents are being uploaded.
+
+        :param doc: The document with contents to be encrypted.
+        :type doc: SoledadDocument
+
+        :return: A deferred that will fire with the encrypted content of the
+                 document.
+        :rtype: twisted.internet.defer.Deferred
         """
-        soledad_assert(self._crypto is not None, "need a crypto object")
         docstr = doc.get_json()
-        key = self._crypto.doc_passphrase(doc.doc_id)
-        secret = self._crypto.secret
-        args = doc.doc_id, doc.rev, docstr, key, secret
-        # encrypt asynchronously
-        self._pool.apply_async(
-            encrypt_doc_task, args,
-            callback=self._encrypt_doc_cb)
+        d = self._run_crypto_task(
+            encrypt_docs_task, (doc.doc_id, doc.rev, docstr), len(docstr),
+            self._crypto.enc_method)
+        d.addCallback(lambda result: result[2])
+        return d
 
     def _encrypt_doc_cb(self, result):
         """
@@ -260,13 +1282,21 @@ class SyncEncrypterPool(SyncEncryptDecryptPool):
                        content.
         :type result: tuple(str, str, str)
         """
+        if not self.running:
+            # the document keeps its backlog entry, and will be encrypted
+            # again after a restart
+            return
         doc_id, doc_rev, content = result
         return self._insert_encrypted_local_doc(doc_id, doc_rev, content)
 
     def _insert_encrypted_local_doc(self, doc_id, doc_rev, content):
         """
         Insert the contents of the encrypted doc into the local sync
-        database.
+        database, and remove its backlog entry.
+
+        The revisions enqueued since the last write are written to the
+        backlog table in the same transaction, so that the backlog costs no
+        extra write per document.
 
         :param doc_id: The document id.
         :type doc_id: str
@@ -275,9 +1305,17 @@ class SyncEncrypterPool(SyncEncryptDecryptPool):
         :param content: The serialized content of the document.
         :type content: str
         """
-        query = "INSERT OR REPLACE INTO '%s' VALUES (?, ?, ?)" \
-                % (self.TABLE_NAME,)
-        return self._runOperation(query, (doc_id, doc_rev, content))
+        insert = "INSERT OR REPLACE INTO '%s' VALUES (?, ?, ?)" \
+                 % (self.TABLE_NAME,)
+        delete = "DELETE FROM %s WHERE doc_id=? AND rev=?" \
+                 % (self.BACKLOG_TABLE_NAME,)
+
+        def _insert(cursor):
+            self._write_backlog(cursor, written=(doc_id, doc_rev))
+            cursor.execute(insert, (doc_id, doc_rev, content))
+            cursor.execute(delete, (doc_id, doc_rev))
+
+        return self._write(_insert)
 
     @defer.inlineCallbacks
     def get_encrypted_doc(self, doc_id, doc_rev):
@@ -306,7 +1344,8 @@ class SyncEncrypterPool(SyncEncryptDecryptPool):
 
     def delete_encrypted_doc(self, doc_id, doc_rev):
         """
-        Delete an encrypted document from the sync db.
+        Delete an encrypted document from the sync db, together with its
+        entry in the backlog table, if any.
 
         :param doc_id: The id of the document.
         :type doc_id: str
@@ -317,40 +1356,63 @@ class SyncEncrypterPool(SyncEncryptDecryptPool):
                  has finished.
         :rtype: twisted.internet.defer.Deferred
         """
-        query = "DELETE FROM %s WHERE doc_id=? and rev=?" \
-                % self.TABLE_NAME
-        self._runOperation(query, (doc_id, doc_rev))
-
-
-def decrypt_doc_task(doc_id, doc_rev, content, gen, trans_id, key, secret,
-                     idx):
-    """
-    Decrypt the content of the given document.
-
-    :param doc_id: The document id.
-    :type doc_id: str
-    :param doc_rev: The document revision.
-    :type doc_rev: str
-    :param content: The encrypted content of the document.
-    :type content: str
-    :param gen: The generation corresponding to the modification of that
-                document.
-    :type gen: int
-    :param trans_id: The transaction id corresponding to the modification of
-                     that document.
-    :type trans_id: str
-    :param key: The encryption key.
-    :type key: str
-    :param secret: The Soledad storage secret (used for MAC auth).
-    :type secret: str
-    :param idx: The index of this document in the current sync process.
-    :type idx: int
+        queries = [
+            "DELETE FROM %s WHERE doc_id=? and rev=?" % table
+            for table in (self.TABLE_NAME, self.BACKLOG_TABLE_NAME)]
+
+        def _delete(cursor):
+            self._write_backlog(cursor)
+            for query in queries:
+                cursor.execute(query, (doc_id, doc_rev))
 
-    :return: A tuple containing the doc id, revision and encrypted content.
-    :rtype: tuple(str, str, str)
+        # this revision was sent, so it does not need to be encrypted ahead
+        # anymore.
+        with self._encr_queue_lock:
+            if self._backlog_writes.get(doc_id) == doc_rev:
+                del self._backlog_writes[doc_id]
+            queued = self._encr_queue.get(doc_id)
+            if queued is not None and queued.rev == doc_rev:
+                del self._encr_queue[doc_id]
+        return self._write(_delete)
+
+
+def decrypt_docs_task(secret, compression, enc_method, encoding, docs,
+                      crypto=None):
+    """
+    Decrypt the contents of a batch of documents in a worker.
+
+    :param secret: The Soledad storage secret.
+    :type secret: str
+    :param compression: The compression method of the Soledad instance. It is
+                        not needed for decryption, but keeps the worker's
+                        crypto object shared with encryption tasks.
+    :type compression: str
+    :param enc_method: The encryption method of the Soledad instance, which
+                       is passed for the same reason.
+    :type enc_method: str
+    :param encoding: The encoding of the Soledad instance, which is passed
+                     for the same reason.
+    :type encoding: str
+    :param docs: A list of (doc_id, doc_rev, content, gen, trans_id, idx)
+                 tuples.
+    :type docs: list
+    :param crypto: The crypto object to use, when running in the main
+                   process. Worker processes use a crypto object of their
+                   own.
+    :type crypto: leap.soledad.client.crypto.SoledadCrypto
+
+    :return: A list of (doc_id, doc_rev, decrypted_content, gen, trans_id,
+             idx) tuples.
+    :rtype: list
     """
-    decrypted_content = decrypt_doc_dict(content, doc_id, doc_rev, key, secret)
-    return doc_id, doc_rev, decrypted_content, gen, trans_id, idx
+    if crypto is None:
+        crypto = get_worker_crypto(secret, compression, enc_method, encoding)
+    decrypted = crypto.decrypt_docs(
+        [(doc_id, doc_rev, content)
+         for doc_id, doc_rev, content, _, _, _ in docs])
+    return [(doc_id, doc_rev, content, gen, trans_id, idx)
+            for (doc_id, doc_rev, _, gen, trans_id, idx), content
+            in zip(docs, decrypted)]
 
 
 class SyncDecrypterPool(SyncEncryptDecryptPool):
@@ -358,33 +1420,41 @@ class SyncDecrypterPool(SyncEncryptDecryptPool):
     Pool of workers that spawn subprocesses to execute the symmetric decryption
     of documents that were received.
 
-    The decryption of the received documents is done in two steps:
+    The processing of received documents is driven by events:
 
-        1. Encrypted documents are stored in the sync db by the actual soledad
-           sync loop.
+        1. The soledad sync loop hands us each document as soon as it arrives.
+           Encrypted documents are dispatched to the pool of workers right
+           away (or as soon as the pool is started).
         2. The soledad sync loop tells us how many documents we should expect
            to process.
-        3. We start a decrypt-and-process loop:
-
-            a. Encrypted documents are fetched.
-            b. Encrypted documents are decrypted.
-            c. The longest possible list of decrypted documents are inserted
-               in the soledad db (this depends on which documents have already
-               arrived and which documents have already been decrypte, because
-               the order of insertion in the local soledad db matters).
-            d. Processed documents are deleted from the database.
-
-        4. When we have processed as many documents as we should, the loop
-           finishes.
+        3. Whenever a document is decrypted, or a document that is not
+           encrypted arrives, it is stored in an in-memory reorder buffer
+           keyed by its index (or in the sync db, if the buffer is full) and
+           a processing step is triggered: the longest possible sequence of
+           decrypted documents is inserted in the soledad db (this depends
+           on which documents have already arrived and which documents have
+           already been decrypted, because the order of insertion in the
+           local soledad db matters).
+
+        4. When we have processed as many documents as we should, the
+           deferred of the pool is fired.
     """
     TABLE_NAME = "docs_received"
     FIELD_NAMES = "doc_id PRIMARY KEY, rev, content, gen, " \
                   "trans_id, encrypted, idx"
 
     """
-    Period of recurrence of the periodic decrypting task, in seconds.
+    Maximum size, in bytes, of the contents of decrypted documents kept in
+    memory while waiting for their predecessors. Documents that do not fit
+    are stored in the sync db until they can be inserted.
+    """
+    MAX_BUFFER_BYTES = 16 * 1024 * 1024
+
+    """
+    Maximum number of decrypted documents inserted in the local replica in a
+    single transaction, when a batch insertion callback is available.
     """
-    DECRYPT_LOOP_PERIOD = 0.5
+    INSERT_BATCH_SIZE = 500
 
     def __init__(self, *args, **kwargs):
         """
@@ -397,23 +1467,44 @@ class SyncDecrypterPool(SyncEncryptDecryptPool):
                               insert_doc_from_target in synchronizer, which
                               implements the TAKE OTHER semantics.
         :type insert_doc_cb: function
+        :param insert_docs_cb: An optional callback for inserting a run of
+                               received documents in a single transaction,
+                               which receives a list of (doc, gen, trans_id)
+                               tuples. If None, documents are inserted one by
+                               one using insert_doc_cb.
+        :type insert_docs_cb: function
         :param source_replica_uid: The source replica uid, used to find the
                                    correct callback for inserting documents.
         :type source_replica_uid: str
+        :param max_buffer_bytes: The maximum size of the in-memory reorder
+                                 buffer. Defaults to MAX_BUFFER_BYTES.
+        :type max_buffer_bytes: int
         """
         self._insert_doc_cb = kwargs.pop("insert_doc_cb")
+        self._insert_docs_cb = kwargs.pop("insert_docs_cb", None)
         self.source_replica_uid = kwargs.pop("source_replica_uid")
+        self._max_buffer_bytes = kwargs.pop(
+            "max_buffer_bytes", self.MAX_BUFFER_BYTES)
 
         SyncEncryptDecryptPool.__init__(self, *args, **kwargs)
 
         self._docs_to_process = None
         self._processed_docs = 0
         self._last_inserted_idx = 0
-        self._decrypting_docs = []
+        self._deferred = None
+
+        # decryptions requested before the pool of workers was started
+        self._pending_decryptions = []
+
+        # reorder buffer of decrypted documents waiting to be inserted, keyed
+        # by their index, and indexes of documents spilled to the sync db
+        self._buffer = {}
+        self._buffer_bytes = 0
+        self._spilled = set()
 
-        # a list that holds the asynchronous decryption results so they can be
-        # collected when they are ready
-        self._async_results = []
+        # state of the processing of decrypted documents
+        self._processing = False
+        self._reprocess = False
 
         # initialize db and make sure any database operation happens after
         # db initialization
@@ -463,17 +1554,22 @@ class SyncDecrypterPool(SyncEncryptDecryptPool):
         SyncEncryptDecryptPool.start(self)
         self._docs_to_process = docs_to_process
         self._deferred = defer.Deferred()
-        reactor.callWhenRunning(self._launch_decrypt_and_recurse)
-
-    def _launch_decrypt_and_recurse(self):
-        d = self._decrypt_and_recurse()
-        d.addErrback(self._errback)
+        pending = self._pending_decryptions
+        self._pending_decryptions = []
+        for d, args in pending:
+            d2 = self._run_crypto_task(
+                decrypt_docs_task, args, self._encrypted_size(args[2]),
+                args[2].get(ENC_METHOD_KEY))
+            d2.chainDeferred(d)
+        # there might be nothing to decrypt, or documents that do not need
+        # decryption might have arrived already.
+        self._schedule_processing()
 
     def _errback(self, failure):
         log.err(failure)
-        self._deferred.errback(failure)
-        self._processed_docs = 0
-        self._last_inserted_idx = 0
+        if self._deferred is not None and not self._deferred.called:
+            self._deferred.errback(failure)
+        self._reset()
 
     @property
     def deferred(self):
@@ -486,8 +1582,8 @@ class SyncDecrypterPool(SyncEncryptDecryptPool):
     def insert_encrypted_received_doc(
             self, doc_id, doc_rev, content, gen, trans_id, idx):
         """
-        Insert a received message with encrypted content, to be decrypted later
-        on.
+        Insert a received message with encrypted content, to be decrypted as
+        soon as the pool of workers is available.
 
         :param doc_id: The document ID.
         :type doc_id: str
@@ -502,22 +1598,42 @@ class SyncDecrypterPool(SyncEncryptDecryptPool):
         :param idx: The index of this document in the current sync process.
         :type idx: int
 
-        :return: A deferred that will fire when the operation in the database
-                 has finished.
+        :return: A deferred that will fire when the decrypted document has
+                 been stored in the sync db.
         :rtype: twisted.internet.defer.Deferred
         """
-        docstr = json.dumps(content)
-        query = "INSERT OR REPLACE INTO '%s' VALUES (?, ?, ?, ?, ?, ?, ?)" \
-                % self.TABLE_NAME
-        return self._runOperation(
-            query, (doc_id, doc_rev, docstr, gen, trans_id, 1, idx))
+        args = doc_id, doc_rev, content, gen, trans_id, idx
+        if self.running:
+            d = self._run_crypto_task(
+                decrypt_docs_task, args, self._encrypted_size(content),
+                content.get(ENC_METHOD_KEY))
+        else:
+            d = defer.Deferred()
+            self._pending_decryptions.append((d, args))
+        d.addCallback(self._decrypt_doc_cb)
+        d.addErrback(self._errback)
+        return d
+
+    @staticmethod
+    def _encrypted_size(content):
+        """
+        Return the size of the encrypted payload of a document.
+
+        :param content: The content of the document.
+        :type content: dict
+
+        :return: The size of the encrypted payload, in bytes.
+        :rtype: int
+        """
+        return len(content.get(ENC_JSON_KEY, ''))
 
     def insert_received_doc(
             self, doc_id, doc_rev, content, gen, trans_id, idx):
         """
         Insert a document that is not symmetrically encrypted.
-        We store it in the staging area (the decrypted_docs dictionary) to be
-        picked up in order as the preceding documents are decrypted.
+        We store it in the reorder buffer to be picked up in order as the
+        preceding documents are decrypted. If the buffer is full, the document
+        is stored in the sync db instead.
 
         :param doc_id: The document id
         :type doc_id: str
@@ -532,187 +1648,161 @@ class SyncDecrypterPool(SyncEncryptDecryptPool):
         :param idx: The index of this document in the current sync process.
         :type idx: int
 
-        :return: A deferred that will fire when the operation in the database
-                 has finished.
+        :return: A deferred that will fire when the document has been stored.
         :rtype: twisted.internet.defer.Deferred
         """
         if not isinstance(content, str):
             content = json.dumps(content)
+        size = len(content)
+        next_idx = self._last_inserted_idx + 1
+        if idx != next_idx \
+                and self._buffer_bytes + size > self._max_buffer_bytes:
+            d = self._spill_received_doc(
+                doc_id, doc_rev, content, gen, trans_id, idx)
+        else:
+            self._buffer[idx] = (doc_id, doc_rev, content, gen, trans_id)
+            self._buffer_bytes += size
+            d = defer.succeed(None)
+        d.addCallback(lambda _: self._schedule_processing())
+        return d
+
+    def _spill_received_doc(
+            self, doc_id, doc_rev, content, gen, trans_id, idx):
+        """
+        Store a document that does not fit in the reorder buffer in the sync
+        db.
+
+        :return: A deferred that will fire when the operation in the database
+                 has finished.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        logger.debug("Sync decrypter pool: spilling doc %s to sync db"
+                     % doc_id)
         query = "INSERT OR REPLACE INTO '%s' VALUES (?, ?, ?, ?, ?, ?, ?)" \
                 % self.TABLE_NAME
-        return self._runOperation(
+        d = self._runOperation(
             query, (doc_id, doc_rev, content, gen, trans_id, 0, idx))
+        d.addCallback(lambda _: self._spilled.add(idx))
+        return d
 
-    def _delete_received_doc(self, doc_id):
+    def _delete_spilled_docs(self, idxs):
         """
-        Delete a received doc after it was inserted into the local db.
+        Delete the received docs that were spilled to the sync db, after they
+        were inserted into the local db.
 
-        :param doc_id: Document ID.
-        :type doc_id: str
+        :param idxs: The indexes of the inserted documents in the current
+                     sync process.
+        :type idxs: list of int
 
         :return: A deferred that will fire when the operation in the database
                  has finished.
         :rtype: twisted.internet.defer.Deferred
         """
-        query = "DELETE FROM '%s' WHERE doc_id=?" \
+        spilled = [(idx,) for idx in idxs if idx in self._spilled]
+        if not spilled:
+            return defer.succeed(None)
+        query = "DELETE FROM '%s' WHERE idx=?" \
                 % self.TABLE_NAME
-        return self._runOperation(query, (doc_id,))
 
-    def _async_decrypt_doc(self, doc_id, rev, content, gen, trans_id, idx):
-        """
-        Dispatch an asynchronous document decrypting routine and save the
-        result object.
-
-        :param doc_id: The ID for the document with contents to be encrypted.
-        :type doc: str
-        :param rev: The revision of the document.
-        :type rev: str
-        :param content: The serialized content of the document.
-        :type content: str
-        :param gen: The generation corresponding to the modification of that
-                    document.
-        :type gen: int
-        :param trans_id: The transaction id corresponding to the modification
-                         of that document.
-        :type trans_id: str
-        :param idx: The index of this document in the current sync process.
-        :type idx: int
-        """
-        soledad_assert(self._crypto is not None, "need a crypto object")
+        def _discard(_):
+            self._spilled.difference_update(idx for idx, in spilled)
 
-        content = json.loads(content)
-        key = self._crypto.doc_passphrase(doc_id)
-        secret = self._crypto.secret
-        args = doc_id, rev, content, gen, trans_id, key, secret, idx
-        # decrypt asynchronously
-        self._async_results.append(
-            self._pool.apply_async(
-                decrypt_doc_task, args))
+        d = self._runInteraction(
+            lambda cursor: cursor.executemany(query, spilled))
+        d.addCallback(_discard)
+        return d
 
     def _decrypt_doc_cb(self, result):
         """
-        Store the decryption result in the sync db from where it will later be
-        picked by _process_decrypted_docs.
+        Store the decryption result in the reorder buffer, from where it will
+        be picked by _process_decrypted_docs. If the buffer is full, the
+        document is spilled to the sync db instead.
 
         :param result: A tuple containing the document's id, revision,
                        content, generation, transaction id and sync index.
         :type result: tuple(str, str, str, int, str, int)
 
         :return: A deferred that will fire after the document has been
-                 inserted in the sync db.
+                 stored.
         :rtype: twisted.internet.defer.Deferred
         """
         doc_id, rev, content, gen, trans_id, idx = result
         logger.debug("Sync decrypter pool: decrypted doc %s: %s %s %s"
                      % (doc_id, rev, gen, trans_id))
-        self._decrypting_docs.remove((doc_id, rev))
         return self.insert_received_doc(
             doc_id, rev, content, gen, trans_id, idx)
 
-    def _get_docs(self, encrypted=None, order_by='idx', order='ASC'):
+    @defer.inlineCallbacks
+    def _get_spilled_doc(self, idx):
         """
-        Get documents from the received docs table in the sync db.
+        Get a document that was spilled to the sync db. It is only deleted
+        from there after it has been inserted in the local replica.
 
-        :param encrypted: If not None, only return documents with encrypted
-                          field equal to given parameter.
-        :type encrypted: bool or None
-        :param order_by: The name of the field to order results.
-        :type order_by: str
-        :param order: Whether the order should be ASC or DESC.
-        :type order: str
+        :param idx: The index of the document in the current sync process.
+        :type idx: int
 
-        :return: A deferred that will fire with the results of the database
-                 query.
+        :return: A deferred that will fire with the document fields.
         :rtype: twisted.internet.defer.Deferred
         """
-        query = "SELECT doc_id, rev, content, gen, trans_id, encrypted, " \
-                "idx FROM %s" % self.TABLE_NAME
-        if encrypted is not None:
-            query += " WHERE encrypted = %d" % int(encrypted)
-        query += " ORDER BY %s %s" % (order_by, order)
-        return self._runQuery(query)
+        query = "SELECT doc_id, rev, content, gen, trans_id FROM %s " \
+                "WHERE idx = ?" % self.TABLE_NAME
+        result = yield self._runQuery(query, (idx,))
+        doc_id, rev, content, gen, trans_id = result[0]
+        defer.returnValue((doc_id, rev, content, gen, trans_id))
 
     @defer.inlineCallbacks
-    def _get_insertable_docs(self):
+    def _get_insertable_doc(self, offset=0):
         """
-        Return a list of non-encrypted documents ready to be inserted.
-
-        :return: A deferred that will fire with the list of insertable
-                 documents.
-        :rtype: twisted.internet.defer.Deferred
-        """
-        # here, we fetch the list of decrypted documents and compare with the
-        # index of the last succesfully processed document.
-        decrypted_docs = yield self._get_docs(encrypted=False)
-        insertable = []
-        last_idx = self._last_inserted_idx
-        for doc_id, rev, content, gen, trans_id, encrypted, idx in \
-                decrypted_docs:
-            # XXX for some reason, a document might not have been deleted from
-            #     the database. This is a bug. In this point, already
-            #     processed documents should have been removed from the sync
-            #     database and we should not have to skip them here. We need
-            #     to find out why this is happening, fix, and remove the
-            #     skipping below.
-            if (idx < last_idx + 1):
-                continue
-            if (idx != last_idx + 1):
-                break
-            insertable.append((doc_id, rev, content, gen, trans_id, idx))
-            last_idx += 1
-        defer.returnValue(insertable)
+        Return the next document to be inserted, if it has already been
+        decrypted.
 
-    @defer.inlineCallbacks
-    def _async_decrypt_received_docs(self):
-        """
-        Get all the encrypted documents from the sync database and dispatch a
-        decrypt worker to decrypt each one of them.
+        :param offset: How many documents after the last inserted one are
+                       already taken to be inserted.
+        :type offset: int
 
-        :return: A deferred that will fire after all documents have been
-                 decrypted and inserted back in the sync db.
+        :return: A deferred that will fire with the document fields, or None
+                 if the next document is not ready yet.
         :rtype: twisted.internet.defer.Deferred
         """
-        docs = yield self._get_docs(encrypted=True)
-        for doc_id, rev, content, gen, trans_id, _, idx in docs:
-            if (doc_id, rev) not in self._decrypting_docs:
-                self._decrypting_docs.append((doc_id, rev))
-                self._async_decrypt_doc(
-                    doc_id, rev, content, gen, trans_id, idx)
+        idx = self._last_inserted_idx + offset + 1
+        fields = self._buffer.pop(idx, None)
+        if fields is not None:
+            self._buffer_bytes -= len(fields[2])
+        elif idx in self._spilled:
+            fields = yield self._get_spilled_doc(idx)
+        if fields is None:
+            defer.returnValue(None)
+        defer.returnValue(fields + (idx,))
 
     @defer.inlineCallbacks
     def _process_decrypted_docs(self):
         """
-        Fetch as many decrypted documents as can be taken from the expected
-        order and insert them in the local replica.
+        Insert as many decrypted documents as can be taken in the expected
+        order in the local replica.
 
-        :return: A deferred that will fire with the list of inserted
-                 documents.
+        :return: A deferred that will fire when there are no more documents
+                 ready to be inserted.
         :rtype: twisted.internet.defer.Deferred
         """
-        insertable = yield self._get_insertable_docs()
-        for doc_fields in insertable:
-            self._insert_decrypted_local_doc(*doc_fields)
-        defer.returnValue(insertable)
-
-    def _delete_processed_docs(self, inserted):
-        """
-        Delete from the sync db documents that have been processed.
-
-        :param inserted: List of documents inserted in the previous process
-                         step.
-        :type inserted: list
-
-        :return: A list of deferreds that will fire when each operation in the
-                 database has finished.
-        :rtype: twisted.internet.defer.DeferredList
-        """
-        deferreds = []
-        for doc_id, doc_rev, _, _, _, _ in inserted:
-            deferreds.append(
-                self._delete_received_doc(doc_id))
-        if not deferreds:
-            return defer.succeed(None)
-        return defer.gatherResults(deferreds)
+        if self._insert_docs_cb is None:
+            while True:
+                doc_fields = yield self._get_insertable_doc()
+                if doc_fields is None:
+                    break
+                yield self._insert_decrypted_local_doc(*doc_fields)
+            return
+        while True:
+            # take the run of documents that can be inserted in order, as
+            # the last inserted index only moves when the run is inserted
+            batch = []
+            while len(batch) < self.INSERT_BATCH_SIZE:
+                doc_fields = yield self._get_insertable_doc(len(batch))
+                if doc_fields is None:
+                    break
+                batch.append(doc_fields)
+            if not batch:
+                break
+            yield self._insert_decrypted_local_docs(batch)
 
     def _insert_decrypted_local_doc(self, doc_id, doc_rev, content,
                                     gen, trans_id, idx):
@@ -734,6 +1824,12 @@ class SyncDecrypterPool(SyncEncryptDecryptPool):
         :param trans_id: The transaction id corresponding to the modification
                          of that document.
         :type trans_id: str
+        :param idx: The index of the document in the current sync process.
+        :type idx: int
+
+        :return: A deferred that will fire when the document has been
+                 inserted.
+        :rtype: twisted.internet.defer.Deferred
         """
         # could pass source_replica in params for callback chain
         logger.debug("Sync decrypter pool: inserting doc in local db: "
@@ -744,11 +1840,51 @@ class SyncDecrypterPool(SyncEncryptDecryptPool):
             content = None
         doc = SoledadDocument(doc_id, doc_rev, content)
         gen = int(gen)
-        self._insert_doc_cb(doc, gen, trans_id)
 
-        # store info about processed docs
-        self._last_inserted_idx = idx
-        self._processed_docs += 1
+        def _store_processed(_):
+            # store info about processed docs
+            self._last_inserted_idx = idx
+            self._processed_docs += 1
+
+        d = defer.maybeDeferred(self._insert_doc_cb, doc, gen, trans_id)
+        d.addCallback(_store_processed)
+        d.addCallback(lambda _: self._delete_spilled_docs([idx]))
+        return d
+
+    def _insert_decrypted_local_docs(self, batch):
+        """
+        Insert a run of decrypted documents into the local replica in a single
+        transaction, using the `insert_docs_cb` callback.
+
+        :param batch: A list of (doc_id, doc_rev, content, gen, trans_id,
+                      idx) tuples, in the order of their indexes.
+        :type batch: list
+
+        :return: A deferred that will fire when the documents have been
+                 inserted.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        logger.debug("Sync decrypter pool: inserting %d docs in local db"
+                     % len(batch))
+        entries = []
+        for doc_id, doc_rev, content, gen, trans_id, idx in batch:
+            # convert deleted documents to avoid error on document creation
+            if content == 'null':
+                content = None
+            entries.append(
+                (SoledadDocument(doc_id, doc_rev, content), int(gen),
+                 trans_id))
+
+        def _store_processed(_):
+            # store info about processed docs
+            self._last_inserted_idx = batch[-1][-1]
+            self._processed_docs += len(batch)
+
+        d = defer.maybeDeferred(self._insert_docs_cb, entries)
+        d.addCallback(_store_processed)
+        d.addCallback(lambda _: self._delete_spilled_docs(
+            [doc_fields[-1] for doc_fields in batch]))
+        return d
 
     def _init_db(self):
         """
@@ -761,50 +1897,52 @@ class SyncDecrypterPool(SyncEncryptDecryptPool):
         query = "DELETE FROM %s WHERE 1" % (self.TABLE_NAME,)
         return self._runOperation(query)
 
-    def _collect_async_decryption_results(self):
+    def _schedule_processing(self):
         """
-        Collect the results of the asynchronous doc decryptions and re-raise
-        any exception raised by a multiprocessing async decryption call.
+        Insert as many decrypted documents as possible in the local replica.
 
-        :raise Exception: Raised if an async call has raised an exception.
+        This is called whenever a decrypted document is stored in the sync db.
+        If a processing step is already running, another one is run right
+        after it, so that no document is left behind.
         """
-        async_results = self._async_results[:]
-        for res in async_results:
-            if res.ready():
-                self._decrypt_doc_cb(res.get())  # might raise an exception!
-                self._async_results.remove(res)
+        if not self.running or self._deferred is None \
+                or self._deferred.called:
+            return
+        if self._processing:
+            self._reprocess = True
+            return
+        self._processing = True
+        d = self._process_and_recurse()
+        d.addErrback(self._errback)
 
     @defer.inlineCallbacks
-    def _decrypt_and_recurse(self):
+    def _process_and_recurse(self):
         """
-        Decrypt the documents received from remote replica and insert them
-        into the local one.
+        Insert decrypted documents in the local replica until there is
+        nothing more to be inserted.
 
-        This method implicitelly returns a defferred (see the decorator
-        above). It should only be called by _launch_decrypt_and_process().
-        because this way any exceptions raised here will be stored by the
-        errback attached to the deferred returned.
-
-        :return: A deferred which will fire after all decrypt, process and
-                 delete operations have been executed.
+        :return: A deferred which will fire after all process and delete
+                 operations have been executed.
         :rtype: twisted.internet.defer.Deferred
         """
-        processed = self._processed_docs
-        pending = self._docs_to_process
-
-        if processed < pending:
-            yield self._async_decrypt_received_docs()
-            self._collect_async_decryption_results()
-            docs = yield self._process_decrypted_docs()
-            yield self._delete_processed_docs(docs)
-            # recurse
-            self._delayed_call = reactor.callLater(
-                self.DECRYPT_LOOP_PERIOD,
-                self._launch_decrypt_and_recurse)
-        else:
-            self._finish()
+        try:
+            self._reprocess = True
+            while self._reprocess:
+                self._reprocess = False
+                yield self._process_decrypted_docs()
+                if self._processed_docs >= self._docs_to_process:
+                    self._finish()
+                    break
+        finally:
+            self._processing = False
 
     def _finish(self):
         self._deferred.callback(None)
+        self._reset()
+
+    def _reset(self):
         self._processed_docs = 0
         self._last_inserted_idx = 0
+        self._buffer = {}
+        self._buffer_bytes = 0
+        self._spilled = set()
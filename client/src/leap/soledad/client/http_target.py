@@ -23,6 +23,9 @@ after receiving.
 
 
 import json
+import time
+import functools
+import collections
 import base64
 import logging
 import warnings
@@ -30,6 +33,7 @@ import warnings
 from uuid import uuid4
 
 from twisted.internet import defer
+from twisted.python.failure import Failure
 from twisted.web.error import Error
 from twisted.web.client import _ReadBodyProtocol
 from twisted.web.client import PartialDownloadError
@@ -51,6 +55,7 @@ from leap.soledad.client.events import SOLEDAD_SYNC_SEND_STATUS
 from leap.soledad.client.events import SOLEDAD_SYNC_RECEIVE_STATUS
 from leap.soledad.client.events import emit
 from leap.soledad.client.encdecpool import SyncDecrypterPool
+from leap.soledad.client.encdecpool import get_crypto_dispatcher
 
 
 logger = logging.getLogger(__name__)
@@ -72,12 +77,15 @@ class ReadBodyProtocol(_ReadBodyProtocol):
         self.headers = response.headers
 
     # ---8<--- snippet from u1db.remote.http_client, modified to use errbacks
-    def _error(self, respdic):
+    def _error(self, respdic, body):
         descr = respdic.get("error")
         exc_cls = errors.wire_description_to_exc.get(descr)
         if exc_cls is not None:
             message = respdic.get("message")
             self.deferred.errback(exc_cls(message))
+        else:
+            self.deferred.errback(
+                errors.HTTPError(self.status, body, self.headers))
     # ---8<--- end of snippet from u1db.remote.http_client
 
     def connectionLost(self, reason):
@@ -99,7 +107,7 @@ class ReadBodyProtocol(_ReadBodyProtocol):
                     self.deferred.errback(
                         errors.HTTPError(self.status, body, self.headers))
                 else:
-                    self._error(respdic)
+                    self._error(respdic, body)
             # special cases
             elif self.status == 503:
                 self.deferred.errback(errors.Unavailable(body, self.headers))
@@ -116,7 +124,60 @@ class ReadBodyProtocol(_ReadBodyProtocol):
             self.deferred.errback(reason)
 
 
-def readBody(response):
+class ReadStreamedBodyProtocol(ReadBodyProtocol):
+    """
+    A body reader that feeds successful responses to a parser as they arrive,
+    instead of accumulating the whole body in memory.
+    """
+
+    def __init__(self, response, deferred, parser):
+        """
+        Initialize the protocol.
+
+        :param parser: The parser to feed the response body to.
+        :type parser: ReceivedDocsParser
+        """
+        ReadBodyProtocol.__init__(self, response, deferred)
+        self._parser = parser
+        self._failure = None
+
+    def _is_success(self):
+        return self.status in (200, 201)
+
+    def dataReceived(self, data):
+        """
+        Feed received data to the parser, or accumulate it if the response
+        is an error.
+        """
+        if not self._is_success():
+            return ReadBodyProtocol.dataReceived(self, data)
+        if self._failure is not None:
+            # the stream is already broken, ignore the rest of it
+            return
+        try:
+            self._parser.feed(data)
+        except Exception:
+            self._failure = Failure()
+
+    def connectionLost(self, reason):
+        """
+        Fire the waiting L{Deferred} with the result of the parser, if the
+        response body has been completely received without error.
+        """
+        if not self._is_success() or not reason.check(ResponseDone):
+            return ReadBodyProtocol.connectionLost(self, reason)
+        if self._failure is None:
+            try:
+                result = self._parser.finish()
+            except Exception:
+                self._failure = Failure()
+        if self._failure is not None:
+            self.deferred.errback(self._failure)
+        else:
+            self.deferred.callback(result)
+
+
+def readBody(response, parser=None):
     """
     Get the body of an L{IResponse} and return it as a byte string.
 
@@ -125,6 +186,10 @@ def readBody(response):
 
     @param response: The HTTP response for which the body will be read.
     @type response: L{IResponse} provider
+    @param parser: If given, a successful response body will be fed to this
+        parser while it arrives, and the L{Deferred} will fire with the
+        result of the parser instead of the body.
+    @type parser: L{ReceivedDocsParser}
 
     @return: A L{Deferred} which will fire with the body of the response.
         Cancelling it will close the connection to the server immediately.
@@ -141,7 +206,10 @@ def readBody(response):
             abort()
 
     d = defer.Deferred(cancel)
-    protocol = ReadBodyProtocol(response, d)
+    if parser is None:
+        protocol = ReadBodyProtocol(response, d)
+    else:
+        protocol = ReadStreamedBodyProtocol(response, d, parser)
 
     def getAbort():
         return getattr(protocol.transport, 'abortConnection', None)
@@ -158,6 +226,197 @@ def readBody(response):
     return d
 
 
+class ReceivedDocsParser(object):
+    """
+    An incremental parser for the stream of documents sent by the server
+    during the receive phase of a sync.
+
+    The stream is a JSON list with one entry per line: the first entry holds
+    the sync metadata and the following ones hold one document each. Data can
+    be fed in chunks of any size, and each entry is handed to the callbacks
+    as soon as its line is complete, so that only one line of the stream has
+    to be kept in memory at a time.
+    """
+
+    _START, _METADATA, _ENTRIES, _END = range(4)
+
+    def __init__(self, metadata_cb, entry_cb):
+        """
+        Initialize the parser.
+
+        :param metadata_cb: A function called with the metadata dictionary
+                            as soon as it is parsed.
+        :type metadata_cb: callable(dict)
+        :param entry_cb: A function called with (doc_id, rev, content, gen,
+                         trans_id) for each document in the stream.
+        :type entry_cb: callable
+        """
+        self._metadata_cb = metadata_cb
+        self._entry_cb = entry_cb
+        self._state = self._START
+        self._buffer = []
+        self._comma = False
+        self._result = None
+        self._entries = 0
+
+    @property
+    def entries(self):
+        """
+        The number of documents parsed so far.
+        """
+        return self._entries
+
+    def feed(self, data):
+        """
+        Feed a chunk of the stream to the parser.
+
+        :param data: A chunk of the stream.
+        :type data: str
+
+        :raise BrokenSyncStream: If the stream is malformed.
+        """
+        start = 0
+        while True:
+            end = data.find('\n', start)
+            if end == -1:
+                if start < len(data):
+                    self._buffer.append(data[start:])
+                return
+            self._buffer.append(data[start:end])
+            line = ''.join(self._buffer)
+            self._buffer = []
+            self._parse_line(line.rstrip('\r'))
+            start = end + 1
+
+    def finish(self):
+        """
+        Signal the end of the stream.
+
+        :return: The new generation and transaction id of the target, and
+                 the total number of changes to be received in the current
+                 sync process.
+        :rtype: tuple(int, str, int)
+
+        :raise BrokenSyncStream: If the stream is malformed or incomplete.
+        """
+        if self._buffer:
+            line = ''.join(self._buffer)
+            self._buffer = []
+            self._parse_line(line.rstrip('\r'))
+        if self._state != self._END:
+            raise errors.BrokenSyncStream
+        return self._result
+
+    def _parse_line(self, line):
+        if self._state == self._START:
+            if line != '[':
+                raise errors.BrokenSyncStream
+            self._state = self._METADATA
+        elif self._state == self._METADATA:
+            line, self._comma = utils.check_and_strip_comma(line)
+            try:
+                metadata = json.loads(line)
+                self._result = (
+                    metadata['new_generation'],
+                    metadata['new_transaction_id'],
+                    metadata['number_of_changes'])
+            except (ValueError, KeyError, TypeError):
+                raise errors.BrokenSyncStream
+            self._state = self._ENTRIES
+            self._metadata_cb(metadata)
+        elif self._state == self._ENTRIES:
+            if line == ']':
+                if self._comma:  # extra comma
+                    raise errors.BrokenSyncStream
+                self._state = self._END
+                return
+            if not self._comma:  # no preceding comma
+                raise errors.BrokenSyncStream
+            line, self._comma = utils.check_and_strip_comma(line)
+            try:
+                entry = json.loads(line)
+                args = (
+                    entry['id'], entry['rev'], entry['content'],
+                    entry['gen'], entry['trans_id'])
+            except (ValueError, KeyError, TypeError):
+                raise errors.BrokenSyncStream
+            self._entries += 1
+            self._entry_cb(*args)
+        elif line:  # data after the end of the stream
+            raise errors.BrokenSyncStream
+
+
+class ReceiveWindow(object):
+    """
+    An adaptive window that bounds the number of concurrent download requests
+    during the receive phase of a sync.
+
+    The size of the window follows an AIMD (additive increase, multiplicative
+    decrease) policy, similar to TCP congestion control: it grows by one
+    request for each full window of successful responses and is halved when a
+    request fails or when the latency of a response gets too far above the
+    smallest latency observed so far. After being halved, the window will
+    only be halved again after a full window of responses has arrived.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=16, latency_factor=3.0):
+        """
+        Initialize the window.
+
+        :param initial: The initial size of the window.
+        :type initial: int
+        :param minimum: The minimum size of the window.
+        :type minimum: int
+        :param maximum: The maximum size of the window.
+        :type maximum: int
+        :param latency_factor: How many times the latency of a response may
+                               exceed the smallest observed latency before
+                               the window is decreased.
+        :type latency_factor: float
+        """
+        self._minimum = minimum
+        self._maximum = max(minimum, maximum)
+        self._size = float(min(max(initial, minimum), self._maximum))
+        self._latency_factor = latency_factor
+        self._base_latency = None
+        self._cooldown = 0
+
+    @property
+    def size(self):
+        """
+        The current number of allowed concurrent requests.
+        """
+        return int(self._size)
+
+    def success(self, latency):
+        """
+        Account for a successful response.
+
+        :param latency: The time (in seconds) it took to get the response.
+        :type latency: float
+        """
+        if self._base_latency is None or latency < self._base_latency:
+            self._base_latency = latency
+        if latency > self._base_latency * self._latency_factor:
+            self._decrease()
+        else:
+            self._cooldown = max(0, self._cooldown - 1)
+            self._size = min(self._maximum, self._size + 1.0 / self._size)
+
+    def failure(self):
+        """
+        Account for a failed request.
+        """
+        self._decrease()
+
+    def _decrease(self):
+        if self._cooldown > 0:
+            self._cooldown -= 1
+            return
+        self._size = max(self._minimum, self._size / 2.0)
+        self._cooldown = self.size
+
+
 class SoledadHTTPSyncTarget(SyncTarget):
 
     """
@@ -170,6 +429,52 @@ class SoledadHTTPSyncTarget(SyncTarget):
     written to the main database.
     """
 
+    """
+    Maximum number of documents to be sent to the server in a single upload
+    request.
+    """
+    MAX_BATCH_DOCS = 100
+
+    """
+    Size threshold (in bytes) of the body of a single upload request. A batch
+    is sent as soon as its size reaches this value, so a request will only
+    exceed it when a single document is bigger than the threshold.
+    """
+    MAX_BATCH_BYTES = 2 * 1024 * 1024
+
+    """
+    Maximum number of documents that may be fetched from the sync db or
+    encrypted ahead of the document currently being added to a batch. This
+    allows for encrypting the next documents while a batch is being uploaded.
+    """
+    ENCRYPT_READ_AHEAD = 2 * MAX_BATCH_DOCS
+
+    """
+    Maximum number of documents to be received from the server in a single
+    download request. Servers that do not support receiving many documents
+    in the same request are asked for one document at a time.
+    """
+    MAX_RECEIVE_DOCS = 50
+
+    """
+    Default maximum number of concurrent download requests. The actual number
+    of concurrent requests adapts to the observed latency and errors, and
+    never exceeds this value.
+    """
+    MAX_CONCURRENT_REQUESTS = 16
+
+    """
+    How many times a download request is retried when the server is
+    temporarily unavailable.
+    """
+    MAX_RECEIVE_RETRIES = 3
+
+    """
+    Maximum number of received documents that are inserted in the local
+    replica in a single transaction, when decryption is not deferred.
+    """
+    INSERT_BATCH_SIZE = 500
+
     def __init__(self, url, source_replica_uid, creds, crypto, cert_file,
                  sync_db=None, sync_enc_pool=None):
         """
@@ -210,9 +515,20 @@ class SoledadHTTPSyncTarget(SyncTarget):
         self._sync_db = sync_db
         self._sync_enc_pool = sync_enc_pool
         self._insert_doc_cb = None
+        self._insert_docs_cb = None
+        # received documents waiting to be inserted in order, by the index of
+        # the first document of their download request
+        self._received_batches = {}
+        self._next_insert_idx = 1
+        self._insertable_docs = []
+        self._received_insertion = defer.succeed(None)
         # asynchronous encryption/decryption attributes
         self._decryption_callback = None
         self._sync_decr_pool = None
+        self._receive_window = ReceiveWindow()
+        # whether the server accepts requests for many documents at once, or
+        # None if that is not known yet
+        self._server_sends_batches = None
         self._http = HTTPClient(cert_file)
 
     def close(self):
@@ -235,6 +551,14 @@ class SoledadHTTPSyncTarget(SyncTarget):
     def _defer_encryption(self):
         return self._sync_enc_pool is not None
 
+    @property
+    def receive_window(self):
+        """
+        The number of concurrent download requests allowed by the end of the
+        last receive phase.
+        """
+        return self._receive_window.size
+
     #
     # SyncTarget API
     #
@@ -312,7 +636,8 @@ class SoledadHTTPSyncTarget(SyncTarget):
     def sync_exchange(self, docs_by_generation, source_replica_uid,
                       last_known_generation, last_known_trans_id,
                       insert_doc_cb, ensure_callback=None,
-                      defer_decryption=True, sync_id=None):
+                      defer_decryption=True, sync_id=None,
+                      max_concurrent_requests=None, insert_docs_cb=None):
         """
         Find out which documents the remote database does not know about,
         encrypt and send them. After that, receive documents from the remote
@@ -349,6 +674,18 @@ class SoledadHTTPSyncTarget(SyncTarget):
                                  decryption will be done inline.
         :type defer_decryption: bool
 
+        :param max_concurrent_requests: The maximum number of concurrent
+                                        requests for receiving documents. If
+                                        None, MAX_CONCURRENT_REQUESTS is used.
+        :type max_concurrent_requests: int
+
+        :param insert_docs_cb: An optional callback for inserting a run of
+                               received documents in a single transaction.
+                               It receives a list of (doc, gen, trans_id)
+                               tuples. If None, documents are inserted one
+                               by one using insert_doc_cb.
+        :type insert_docs_cb: function
+
         :return: A deferred which fires with the new generation and
                  transaction id of the target replica.
         :rtype: twisted.internet.defer.Deferred
@@ -360,8 +697,10 @@ class SoledadHTTPSyncTarget(SyncTarget):
             sync_id = str(uuid4())
         self.source_replica_uid = source_replica_uid
 
-        # save a reference to the callback so we can use it after decrypting
+        # save a reference to the callbacks so we can use them after
+        # decrypting
         self._insert_doc_cb = insert_doc_cb
+        self._insert_docs_cb = insert_docs_cb
 
         gen_after_send, trans_id_after_send = yield self._send_docs(
             docs_by_generation,
@@ -372,7 +711,8 @@ class SoledadHTTPSyncTarget(SyncTarget):
         cur_target_gen, cur_target_trans_id = yield self._receive_docs(
             last_known_generation, last_known_trans_id,
             ensure_callback, sync_id,
-            defer_decryption=defer_decryption)
+            defer_decryption=defer_decryption,
+            max_concurrent_requests=max_concurrent_requests)
 
         # update gen and trans id info in case we just sent and did not
         # receive docs.
@@ -408,46 +748,106 @@ class SoledadHTTPSyncTarget(SyncTarget):
             last_known_trans_id=last_known_trans_id,
             sync_id=sync_id,
             ensure=self._ensure_callback is not None)
-        idx = 0
         total = len(docs_by_generation)
-        for doc, gen, trans_id in docs_by_generation:
-            idx += 1
-            result = yield self._send_one_doc(
-                headers, first_entries, doc,
-                gen, trans_id, total, idx)
-            if self._defer_encryption:
-                self._sync_enc_pool.delete_encrypted_doc(
-                    doc.doc_id, doc.rev)
-
-            msg = "%d/%d" % (idx, total)
-            content = {'sent': idx, 'total': total}
-            emit(SOLEDAD_SYNC_SEND_STATUS, content)
-            logger.debug("Sync send status: %s" % msg)
-
+        entries = first_entries[:]
+        batch_size = 0
+        batch = []
+
+        # Documents are fetched from the sync db or encrypted ahead of time,
+        # so that the next ones are being prepared while a batch is uploaded.
+        # Batches are still sent one after the other and documents are added
+        # to them in order, so doc_idx always matches the upload order.
+        to_encrypt = iter(enumerate(docs_by_generation, 1))
+        encrypting = collections.deque()
+
+        def _read_ahead():
+            for idx, (doc, gen, trans_id) in to_encrypt:
+                encrypting.append(
+                    (idx, doc, gen, trans_id, self._encrypt_doc(doc)))
+                if len(encrypting) >= self.ENCRYPT_READ_AHEAD:
+                    break
+
+        _read_ahead()
+        sending = None
+        while encrypting:
+            idx, doc, gen, trans_id, d = encrypting.popleft()
+            content = yield d
+            _read_ahead()
+            # add the document to the current batch
+            batch_size += self._prepare(
+                ',', entries,
+                id=doc.doc_id, rev=doc.rev, content=content, gen=gen,
+                trans_id=trans_id, number_of_docs=total,
+                doc_idx=idx)
+            batch.append(doc)
+            # send the batch if it is full or if this is the last document
+            if len(batch) < self.MAX_BATCH_DOCS \
+                    and batch_size < self.MAX_BATCH_BYTES \
+                    and idx < total:
+                continue
+            # wait for the previous batch before sending this one
+            if sending is not None:
+                yield sending
+            sending = self._send_batch(headers, entries)
+            sending.addCallback(self._batch_sent, batch, idx, total)
+            entries = first_entries[:]
+            batch_size = 0
+            batch = []
+
+        result = yield sending
         response_dict = json.loads(result)[0]
         gen_after_send = response_dict['new_generation']
         trans_id_after_send = response_dict['new_transaction_id']
         defer.returnValue([gen_after_send, trans_id_after_send])
 
-    @defer.inlineCallbacks
-    def _send_one_doc(self, headers, first_entries, doc, gen, trans_id,
-                      number_of_docs, doc_idx):
-        entries = first_entries[:]
-        # add the document to the request
-        content = yield self._encrypt_doc(doc)
-        self._prepare(
-            ',', entries,
-            id=doc.doc_id, rev=doc.rev, content=content, gen=gen,
-            trans_id=trans_id, number_of_docs=number_of_docs,
-            doc_idx=doc_idx)
+    def _send_batch(self, headers, entries):
+        """
+        Send a batch of documents to the server in a single request.
+
+        :param headers: The headers of the request.
+        :type headers: dict
+        :param entries: The list of serialized entries of the request,
+                        starting with the sync metadata and followed by one
+                        entry for each document in the batch.
+        :type entries: list
+
+        :return: A deferred that will fire with the body of the response.
+        :rtype: twisted.internet.defer.Deferred
+        """
         entries.append('\r\n]')
         data = ''.join(entries)
-        result = yield self._http_request(
+        return self._http_request(
             self._url,
             method='POST',
             headers=headers,
             body=data)
-        defer.returnValue(result)
+
+    def _batch_sent(self, result, batch, idx, total):
+        """
+        Account for a batch of documents that was successfully sent.
+
+        :param result: The body of the response to the batch request.
+        :type result: str
+        :param batch: The documents in the batch.
+        :type batch: list
+        :param idx: The index of the last document in the batch.
+        :type idx: int
+        :param total: The total number of documents to send.
+        :type total: int
+
+        :return: The body of the response.
+        :rtype: str
+        """
+        if self._defer_encryption:
+            for sent_doc in batch:
+                self._sync_enc_pool.delete_encrypted_doc(
+                    sent_doc.doc_id, sent_doc.rev)
+
+        msg = "%d/%d" % (idx, total)
+        content = {'sent': idx, 'total': total}
+        emit(SOLEDAD_SYNC_SEND_STATUS, content)
+        logger.debug("Sync send status: %s" % msg)
+        return result
 
     def _encrypt_doc(self, doc):
         d = None
@@ -455,15 +855,16 @@ class SoledadHTTPSyncTarget(SyncTarget):
             d = defer.succeed(None)
         elif not self._defer_encryption:
             # fallback case, for tests
-            d = defer.succeed(self._crypto.encrypt_doc(doc))
+            d = get_crypto_dispatcher(self._crypto.enc_method).encrypt_doc(
+                self, self._crypto, doc)
         else:
 
             def _maybe_encrypt_doc_inline(doc_json):
                 if doc_json is None:
                     # the document is not marked as tombstone, but we got
                     # nothing from the sync db. As it is not encrypted
-                    # yet, we force inline encryption.
-                    return self._crypto.encrypt_doc(doc)
+                    # yet, we encrypt it in the pool of workers.
+                    return self._sync_enc_pool.encrypt_doc(doc)
                 return doc_json
 
             d = self._sync_enc_pool.get_encrypted_doc(doc.doc_id, doc.rev)
@@ -476,7 +877,8 @@ class SoledadHTTPSyncTarget(SyncTarget):
 
     @defer.inlineCallbacks
     def _receive_docs(self, last_known_generation, last_known_trans_id,
-                      ensure_callback, sync_id, defer_decryption):
+                      ensure_callback, sync_id, defer_decryption,
+                      max_concurrent_requests=None):
 
         self._queue_for_decrypt = defer_decryption \
             and self._sync_db is not None
@@ -491,22 +893,30 @@ class SoledadHTTPSyncTarget(SyncTarget):
         if defer_decryption:
             self._setup_sync_decr_pool()
 
+        if max_concurrent_requests is None:
+            max_concurrent_requests = self.MAX_CONCURRENT_REQUESTS
+        self._receive_window = ReceiveWindow(
+            maximum=max_concurrent_requests)
+        self._received_batches = {}
+        self._next_insert_idx = 1
+        self._insertable_docs = []
+        self._received_insertion = defer.succeed(None)
+
         headers = self._auth_header.copy()
         headers.update({'content-type': ['application/x-soledad-sync-get']})
 
         # ---------------------------------------------------------------------
-        # maybe receive the first document
+        # maybe receive the first batch of documents
         # ---------------------------------------------------------------------
 
-        # we fetch the first document before fetching the rest because we need
-        # to know the total number of documents to be received, and this
-        # information comes as metadata to each request.
+        # we fetch the first batch of documents before fetching the rest
+        # because we need to know the total number of documents to be
+        # received, and this information comes as metadata to each request.
 
-        doc = yield self._receive_one_doc(
-            headers, last_known_generation, last_known_trans_id,
-            sync_id, 0)
         self._received_docs = 0
-        number_of_changes, ngen, ntrans = self._insert_received_doc(doc, 1, 1)
+        ngen, ntrans, number_of_changes = yield self._receive_first_doc_batch(
+            headers, last_known_generation, last_known_trans_id, sync_id)
+        count = self._receive_count
 
         # update the target gen and trans_id in case a document was received
         if ngen:
@@ -520,27 +930,24 @@ class SoledadHTTPSyncTarget(SyncTarget):
         # maybe receive the rest of the documents
         # ---------------------------------------------------------------------
 
-        # launch many asynchronous fetches and inserts of received documents
-        # in the temporary sync db. Will wait for all results before
-        # continuing.
+        # fetch and insert the remaining batches of received documents in the
+        # temporary sync db, keeping a bounded number of requests in flight.
+        # Will wait for all results before continuing.
 
-        received = 1
-        deferreds = []
-        while received < number_of_changes:
-            d = self._receive_one_doc(
+        def _receive_and_insert(received):
+            return self._receive_doc_batch(
                 headers, last_known_generation,
-                last_known_trans_id, sync_id, received)
-            d.addCallback(
-                self._insert_received_doc,
-                received + 1,  # the index of the current received doc
-                number_of_changes)
-            deferreds.append(d)
-            received += 1
-        results = yield defer.gatherResults(deferreds)
+                last_known_trans_id, sync_id, received, count)
+
+        offsets = range(self._received_docs, number_of_changes, count)
+        results = yield self._receive_windowed(_receive_and_insert, offsets)
 
         # get generation and transaction id of target after insertions
-        if deferreds:
-            _, new_generation, new_transaction_id = results.pop()
+        if results:
+            new_generation, new_transaction_id, _ = results.pop()
+        yield self._received_insertion
+        logger.debug(
+            "Sync receive window: %d" % self._receive_window.size)
 
         # ---------------------------------------------------------------------
         # wait for async decryption to finish
@@ -552,8 +959,132 @@ class SoledadHTTPSyncTarget(SyncTarget):
 
         defer.returnValue([new_generation, new_transaction_id])
 
-    def _receive_one_doc(self, headers, last_known_generation,
-                         last_known_trans_id, sync_id, received):
+    @property
+    def _receive_count(self):
+        """
+        The number of documents to ask for in each download request.
+        """
+        if self._server_sends_batches is False:
+            return 1
+        return self.MAX_RECEIVE_DOCS
+
+    @defer.inlineCallbacks
+    def _receive_first_doc_batch(self, headers, last_known_generation,
+                                 last_known_trans_id, sync_id):
+        """
+        Request the first batch of documents from the server.
+
+        Servers that predate batched downloads reject the number of documents
+        to be received with a bad request error. In that case, the first
+        document is requested again on its own, and the rest of the documents
+        will be requested one at a time.
+
+        See `_receive_doc_batch` for the parameters and the result.
+        """
+        count = self._receive_count
+        try:
+            result = yield self._receive_doc_batch(
+                headers, last_known_generation, last_known_trans_id,
+                sync_id, 0, count)
+        except errors.HTTPError as e:
+            if count == 1 or e.status != 400:
+                raise
+            logger.warning(
+                "Server does not send documents in batches, receiving one "
+                "document per request.")
+            self._server_sends_batches = False
+            result = yield self._receive_doc_batch(
+                headers, last_known_generation, last_known_trans_id,
+                sync_id, 0, 1)
+        else:
+            if count > 1:
+                self._server_sends_batches = True
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def _receive_windowed(self, receive, offsets):
+        """
+        Call C{receive} for each offset, keeping at most as many calls in
+        flight as allowed by the current receive window.
+
+        :param receive: A function that receives the batch of documents that
+                        starts at a given offset and returns a deferred.
+        :type receive: callable(int)
+        :param offsets: The offsets of the batches to receive.
+        :type offsets: list
+
+        :return: A deferred that will fire with the list of results of all
+                 calls, in no particular order, or with the first failure
+                 after all calls in flight have finished.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        window = self._receive_window
+        pending = list(reversed(offsets))
+        retries = dict.fromkeys(offsets, 0)
+        in_flight = set()
+        results = []
+        failures = []
+        waiting = []
+
+        def _done(result, d, offset, started):
+            in_flight.discard(d)
+            if isinstance(result, Failure):
+                window.failure()
+                if result.check(errors.Unavailable) \
+                        and retries[offset] < self.MAX_RECEIVE_RETRIES:
+                    logger.warning(
+                        "Server unavailable, retrying to receive docs...")
+                    retries[offset] += 1
+                    pending.append(offset)
+                else:
+                    failures.append(result)
+            else:
+                window.success(time.time() - started)
+                results.append(result)
+            if waiting:
+                waiting.pop().callback(None)
+
+        while (pending and not failures) or in_flight:
+            while pending and not failures and len(in_flight) < window.size:
+                offset = pending.pop()
+                d = receive(offset)
+                in_flight.add(d)
+                d.addBoth(_done, d, offset, time.time())
+            if in_flight:
+                wakeup = defer.Deferred()
+                waiting.append(wakeup)
+                yield wakeup
+
+        if failures:
+            failures[0].raiseException()
+        defer.returnValue(results)
+
+    def _receive_doc_batch(self, headers, last_known_generation,
+                           last_known_trans_id, sync_id, received, count):
+        """
+        Request a batch of documents from the server.
+
+        :param headers: The headers of the request.
+        :type headers: dict
+        :param last_known_generation: Target's last known generation.
+        :type last_known_generation: int
+        :param last_known_trans_id: Target's last known transaction id.
+        :type last_known_trans_id: str
+        :param sync_id: The id of the current sync session.
+        :type sync_id: str
+        :param received: How many documents have already been received.
+        :type received: int
+        :param count: The maximum number of documents to receive.
+        :type count: int
+
+        :return: A deferred that will fire with the new generation and
+                 transaction id of the target and the number of changes to be
+                 received in the current sync process, after all documents in
+                 the batch have been inserted, or queued for insertion. It
+                 fails with BrokenSyncStream if the server sent fewer
+                 documents than requested.
+        :rtype: twisted.internet.defer.Deferred
+        """
         entries = ['[']
         # add remote replica metadata to the request
         self._prepare(
@@ -562,119 +1093,259 @@ class SoledadHTTPSyncTarget(SyncTarget):
             last_known_trans_id=last_known_trans_id,
             sync_id=sync_id,
             ensure=self._ensure_callback is not None)
-        # inform server of how many documents have already been received
-        self._prepare(
-            ',', entries, received=received)
+        # inform server of how many documents have already been received and
+        # how many we want to receive now
+        if count > 1:
+            self._prepare(
+                ',', entries, received=received, count=count)
+        else:
+            self._prepare(
+                ',', entries, received=received)
         entries.append('\r\n]')
-        # send headers
-        return self._http_request(
+        # documents are inserted while the response is being received, or
+        # collected and queued for insertion when the request succeeds
+        docs = []
+        parser = self._received_docs_parser(received + 1, docs)
+        d = self._http_request(
             self._url,
             method='POST',
             headers=headers,
-            body=''.join(entries))
+            body=''.join(entries),
+            parser=parser)
+        d.addCallback(self._check_received_docs, parser, received, count)
+        d.addCallback(self._queue_received_docs, received + 1, docs)
+        return d
+
+    def _check_received_docs(self, result, parser, received, count):
+        """
+        Make sure that a download request got all the documents it asked for.
+
+        :param result: The result of the download request.
+        :type result: tuple(int, str, int)
+        :param parser: The parser of the response.
+        :type parser: ReceivedDocsParser
+        :param received: How many documents had already been received.
+        :type received: int
+        :param count: The maximum number of documents requested.
+        :type count: int
+
+        :return: The result of the download request.
+        :rtype: tuple(int, str, int)
+
+        :raise BrokenSyncStream: If the server sent fewer or more documents
+            than requested.
+        """
+        number_of_changes = result[2]
+        expected = max(0, min(count, number_of_changes - received))
+        if parser.entries != expected:
+            raise errors.BrokenSyncStream(
+                "Expected %d documents from the server, got %d."
+                % (expected, parser.entries))
+        return result
+
+    def _received_docs_parser(self, idx, docs):
+        """
+        Build a parser that inserts received documents into the local replica
+        as soon as they are parsed.
+
+        :param idx: The index of the first document of the batch in the
+                    current sync process.
+        :type idx: int
+        :param docs: The list in which to collect the documents to be
+                     inserted in a batch.
+        :type docs: list
+
+        :return: The parser.
+        :rtype: ReceivedDocsParser
+        """
+        state = {'idx': idx, 'total': None}
+
+        def _metadata_cb(metadata):
+            state['total'] = metadata['number_of_changes']
+            self._ensure_replica_uid(metadata)
+
+        def _entry_cb(doc_id, rev, content, gen, trans_id):
+            self._insert_received_doc(
+                doc_id, rev, content, gen, trans_id, state['idx'],
+                state['total'], docs)
+            state['idx'] += 1
+
+        return ReceivedDocsParser(_metadata_cb, _entry_cb)
+
+    def _ensure_replica_uid(self, metadata):
+        """
+        Make sure we have replica_uid from fresh new dbs.
+
+        :param metadata: The metadata sent by the server.
+        :type metadata: dict
+        """
+        if self._ensure_callback and 'replica_uid' in metadata:
+            self._ensure_callback(metadata['replica_uid'])
 
-    def _insert_received_doc(self, response, idx, total):
+    def _insert_received_doc(self, doc_id, rev, content, gen, trans_id, idx,
+                             total, docs):
         """
         Insert a received document into the local replica.
 
-        :param response: The body and headers of the response.
-        :type response: tuple(str, dict)
+        :param doc_id: The document id.
+        :type doc_id: str
+        :param rev: The document revision.
+        :type rev: str
+        :param content: The content of the document.
+        :type content: dict
+        :param gen: The target generation corresponding to the document.
+        :type gen: int
+        :param trans_id: The target transaction id corresponding to the
+                         document.
+        :type trans_id: str
         :param idx: The index count of the current operation.
         :type idx: int
         :param total: The total number of operations.
         :type total: int
+        :param docs: The list in which to collect the documents of the
+                     download request to be inserted in a batch.
+        :type docs: list
         """
-        new_generation, new_transaction_id, number_of_changes, doc_id, \
-            rev, content, gen, trans_id = \
-            self._parse_received_doc_response(response)
-        if doc_id is not None:
-            # decrypt incoming document and insert into local database
-            # -------------------------------------------------------------
-            # symmetric decryption of document's contents
-            # -------------------------------------------------------------
-            # If arriving content was symmetrically encrypted, we decrypt it.
-            # We do it inline if defer_decryption flag is False or no sync_db
-            # was defined, otherwise we defer it writing it to the received
-            # docs table.
-            doc = SoledadDocument(doc_id, rev, content)
-            if is_symmetrically_encrypted(doc):
-                if self._queue_for_decrypt:
-                    self._sync_decr_pool.insert_encrypted_received_doc(
-                        doc.doc_id, doc.rev, doc.content, gen, trans_id,
-                        idx)
-                else:
-                    # defer_decryption is False or no-sync-db fallback
-                    doc.set_json(self._crypto.decrypt_doc(doc))
-                    self._insert_doc_cb(doc, gen, trans_id)
+        # decrypt incoming document and insert into local database
+        # -------------------------------------------------------------
+        # symmetric decryption of document's contents
+        # -------------------------------------------------------------
+        # If arriving content was symmetrically encrypted, we decrypt it.
+        # We do it inline if defer_decryption flag is False or no sync_db
+        # was defined, otherwise we defer it writing it to the received
+        # docs table.
+        doc = SoledadDocument(doc_id, rev, content)
+        if is_symmetrically_encrypted(doc):
+            if self._queue_for_decrypt:
+                self._sync_decr_pool.insert_encrypted_received_doc(
+                    doc.doc_id, doc.rev, doc.content, gen, trans_id,
+                    idx)
             else:
-                # not symmetrically encrypted doc, insert it directly
-                # or save it in the decrypted stage.
-                if self._queue_for_decrypt:
-                    self._sync_decr_pool.insert_received_doc(
-                        doc.doc_id, doc.rev, doc.content, gen, trans_id,
-                        idx)
-                else:
-                    self._insert_doc_cb(doc, gen, trans_id)
-            # -------------------------------------------------------------
-            # end of symmetric decryption
-            # -------------------------------------------------------------
+                # defer_decryption is False or no-sync-db fallback
+                doc.set_json(self._crypto.decrypt_doc(doc))
+                self._insert_received_doc_inline(doc, gen, trans_id, docs)
+        else:
+            # not symmetrically encrypted doc, insert it directly
+            # or save it in the decrypted stage.
+            if self._queue_for_decrypt:
+                self._sync_decr_pool.insert_received_doc(
+                    doc.doc_id, doc.rev, doc.content, gen, trans_id,
+                    idx)
+            else:
+                self._insert_received_doc_inline(doc, gen, trans_id, docs)
+        # -------------------------------------------------------------
+        # end of symmetric decryption
+        # -------------------------------------------------------------
         self._received_docs += 1
         msg = "%d/%d" % (self._received_docs, total)
-        content = {'received': self._received_docs, 'total': total}
+        content = {
+            'received': self._received_docs,
+            'total': total,
+            'window': self._receive_window.size,
+        }
         emit(SOLEDAD_SYNC_RECEIVE_STATUS, content)
         logger.debug("Sync receive status: %s" % msg)
-        return number_of_changes, new_generation, new_transaction_id
 
-    def _parse_received_doc_response(self, response):
+    def _insert_received_doc_inline(self, doc, gen, trans_id, docs):
+        """
+        Insert a received document that does not go through the decrypter
+        pool into the local replica.
+
+        If a batch insertion callback was given, the document is collected
+        in the documents of its download request instead, to be inserted
+        when the request succeeds. See `_queue_received_docs`.
+
+        :param doc: The document to be inserted.
+        :type doc: SoledadDocument
+        :param gen: The target generation corresponding to the document.
+        :type gen: int
+        :param trans_id: The target transaction id corresponding to the
+                         document.
+        :type trans_id: str
+        :param docs: The list in which to collect the documents of the
+                     download request to be inserted in a batch.
+        :type docs: list
+        """
+        if self._insert_docs_cb is None:
+            self._insert_doc_cb(doc, gen, trans_id)
+            return
+        docs.append((doc, gen, trans_id))
+
+    def _queue_received_docs(self, result, idx, docs):
+        """
+        Queue the documents received by a download request for insertion in
+        the local replica.
+
+        Concurrent download requests may finish in any order, but documents
+        are inserted in the order of their index, which is the order of
+        their generations, so that the generation recorded for the target
+        after each insertion is never ahead of a document that was not
+        inserted yet. Documents that become insertable while an insertion is
+        running are inserted together, in runs of at most INSERT_BATCH_SIZE
+        documents, and insertion stops at the first run that fails.
+
+        This is used as a callback of download requests, so it passes the
+        result of the request through.
+
+        :param result: The result of the download request.
+        :type result: any
+        :param idx: The index of the first document of the download request
+                    in the current sync process.
+        :type idx: int
+        :param docs: The documents received by the download request, as
+                     (doc, gen, trans_id) tuples.
+        :type docs: list
+
+        :return: The result of the download request.
+        :rtype: any
+        """
+        if self._insert_docs_cb is None or self._queue_for_decrypt:
+            return result
+        self._received_batches[idx] = docs
+        while self._next_insert_idx in self._received_batches:
+            docs = self._received_batches.pop(self._next_insert_idx)
+            self._next_insert_idx += len(docs)
+            self._insertable_docs.extend(docs)
+            self._received_insertion.addCallback(self._insert_received_docs)
+        return result
+
+    def _insert_received_docs(self, _):
+        """
+        Insert the received documents in the local replica, one run after
+        the other, until there are no insertable documents left.
+
+        :return: A deferred that will fire when the documents have been
+                 inserted.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        run = self._insertable_docs[:self.INSERT_BATCH_SIZE]
+        del self._insertable_docs[:len(run)]
+        if run:
+            d = defer.maybeDeferred(self._insert_docs_cb, run)
+            d.addCallback(self._insert_received_docs)
+            return d
+
+    def _parse_received_docs_response(self, response):
         """
-        Parse the response from the server containing the received document.
+        Parse the response from the server containing the received documents.
 
-        :param response: The body and headers of the response.
-        :type response: tuple(str, dict)
+        :param response: The body of the response.
+        :type response: str
 
-        :return: (new_gen, new_trans_id, number_of_changes, doc_id, rev,
-                 content, gen, trans_id)
+        :return: (new_gen, new_trans_id, number_of_changes, entries), where
+                 entries is a list of (doc_id, rev, content, gen, trans_id)
+                 tuples.
         :rtype: tuple
         """
-        # decode incoming stream
-        parts = response.splitlines()
-        if not parts or parts[0] != '[' or parts[-1] != ']':
-            raise errors.BrokenSyncStream
-        data = parts[1:-1]
-        # decode metadata
-        try:
-            line, comma = utils.check_and_strip_comma(data[0])
-            metadata = None
-        except (IndexError):
-            raise errors.BrokenSyncStream
-        try:
-            metadata = json.loads(line)
-            new_generation = metadata['new_generation']
-            new_transaction_id = metadata['new_transaction_id']
-            number_of_changes = metadata['number_of_changes']
-        except (ValueError, KeyError):
-            raise errors.BrokenSyncStream
-        # make sure we have replica_uid from fresh new dbs
-        if self._ensure_callback and 'replica_uid' in metadata:
-            self._ensure_callback(metadata['replica_uid'])
-        # parse incoming document info
-        doc_id = None
-        rev = None
-        content = None
-        gen = None
-        trans_id = None
-        if number_of_changes > 0:
-            try:
-                entry = json.loads(data[1])
-                doc_id = entry['id']
-                rev = entry['rev']
-                content = entry['content']
-                gen = entry['gen']
-                trans_id = entry['trans_id']
-            except (IndexError, KeyError):
-                raise errors.BrokenSyncStream
+        entries = []
+        parser = ReceivedDocsParser(
+            self._ensure_replica_uid,
+            lambda *entry: entries.append(entry))
+        parser.feed(response)
+        new_generation, new_transaction_id, number_of_changes = \
+            parser.finish()
         return new_generation, new_transaction_id, number_of_changes, \
-            doc_id, rev, content, gen, trans_id
+            entries
 
     def _setup_sync_decr_pool(self):
         """
@@ -686,10 +1357,15 @@ class SoledadHTTPSyncTarget(SyncTarget):
                 self._crypto,
                 self._sync_db,
                 insert_doc_cb=self._insert_doc_cb,
+                insert_docs_cb=self._insert_docs_cb,
                 source_replica_uid=self.source_replica_uid)
 
-    def _http_request(self, url, method='GET', body=None, headers={}):
-        d = self._http.request(url, method, body, headers, readBody)
+    def _http_request(self, url, method='GET', body=None, headers={},
+                      parser=None):
+        callback = readBody
+        if parser is not None:
+            callback = functools.partial(readBody, parser=parser)
+        d = self._http.request(url, method, body, headers, callback)
         d.addErrback(_unauth_to_invalid_token_error)
         return d
 
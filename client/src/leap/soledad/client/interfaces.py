@@ -89,6 +89,36 @@ class ILocalStorage(Interface):
         :rtype: Deferred
         """
 
+    def put_docs(self, docs):
+        """
+        Update many documents in the local encrypted database, in a single
+        transaction.
+
+        :param docs: the documents to update
+        :type docs: list of SoledadDocument
+
+        :return:
+            a deferred that will fire with a list of (success, result)
+            tuples, one for each document, where result is either the new
+            revision identifier or the error that prevented the update
+        :rtype: Deferred
+        """
+
+    def delete_docs(self, docs):
+        """
+        Delete many documents from the local encrypted database, in a single
+        transaction.
+
+        :param docs: the documents to delete
+        :type docs: list of SoledadDocument
+
+        :return:
+            a deferred that will fire with a list of (success, result)
+            tuples, one for each document, where result is either the new
+            revision identifier or the error that prevented the deletion
+        :rtype: Deferred
+        """
+
     def get_doc(self, doc_id, include_deleted=False):
         """
         Retrieve a document from the local encrypted database.
@@ -152,6 +182,24 @@ class ILocalStorage(Interface):
         :rtype: Deferred
         """
 
+    def create_docs(self, contents, doc_ids=None):
+        """
+        Create many new documents in the local encrypted database, in a
+        single transaction.
+
+        :param contents: the contents of the new documents
+        :type contents: list of dict
+        :param doc_ids: optional identifiers for the new documents
+        :type doc_ids: list of str
+
+        :return:
+            a deferred that will fire with a list of (success, result)
+            tuples, one for each document, where result is either the new
+            document (SoledadDocument instance) or the error that prevented
+            its creation
+        :rtype: Deferred
+        """
+
     def create_doc_from_json(self, json, doc_id=None):
         """
         Create a new document.
@@ -321,7 +369,7 @@ class ISyncableStorage(Interface):
         "Property, True if the syncer is syncing.")
     token = Attribute("The authentication Token.")
 
-    def sync(self, defer_decryption=True):
+    def sync(self, defer_decryption=True, max_concurrent_requests=None):
         """
         Synchronize the local encrypted replica with a remote replica.
 
@@ -336,6 +384,11 @@ class ISyncableStorage(Interface):
             database. If False, decryption will be done inline.
         :type defer_decryption: bool
 
+        :param max_concurrent_requests:
+            The maximum number of concurrent requests for receiving documents.
+            If None, a default value is used.
+        :type max_concurrent_requests: int
+
         :return:
             A deferred that will fire with the local generation before the
             synchronisation was performed.
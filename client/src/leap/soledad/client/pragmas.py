@@ -31,6 +31,132 @@ logger = logging.getLogger(__name__)
 _db_init_lock = threading.Lock()
 
 
+#
+# Performance profiles
+#
+
+class PerformanceProfile(object):
+    """
+    A set of performance settings for the connections to a SQLCipher
+    database.
+
+    The cipher page size, and the number of key derivation iterations when
+    not using a raw key, are part of the format of an encrypted database: a
+    database can only be opened with the values it was created with. All the
+    other settings can be changed every time a database is opened.
+    """
+
+    def __init__(self, cipher_page_size=1024, raw_key_kdf_iter=4000,
+                 cache_size=None, wal=True,
+                 wal_autocheckpoint=50, synchronous='NORMAL',
+                 temp_store=None):
+        """
+        :param cipher_page_size: The page size of the encrypted database.
+        :type cipher_page_size: int
+        :param raw_key_kdf_iter: The number of key derivation iterations to
+                                 use when the database is keyed with a raw
+                                 key.
+        :type raw_key_kdf_iter: int
+        :param cache_size: The size of the page cache of each connection, in
+                           KiB. If None, the SQLite default is used.
+        :type cache_size: int
+        :param wal: Whether to use write-ahead logging.
+        :type wal: bool
+        :param wal_autocheckpoint: The size of the write-ahead log, in pages,
+                                   that triggers a checkpoint. If 0,
+                                   automatic checkpoints are disabled.
+        :type wal_autocheckpoint: int
+        :param synchronous: The value of the "synchronous" flag, one of
+                            'OFF', 'NORMAL' or 'FULL'.
+        :type synchronous: str
+        :param temp_store: Where to store temporary tables, one of 'FILE' or
+                           'MEMORY'. If None, the SQLite default is used.
+        :type temp_store: str
+        """
+        self.cipher_page_size = cipher_page_size
+        self.raw_key_kdf_iter = raw_key_kdf_iter
+        self.cache_size = cache_size
+        self.wal = wal
+        self.wal_autocheckpoint = wal_autocheckpoint
+        self.synchronous = synchronous
+        self.temp_store = temp_store
+
+    def copy(self, **kwargs):
+        """
+        Return a copy of this profile with some settings replaced.
+
+        :return: The new profile.
+        :rtype: PerformanceProfile
+        """
+        settings = dict(self.__dict__)
+        settings.update(kwargs)
+        return PerformanceProfile(**settings)
+
+    def __eq__(self, other):
+        return isinstance(other, PerformanceProfile) \
+            and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        settings = ', '.join(
+            '%s=%r' % item for item in sorted(self.__dict__.items()))
+        return "PerformanceProfile(%s)" % settings
+
+
+"""
+Named performance profiles. The presets keep the default cipher page size
+and key derivation iterations, so they can be used with existing databases.
+"""
+PROFILES = {
+    # small write-ahead log for fast reads
+    'default': PerformanceProfile(),
+    # more cache, fewer checkpoints
+    'laptop': PerformanceProfile(
+        cache_size=8 * 1024, wal_autocheckpoint=1000, temp_store='MEMORY'),
+    # keep memory usage to a minimum
+    'low-memory': PerformanceProfile(cache_size=512, temp_store='FILE'),
+    # large caches and rare checkpoints for writing many documents
+    'bulk-import': PerformanceProfile(
+        cache_size=32 * 1024, wal_autocheckpoint=10000,
+        temp_store='MEMORY'),
+}
+
+
+def get_profile(profile=None):
+    """
+    Get a performance profile.
+
+    If no profile is given, the one named by the LEAP_SQLITE_PROFILE
+    environment variable is used, or the default one. The LEAP_SQLITE_NOSYNC,
+    LEAP_SQLITE_MEMSTORE and LEAP_SQLITE_NOWAL environment variables override
+    the settings of the profile.
+
+    :param profile: The name of a preset, or a profile.
+    :type profile: str or PerformanceProfile
+
+    :return: The performance profile.
+    :rtype: PerformanceProfile
+    """
+    if profile is None:
+        profile = os.environ.get('LEAP_SQLITE_PROFILE', 'default')
+    if not isinstance(profile, PerformanceProfile):
+        if profile not in PROFILES:
+            raise ValueError("Unknown SQLCipher profile: %s" % profile)
+        profile = PROFILES[profile]
+    overrides = {}
+    if os.environ.get('LEAP_SQLITE_NOSYNC'):
+        overrides['synchronous'] = 'OFF'
+    if os.environ.get('LEAP_SQLITE_MEMSTORE'):
+        overrides['temp_store'] = 'MEMORY'
+    if os.environ.get('LEAP_SQLITE_NOWAL'):
+        overrides['wal'] = False
+    if overrides:
+        profile = profile.copy(**overrides)
+    return profile
+
+
 def set_init_pragmas(conn, opts=None, extra_queries=None):
     """
     Set the initialization pragmas.
@@ -47,25 +173,42 @@ def set_init_pragmas(conn, opts=None, extra_queries=None):
 
 def _set_init_pragmas(conn, opts, extra_queries):
 
-    sync_off = os.environ.get('LEAP_SQLITE_NOSYNC')
-    memstore = os.environ.get('LEAP_SQLITE_MEMSTORE')
-    nowal = os.environ.get('LEAP_SQLITE_NOWAL')
+    profile = getattr(opts, 'profile', None)
+    if profile is None:
+        profile = get_profile()
 
     set_crypto_pragmas(conn, opts)
-
-    if not nowal:
-        set_write_ahead_logging(conn)
-    if sync_off:
-        set_synchronous_off(conn)
-    else:
-        set_synchronous_normal(conn)
-    if memstore:
-        set_mem_temp_store(conn)
+    set_performance_pragmas(conn, profile)
 
     for query in extra_queries:
         conn.cursor().execute(query)
 
 
+def set_performance_pragmas(db_handle, profile):
+    """
+    Set the pragmas of a performance profile.
+
+    :param db_handle: A handle to the SQLCipher database.
+    :type db_handle: pysqlcipher.Connection
+    :param profile: The performance profile.
+    :type profile: PerformanceProfile
+    """
+    if profile.wal:
+        set_write_ahead_logging(db_handle, profile.wal_autocheckpoint)
+    if profile.synchronous == 'OFF':
+        set_synchronous_off(db_handle)
+    elif profile.synchronous == 'NORMAL':
+        set_synchronous_normal(db_handle)
+    else:
+        set_synchronous_full(db_handle)
+    if profile.temp_store == 'MEMORY':
+        set_mem_temp_store(db_handle)
+    elif profile.temp_store == 'FILE':
+        set_file_temp_store(db_handle)
+    if profile.cache_size is not None:
+        set_cache_size(db_handle, profile.cache_size)
+
+
 def set_crypto_pragmas(db_handle, sqlcipher_opts):
     """
     Set cryptographic params (key, cipher, KDF number of iterations and
@@ -333,6 +476,14 @@ def set_synchronous_normal(db_handle):
     db_handle.cursor().execute('PRAGMA synchronous=NORMAL')
 
 
+def set_synchronous_full(db_handle):
+    """
+    Change the setting of the "synchronous" flag to FULL.
+    """
+    logger.debug("SQLCIPHER: SETTING SYNCHRONOUS FULL")
+    db_handle.cursor().execute('PRAGMA synchronous=FULL')
+
+
 def set_mem_temp_store(db_handle):
     """
     Use a in-memory store for temporary tables.
@@ -341,9 +492,32 @@ def set_mem_temp_store(db_handle):
     db_handle.cursor().execute('PRAGMA temp_store=MEMORY')
 
 
-def set_write_ahead_logging(db_handle):
+def set_file_temp_store(db_handle):
+    """
+    Use a file store for temporary tables.
+    """
+    logger.debug("SQLCIPHER: SETTING TEMP_STORE FILE")
+    db_handle.cursor().execute('PRAGMA temp_store=FILE')
+
+
+def set_cache_size(db_handle, cache_size):
+    """
+    Set the size of the page cache of the connection.
+
+    :param db_handle: A handle to the SQLCipher database.
+    :type db_handle: pysqlcipher.Connection
+    :param cache_size: The size of the cache, in KiB.
+    :type cache_size: int
     """
-    Enable write-ahead logging, and set the autocheckpoint to 50 pages.
+    logger.debug("SQLCIPHER: SETTING CACHE SIZE TO %d KiB" % cache_size)
+    # negative values are interpreted by sqlite as a size in KiB
+    db_handle.cursor().execute('PRAGMA cache_size=-%d' % cache_size)
+
+
+def set_write_ahead_logging(db_handle, autocheckpoint=50):
+    """
+    Enable write-ahead logging, and set the autocheckpoint to
+    ``autocheckpoint`` pages (50 by default).
 
     Setting the autocheckpoint to a small value, we make the reads not
     suffer too much performance degradation.
@@ -365,11 +539,12 @@ def set_write_ahead_logging(db_handle):
     logger.debug("SQLCIPHER: SETTING WRITE-AHEAD LOGGING")
     db_handle.cursor().execute('PRAGMA journal_mode=WAL')
 
-    # The optimum value can still use a little bit of tuning, but we favor
-    # small sizes of the WAL file to get fast reads, since we assume that
-    # the writes will be quick enough to not block too much.
+    # The optimum value depends on the performance profile. By default we
+    # favor small sizes of the WAL file to get fast reads, since we assume
+    # that the writes will be quick enough to not block too much.
 
-    db_handle.cursor().execute('PRAGMA wal_autocheckpoint=50')
+    db_handle.cursor().execute(
+        'PRAGMA wal_autocheckpoint=%d' % autocheckpoint)
 
 
 class NotAnHexString(Exception):
@@ -51,12 +51,17 @@ from u1db.backends import sqlite_backend
 
 from hashlib import sha256
 from functools import partial
+from contextlib import contextmanager
+from collections import deque
 
 from pysqlcipher import dbapi2 as sqlcipher_dbapi2
 
 from twisted.internet import reactor
 from twisted.internet import defer
+from twisted.internet import threads
 from twisted.enterprise import adbapi
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 
 from leap.soledad.client.http_target import SoledadHTTPSyncTarget
 from leap.soledad.client.sync import SoledadSynchronizer
@@ -111,7 +116,8 @@ class SQLCipherOptions(object):
     @classmethod
     def copy(cls, source, path=None, key=None, create=None,
              is_raw_key=None, cipher=None, kdf_iter=None,
-             cipher_page_size=None, defer_encryption=None, sync_db_key=None):
+             cipher_page_size=None, defer_encryption=None, sync_db_key=None,
+             profile=None):
         """
         Return a copy of C{source} with parameters different than None
         replaced by new values.
@@ -128,7 +134,8 @@ class SQLCipherOptions(object):
                 args.append(getattr(source, name))
 
         for name in ["create", "is_raw_key", "cipher", "kdf_iter",
-                     "cipher_page_size", "defer_encryption", "sync_db_key"]:
+                     "cipher_page_size", "defer_encryption", "sync_db_key",
+                     "profile"]:
             val = local_vars[name]
             if val is not None:
                 kwargs[name] = val
@@ -138,8 +145,8 @@ class SQLCipherOptions(object):
         return SQLCipherOptions(*args, **kwargs)
 
     def __init__(self, path, key, create=True, is_raw_key=False,
-                 cipher='aes-256-cbc', kdf_iter=4000, cipher_page_size=1024,
-                 defer_encryption=False, sync_db_key=None):
+                 cipher='aes-256-cbc', kdf_iter=None, cipher_page_size=None,
+                 defer_encryption=False, sync_db_key=None, profile=None):
         """
         :param path: The filesystem path for the database to open.
         :type path: str
@@ -153,15 +160,28 @@ class SQLCipherOptions(object):
         :type raw_key: bool
         :param cipher: The cipher and mode to use.
         :type cipher: str
-        :param kdf_iter: The number of iterations to use.
+        :param kdf_iter:
+            The number of iterations to use. Defaults to 4000, or to the
+            one of the performance profile when using a raw key.
         :type kdf_iter: int
-        :param cipher_page_size: The page size.
+        :param cipher_page_size:
+            The page size. Defaults to the one of the performance profile.
         :type cipher_page_size: int
         :param defer_encryption:
             Whether to defer encryption/decryption of documents, or do it
             inline while syncing.
         :type defer_encryption: bool
-        """
+        :param profile:
+            The performance profile of the connections to the database, or
+            the name of one of the presets in pragmas.PROFILES. See
+            pragmas.get_profile for the default.
+        :type profile: str or pragmas.PerformanceProfile
+        """
+        profile = pragmas.get_profile(profile)
+        if kdf_iter is None:
+            kdf_iter = profile.raw_key_kdf_iter if is_raw_key else 4000
+        if cipher_page_size is None:
+            cipher_page_size = profile.cipher_page_size
         self.path = path
         self.key = key
         self.is_raw_key = is_raw_key
@@ -169,6 +189,7 @@ class SQLCipherOptions(object):
         self.cipher = cipher
         self.kdf_iter = kdf_iter
         self.cipher_page_size = cipher_page_size
+        self.profile = profile
         self.defer_encryption = defer_encryption
         self.sync_db_key = sync_db_key
 
@@ -281,6 +302,164 @@ class SQLCipherDatabase(sqlite_backend.SQLitePartialExpandDatabase):
             self._sync_enc_pool.enqueue_doc_for_encryption(doc)
         return doc_rev
 
+    #
+    # Bulk write methods
+    #
+
+    @contextmanager
+    def _single_transaction(self):
+        """
+        Run the block in a single database transaction.
+
+        The u1db write methods commit on their own by using the connection
+        as a context manager. Inside this block, the connection is replaced
+        by a proxy whose context manager does nothing, so everything is
+        committed (or rolled back) only once, when the block finishes.
+        """
+        handle = self._db_handle
+        with handle:
+            self._db_handle = _TransactionProxy(handle)
+            try:
+                yield
+            finally:
+                self._db_handle = handle
+
+    def _bulk_write(self, write, docs):
+        """
+        Apply a u1db write method to many documents in a single transaction.
+
+        Errors from u1db (conflicts, invalid ids, too big documents, etc) are
+        reported for each document, without affecting the others. Any other
+        error rolls back the whole transaction and restores the revisions and
+        contents of the documents, so the write can be retried.
+
+        :param write: The u1db method to apply to each document.
+        :type write: callable
+        :param docs: The documents to be written.
+        :type docs: list of u1db.Document
+
+        :return: A list of (success, result) tuples, one for each document,
+            where result is either the new revision or the u1db error.
+        :rtype: list
+        """
+        results = []
+        saved = [(doc.rev, doc.content) for doc in docs]
+        try:
+            with self._single_transaction():
+                for doc in docs:
+                    try:
+                        results.append((True, write(self, doc)))
+                    except u1db_errors.U1DBError as e:
+                        results.append((False, e))
+        except Exception:
+            for doc, (rev, content) in zip(docs, saved):
+                doc.rev = rev
+                doc.content = content
+            raise
+        return results
+
+    def put_docs(self, docs):
+        """
+        Update many documents in a single transaction, and enqueue the
+        updated ones for encryption before sync.
+
+        :param docs: The documents to be put.
+        :type docs: list of u1db.Document
+
+        :return: A list of (success, result) tuples, one for each document,
+            where result is either the new revision or the u1db error that
+            prevented the document from being put.
+        :rtype: list
+        """
+        results = self._bulk_write(
+            sqlite_backend.SQLitePartialExpandDatabase.put_doc, docs)
+        if self.defer_encryption:
+            self._sync_enc_pool.enqueue_docs_for_encryption(
+                [doc for doc, (ok, _) in zip(docs, results) if ok])
+        return results
+
+    def create_docs(self, contents, doc_ids=None):
+        """
+        Create many documents in a single transaction.
+
+        :param contents: The contents of the new documents.
+        :type contents: list of dict
+        :param doc_ids: Optional identifiers for the new documents, with
+            None for the ones that should get a new identifier.
+        :type doc_ids: list
+
+        :return: A list of (success, result) tuples, one for each document,
+            where result is either the new document or the u1db error that
+            prevented it from being created.
+        :rtype: list
+        """
+        if doc_ids is None:
+            doc_ids = [None] * len(contents)
+        docs = []
+        for content, doc_id in zip(contents, doc_ids):
+            if doc_id is None:
+                doc_id = self._allocate_doc_id()
+            docs.append(self._factory(doc_id, None, json.dumps(content)))
+        results = self.put_docs(docs)
+        return [(ok, doc if ok else result)
+                for doc, (ok, result) in zip(docs, results)]
+
+    def delete_docs(self, docs):
+        """
+        Mark many documents as deleted in a single transaction.
+
+        :param docs: The documents to be deleted.
+        :type docs: list of u1db.Document
+
+        :return: A list of (success, result) tuples, one for each document,
+            where result is either the new revision or the u1db error that
+            prevented the document from being deleted.
+        :rtype: list
+        """
+        return self._bulk_write(
+            sqlite_backend.SQLitePartialExpandDatabase.delete_doc, docs)
+
+    def _put_docs_if_newer(self, entries, save_conflict, replica_uid):
+        """
+        Insert a run of documents received from another replica in a single
+        transaction.
+
+        This is the bulk version of `_put_doc_if_newer`. The generation and
+        transaction id of the other replica are validated against the first
+        document, and recorded only for the last one. As all documents and
+        the new generation are committed together, a crash leaves the
+        database either before or after the whole run.
+
+        :param entries: A list of (doc, replica_gen, replica_trans_id)
+                        tuples, in the order in which the documents should be
+                        inserted.
+        :type entries: list
+        :param save_conflict: Whether conflicting documents should be saved
+                              as conflicts.
+        :type save_conflict: bool
+        :param replica_uid: The uid of the other replica.
+        :type replica_uid: str
+
+        :return: The list of states of the insertion of each document, as
+                 returned by `_put_doc_if_newer`.
+        :rtype: list of str
+        """
+        if not entries:
+            return []
+        states = []
+        with self._single_transaction():
+            _, gen, trans_id = entries[0]
+            self._validate_source(replica_uid, gen, trans_id)
+            for i, (doc, gen, trans_id) in enumerate(entries):
+                # passing no replica uid skips recording the generation,
+                # which is done only for the last document of the run.
+                uid = replica_uid if i == len(entries) - 1 else None
+                state, _ = self._put_doc_if_newer(
+                    doc, save_conflict=save_conflict, replica_uid=uid,
+                    replica_gen=gen, replica_trans_id=trans_id)
+                states.append(state)
+        return states
+
     #
     # SQLCipher API methods
     #
@@ -451,6 +630,14 @@ class SQLCipherU1DBSync(SQLCipherDatabase):
         self._db_handle = None
         self._initialize_main_db()
 
+        # writes of the sync process to the local replica are run by a writer
+        # thread with a connection of its own, so they do not block the
+        # reactor. An in-memory database can not be opened twice, so in that
+        # case writes are run directly on our connection.
+        self.writer = None
+        if opts.path != ':memory:':
+            self.writer = SQLCipherWriter(opts)
+
         self.shutdownID = None
 
     @property
@@ -461,6 +648,8 @@ class SQLCipherU1DBSync(SQLCipherDatabase):
         if not self.running:
             self.shutdownID = self._reactor.addSystemEventTrigger(
                 'during', 'shutdown', self.finalClose)
+            if self.writer is not None:
+                self.writer.start()
             self.running = True
 
     def _initialize_main_db(self):
@@ -471,7 +660,8 @@ class SQLCipherU1DBSync(SQLCipherDatabase):
         self.set_document_factory(soledad_doc_factory)
 
     @defer.inlineCallbacks
-    def sync(self, url, creds=None, defer_decryption=True):
+    def sync(self, url, creds=None, defer_decryption=True,
+             max_concurrent_requests=None):
         """
         Synchronize documents with remote replica exposed at url.
 
@@ -490,6 +680,9 @@ class SQLCipherU1DBSync(SQLCipherDatabase):
             Whether to defer the decryption process using the intermediate
             database. If False, decryption will be done inline.
         :type defer_decryption: bool
+        :param max_concurrent_requests:
+            The maximum number of concurrent requests for receiving documents.
+        :type max_concurrent_requests: int
 
         :return:
             A Deferred, that will fire with the local generation (type `int`)
@@ -498,7 +691,8 @@ class SQLCipherU1DBSync(SQLCipherDatabase):
         """
         syncer = self._get_syncer(url, creds=creds)
         local_gen_before_sync = yield syncer.sync(
-            defer_decryption=defer_decryption)
+            defer_decryption=defer_decryption,
+            max_concurrent_requests=max_concurrent_requests)
         self.received_docs = syncer.received_docs
         defer.returnValue(local_gen_before_sync)
 
@@ -554,6 +748,8 @@ class SQLCipherU1DBSync(SQLCipherDatabase):
         """
         self.shutdownID = None
         self.running = False
+        if self.writer is not None:
+            self.writer.stop()
 
     def close(self):
         """
@@ -564,6 +760,127 @@ class SQLCipherU1DBSync(SQLCipherDatabase):
             _, syncer = self._syncers[url]
             syncer.close()
             del self._syncers[url]
+        if self.writer is not None:
+            self.writer.stop()
+
+
+class SQLCipherWriter(object):
+    """
+    A single thread that runs the writes of the sync process on the local
+    replica, using a database connection of its own.
+
+    Writes are queued and run one at a time, in order, and their results are
+    delivered in the reactor thread. Each write runs in its own transaction:
+    the insertion of a run of received documents validates and records the
+    generation of the other replica for that run only, so runs from
+    different callers are never merged.
+    """
+
+    def __init__(self, opts):
+        """
+        Initialize the writer.
+
+        :param opts: The options of the database to write to.
+        :type opts: SQLCipherOptions
+        """
+        self._opts = opts
+        self._db = None
+        self._queue = deque()
+        self._writing = False
+        self._threadpool = ThreadPool(1, 1, name='SQLCipherWriter')
+        self.running = False
+
+    def start(self):
+        """
+        Start the writer thread.
+        """
+        if not self.running:
+            self._threadpool.start()
+            self.running = True
+
+    def stop(self):
+        """
+        Stop the writer thread after the write currently running, if any,
+        has finished. The deferreds of queued writes fail with
+        CancelledError.
+        """
+        if self.running:
+            self.running = False
+            while self._queue:
+                _, _, _, d = self._queue.popleft()
+                d.errback(defer.CancelledError())
+            self._threadpool.callInThread(self._close_db)
+            self._threadpool.stop()
+
+    def run(self, meth, *args, **kw):
+        """
+        Run a write method of the database in the writer thread.
+
+        :param meth: The name of the SQLCipherDatabase method.
+        :type meth: str
+
+        :return: A deferred that will fire with the return value of the
+                 method, or fail with the exception it raised.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        d = defer.Deferred()
+        self._queue.append((meth, args, kw, d))
+        self._write_next()
+        return d
+
+    def _write_next(self):
+        """
+        Send the next write to the writer thread.
+        """
+        if self._writing or not self._queue:
+            return
+        self._writing = True
+        meth, args, kw, deferred = self._queue.popleft()
+        d = threads.deferToThreadPool(
+            reactor, self._threadpool, self._write, meth, args, kw)
+        d.addBoth(self._written, deferred)
+
+    def _write(self, meth, args, kw):
+        if self._db is None:
+            self._db = SQLCipherDatabase(self._opts)
+        return getattr(self._db, meth)(*args, **kw)
+
+    def _written(self, result, deferred):
+        """
+        Deliver the result of a write to its deferred, and send the next
+        write to the writer thread.
+        """
+        self._writing = False
+        self._write_next()
+        if isinstance(result, Failure):
+            deferred.errback(result)
+        else:
+            deferred.callback(result)
+
+    def _close_db(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class _TransactionProxy(object):
+    """
+    A database connection proxy whose context manager does nothing.
+
+    See SQLCipherDatabase._single_transaction.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
 
 
 class U1DBSQLiteBackend(sqlite_backend.SQLitePartialExpandDatabase):
@@ -42,7 +42,7 @@ class SoledadSynchronizer(Synchronizer):
     received_docs = []
 
     @defer.inlineCallbacks
-    def sync(self, defer_decryption=True):
+    def sync(self, defer_decryption=True, max_concurrent_requests=None):
         """
         Synchronize documents between source and target.
 
@@ -58,6 +58,9 @@ class SoledadSynchronizer(Synchronizer):
                                  the intermediate database. If False,
                                  decryption will be done inline.
         :type defer_decryption: bool
+        :param max_concurrent_requests: The maximum number of concurrent
+                                        requests for receiving documents.
+        :type max_concurrent_requests: int
 
         :return: A deferred which will fire after the sync has finished with
                  the local generation before the synchronization was performed.
@@ -141,7 +144,9 @@ class SoledadSynchronizer(Synchronizer):
             docs_by_generation, self.source._replica_uid,
             target_last_known_gen, target_last_known_trans_id,
             self._insert_doc_from_target, ensure_callback=ensure_callback,
-            defer_decryption=defer_decryption)
+            defer_decryption=defer_decryption,
+            max_concurrent_requests=max_concurrent_requests,
+            insert_docs_cb=self._insert_docs_from_target)
         logger.debug(
             "Soledad source sync info after sync exchange:\n"
             "  source known target gen: %d\n"
@@ -151,7 +156,8 @@ class SoledadSynchronizer(Synchronizer):
             "target_replica_uid": self.target_replica_uid,
             "new_gen": new_gen,
             "new_trans_id": new_trans_id,
-            "my_gen": my_gen
+            "my_gen": my_gen,
+            "receive_window": sync_target.receive_window,
         }
         self._syncing_info = info
         yield self.complete_sync()
@@ -179,11 +185,60 @@ class SoledadSynchronizer(Synchronizer):
         # record target synced-up-to generation including applying what we
         # sent
         info = self._syncing_info
-        self.source._set_replica_gen_and_trans_id(
+        d = self._write(
+            "_set_replica_gen_and_trans_id",
             info["target_replica_uid"], info["new_gen"], info["new_trans_id"])
 
         # if gapless record current reached generation with target
-        return self._record_sync_info_with_the_target(info["my_gen"])
+        d.addCallback(
+            lambda _: self._record_sync_info_with_the_target(info["my_gen"]))
+        return d
+
+    def _insert_docs_from_target(self, entries):
+        """
+        Insert a run of documents received from the target in a single
+        transaction.
+
+        This has the same TAKE OTHER semantics as `_insert_doc_from_target`,
+        but the documents and the new target generation are committed only
+        once for the whole run.
+
+        :param entries: A list of (doc, gen, trans_id) tuples, in the order
+                        in which the documents were received.
+        :type entries: list
+
+        :return: A deferred that will fire when the documents have been
+                 inserted.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        def _count_inserted(states):
+            # documents that were inserted or saved as conflicts changed the
+            # db
+            self.num_inserted += len(
+                [s for s in states if s in ('inserted', 'conflicted')])
+
+        d = self._write(
+            "_put_docs_if_newer", entries, save_conflict=True,
+            replica_uid=self.target_replica_uid)
+        d.addCallback(_count_inserted)
+        return d
+
+    def _write(self, meth, *args, **kw):
+        """
+        Run a write method on the local replica, in its writer thread if it
+        has one.
+
+        :param meth: The name of the database method.
+        :type meth: str
+
+        :return: A deferred that will fire with the return value of the
+                 method.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        writer = getattr(self.source, 'writer', None)
+        if writer is not None:
+            return writer.run(meth, *args, **kw)
+        return defer.maybeDeferred(getattr(self.source, meth), *args, **kw)
 
     def close(self):
         """
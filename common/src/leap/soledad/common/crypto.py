@@ -51,6 +51,7 @@ class EncryptionMethods(object):
     """
 
     AES_256_CTR = 'aes-256-ctr'
+    AES_256_GCM = 'aes-256-gcm'
 
 
 class UnknownEncryptionMethodError(Exception):
@@ -61,6 +62,43 @@ class UnknownEncryptionMethodError(Exception):
     pass
 
 
+class EncodingMethods(object):
+
+    """
+    Representation of encodings used to store binary data (ciphertext and
+    MAC) in the JSON serialization of encrypted documents.
+    """
+
+    HEX = 'hex'
+    BASE64 = 'base64'
+
+
+class UnknownEncodingMethodError(Exception):
+
+    """
+    Raised when trying to decode data stored with unknown encoding.
+    """
+    pass
+
+
+class CompressionMethods(object):
+
+    """
+    Representation of compression methods applied to document's contents
+    before encryption.
+    """
+
+    ZLIB = 'zlib'
+
+
+class UnknownCompressionMethodError(Exception):
+
+    """
+    Raised when trying to compress/decompress with unknown method.
+    """
+    pass
+
+
 class MacMethods(object):
 
     """
@@ -68,6 +106,7 @@ class MacMethods(object):
     """
 
     HMAC = 'hmac'
+    AEAD = 'aead'  # the authentication tag of an AEAD encryption method
 
 
 class UnknownMacMethodError(Exception):
@@ -94,5 +133,7 @@ ENC_JSON_KEY = '_enc_json'
 ENC_SCHEME_KEY = '_enc_scheme'
 ENC_METHOD_KEY = '_enc_method'
 ENC_IV_KEY = '_enc_iv'
+ENC_ENCODING_KEY = '_enc_encoding'
+ENC_COMPRESSION_KEY = '_enc_compression'
 MAC_KEY = '_mac'
 MAC_METHOD_KEY = '_mac_method'
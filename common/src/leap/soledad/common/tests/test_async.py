@@ -20,9 +20,13 @@ import os
 import hashlib
 
 from twisted.internet import defer
+from twisted.internet import reactor
+
+from pysqlcipher.dbapi2 import OperationalError
 
 from leap.soledad.common.tests.util import BaseSoledadTest
 from leap.soledad.client import adbapi
+from leap.soledad.client.sqlcipher import SQLCipherDatabase
 from leap.soledad.client.sqlcipher import SQLCipherOptions
 
 
@@ -34,10 +38,10 @@ class ASyncSQLCipherRetryTestCase(BaseSoledadTest):
 
     NUM_DOCS = 5000
 
-    def _get_dbpool(self):
+    def _get_dbpool(self, readers=None):
         tmpdb = os.path.join(self.tempdir, "test.soledad")
         opts = SQLCipherOptions(tmpdb, "secret", create=True)
-        return adbapi.getConnectionPool(opts)
+        return adbapi.getConnectionPool(opts, readers=readers)
 
     def _get_sample(self):
         if not getattr(self, "_sample", None):
@@ -74,7 +78,9 @@ class ASyncSQLCipherRetryTestCase(BaseSoledadTest):
         adbapi.SQLCIPHER_CONNECTION_TIMEOUT = 1
         adbapi.SQLCIPHER_MAX_RETRIES = 1
 
-        dbpool = self._get_dbpool()
+        # the reader/writer pool queues writes, so use a pool of read-write
+        # connections to make them compete for the lock.
+        dbpool = self._get_dbpool(readers=0)
 
         def _create_doc(doc):
             return dbpool.runU1DBQuery("create_doc", doc)
@@ -142,3 +148,90 @@ class ASyncSQLCipherRetryTestCase(BaseSoledadTest):
         d.addCallback(lambda _: dbpool.runU1DBQuery("get_all_docs"))
         d.addCallback(_count_docs)
         return d
+
+    def test_concurrent_puts_and_reads_with_reader_writer_pool(self):
+        """
+        Test that concurrent puts and reads succeed with a reader/writer pool
+        even with a small timeout and no retries, because writes of the pool
+        are queued instead of competing with each other for the database
+        lock.
+        """
+        old_timeout = adbapi.SQLCIPHER_CONNECTION_TIMEOUT
+        old_max_retries = adbapi.SQLCIPHER_MAX_RETRIES
+        adbapi.SQLCIPHER_CONNECTION_TIMEOUT = 1
+        adbapi.SQLCIPHER_MAX_RETRIES = 1
+
+        def _restore(result):
+            adbapi.SQLCIPHER_CONNECTION_TIMEOUT = old_timeout
+            adbapi.SQLCIPHER_MAX_RETRIES = old_max_retries
+            return result
+
+        dbpool = self._get_dbpool(readers=4)
+        self.assertIsInstance(dbpool, adbapi.U1DBReadWriteConnectionPool)
+
+        deferreds = []
+        for i in range(self.NUM_DOCS):
+            payload = self._get_sample()[i]
+            chash = hashlib.sha256(payload).hexdigest()
+            doc = {"number": i, "payload": payload, 'chash': chash}
+            deferreds.append(dbpool.runU1DBQuery("create_doc", doc))
+            if i % 100 == 0:
+                deferreds.append(dbpool.runU1DBQuery("get_all_docs"))
+
+        def _count_docs(results):
+            _, docs = results
+            self.assertEqual(self.NUM_DOCS, len(docs))
+
+        d = defer.gatherResults(deferreds, consumeErrors=True)
+        d.addCallback(lambda _: dbpool.runU1DBQuery("get_all_docs"))
+        d.addCallback(_count_docs)
+        d.addBoth(_restore)
+        d.addBoth(lambda result: dbpool.close() or result)
+        return d
+
+    def test_raw_queries_with_reader_writer_pool(self):
+        """
+        Test that raw queries of a reader/writer pool may write to the
+        database, and that read queries run on a read-only connection.
+        """
+        dbpool = self._get_dbpool(readers=4)
+
+        def _check(rows):
+            self.assertEqual([(1,)], [tuple(row) for row in rows])
+
+        d = dbpool.runQuery("CREATE TABLE raw_test (value)")
+        d.addCallback(
+            lambda _: dbpool.runQuery("INSERT INTO raw_test VALUES (1)"))
+        d.addCallback(
+            lambda _: dbpool.runReadQuery("SELECT value FROM raw_test"))
+        d.addCallback(_check)
+        d.addCallback(
+            lambda _: self.assertFailure(
+                dbpool.runReadQuery("INSERT INTO raw_test VALUES (2)"),
+                OperationalError))
+        d.addBoth(lambda result: dbpool.close() or result)
+        return d
+
+    def test_writes_retried_with_reader_writer_pool(self):
+        """
+        Test that writes of a reader/writer pool are retried while another
+        connection to the database, like the ones used by the sync, holds
+        the database lock for longer than the timeout.
+        """
+        old_timeout = adbapi.SQLCIPHER_CONNECTION_TIMEOUT
+        adbapi.SQLCIPHER_CONNECTION_TIMEOUT = 1
+        dbpool = self._get_dbpool(readers=4)
+        adbapi.SQLCIPHER_CONNECTION_TIMEOUT = old_timeout
+
+        # hold the lock from another connection for a while
+        db = SQLCipherDatabase(dbpool.opts)
+        db._db_handle.cursor().execute('BEGIN IMMEDIATE')
+        reactor.callLater(1.5, db._db_handle.commit)
+
+        def _check(doc):
+            self.assertEqual({"number": 1}, doc.content)
+
+        d = dbpool.runU1DBQuery("create_doc", {"number": 1})
+        d.addCallback(_check)
+        d.addBoth(lambda result: db.close() or dbpool.close() or result)
+        return d
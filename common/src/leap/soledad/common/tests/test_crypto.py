@@ -18,6 +18,8 @@
 Tests for cryptographic related stuff.
 """
 import os
+import json
+import base64
 import hashlib
 import binascii
 
@@ -27,8 +29,14 @@ from leap.soledad.common.tests.util import BaseSoledadTest
 from leap.soledad.common.crypto import WrongMacError
 from leap.soledad.common.crypto import UnknownMacMethodError
 from leap.soledad.common.crypto import EncryptionMethods
+from leap.soledad.common.crypto import MacMethods
+from leap.soledad.common.crypto import EncodingMethods
+from leap.soledad.common.crypto import CompressionMethods
 from leap.soledad.common.crypto import ENC_JSON_KEY
+from leap.soledad.common.crypto import ENC_ENCODING_KEY
+from leap.soledad.common.crypto import ENC_COMPRESSION_KEY
 from leap.soledad.common.crypto import ENC_SCHEME_KEY
+from leap.soledad.common.crypto import ENC_METHOD_KEY
 from leap.soledad.common.crypto import MAC_KEY
 from leap.soledad.common.crypto import MAC_METHOD_KEY
 
@@ -60,6 +68,164 @@ class EncryptedSyncTestCase(BaseSoledadTest):
         self.assertEqual(
             simpledoc, doc1.content, 'incorrect document encryption')
 
+    def test_encrypt_uses_legacy_method_by_default(self):
+        """
+        Test that documents are encrypted in a format that clients which do
+        not support AES-256-GCM can decrypt, unless it is enabled.
+        """
+        doc = SoledadDocument(doc_id='id', rev='rev')
+        doc.content = {'key': 'val' * 100}
+        enc = json.loads(self._soledad._crypto.encrypt_doc(doc))
+        self.assertEqual(EncryptionMethods.AES_256_CTR, enc[ENC_METHOD_KEY])
+        self.assertEqual(MacMethods.HMAC, enc[MAC_METHOD_KEY])
+        self.assertEqual(EncodingMethods.HEX, enc[ENC_ENCODING_KEY])
+        ciphertext = binascii.a2b_hex(enc[ENC_JSON_KEY])
+        self.assertEqual(len(doc.get_json()), len(ciphertext))
+
+    def test_encrypt_uses_base64_with_aead(self):
+        sol_crypto = crypto.SoledadCrypto(
+            self._soledad._crypto.secret,
+            enc_method=EncryptionMethods.AES_256_GCM)
+        doc = SoledadDocument(doc_id='id', rev='rev')
+        doc.content = {'key': 'val' * 100}
+        enc = json.loads(sol_crypto.encrypt_doc(doc))
+        self.assertEqual(EncodingMethods.BASE64, enc[ENC_ENCODING_KEY])
+        ciphertext = base64.b64decode(enc[ENC_JSON_KEY])
+        self.assertEqual(len(doc.get_json()), len(ciphertext))
+        doc.content = enc
+        doc.set_json(self._soledad._crypto.decrypt_doc(doc))
+        self.assertEqual({'key': 'val' * 100}, doc.content)
+
+    def test_encrypt_with_base64_encoding_opt_in(self):
+        """
+        Test that base64 encoding can be chosen for every encryption method,
+        and that documents encrypted with it are decrypted.
+        """
+        docstr = json.dumps({'key': 'val' * 100})
+        for enc_method in [EncryptionMethods.AES_256_CTR,
+                           EncryptionMethods.AES_256_GCM]:
+            sol_crypto = crypto.SoledadCrypto(
+                self._soledad._crypto.secret, enc_method=enc_method,
+                encoding=EncodingMethods.BASE64)
+            enc = json.loads(
+                sol_crypto.encrypt_docs([('id', 'rev', docstr)])[0])
+            self.assertEqual(enc_method, enc[ENC_METHOD_KEY])
+            self.assertEqual(EncodingMethods.BASE64, enc[ENC_ENCODING_KEY])
+            ciphertext = base64.b64decode(enc[ENC_JSON_KEY])
+            self.assertEqual(len(docstr), len(ciphertext))
+            self.assertEqual(
+                [docstr],
+                self._soledad._crypto.decrypt_docs([('id', 'rev', enc)]))
+
+    def test_decrypt_legacy_hex_encoding(self):
+        """
+        Test decrypting documents stored before the encoding was recorded.
+        """
+        simpledoc = {'key': 'val'}
+        doc = SoledadDocument(doc_id='id', rev='rev')
+        doc.content = simpledoc
+        enc = json.loads(self._soledad._crypto.encrypt_doc(doc))
+        # convert to the legacy format
+        del enc[ENC_ENCODING_KEY]
+        doc.content = enc
+        doc.set_json(self._soledad._crypto.decrypt_doc(doc))
+        self.assertEqual(simpledoc, doc.content)
+
+    def _encrypt_docstr(self, docstr, compression):
+        key = self._soledad._crypto.doc_passphrase('id')
+        secret = self._soledad._crypto.secret
+        return json.loads(crypto.encrypt_docstr(
+            docstr, 'id', 'rev', key, secret, compression=compression,
+            enc_method=EncryptionMethods.AES_256_GCM))
+
+    def _decrypt_doc_dict(self, enc):
+        key = self._soledad._crypto.doc_passphrase('id')
+        secret = self._soledad._crypto.secret
+        return crypto.decrypt_doc_dict(enc, 'id', 'rev', key, secret)
+
+    def test_compress_then_encrypt(self):
+        docstr = json.dumps({'body': 'lorem ipsum ' * 1000})
+        enc = self._encrypt_docstr(docstr, CompressionMethods.ZLIB)
+        self.assertEqual(CompressionMethods.ZLIB, enc[ENC_COMPRESSION_KEY])
+        ciphertext = base64.b64decode(enc[ENC_JSON_KEY])
+        self.assertTrue(len(ciphertext) < len(docstr))
+        self.assertEqual(docstr, self._decrypt_doc_dict(enc))
+
+    def test_compression_skipped_for_small_docs(self):
+        docstr = json.dumps({'key': 'val'})
+        self.assertTrue(len(docstr) < crypto.COMPRESSION_THRESHOLD)
+        enc = self._encrypt_docstr(docstr, CompressionMethods.ZLIB)
+        self.assertFalse(ENC_COMPRESSION_KEY in enc)
+        self.assertEqual(docstr, self._decrypt_doc_dict(enc))
+
+    def test_compression_flag_is_authenticated(self):
+        docstr = json.dumps({'body': 'lorem ipsum ' * 1000})
+        enc = self._encrypt_docstr(docstr, CompressionMethods.ZLIB)
+        del enc[ENC_COMPRESSION_KEY]
+        self.assertRaises(WrongMacError, self._decrypt_doc_dict, enc)
+
+    def test_encrypt_with_aead(self):
+        docstr = json.dumps({'key': 'val'})
+        enc = self._encrypt_docstr(docstr, None)
+        self.assertEqual(
+            EncryptionMethods.AES_256_GCM, enc[ENC_METHOD_KEY])
+        self.assertEqual(MacMethods.AEAD, enc[MAC_METHOD_KEY])
+        self.assertEqual(docstr, self._decrypt_doc_dict(enc))
+
+    def test_aead_authenticates_doc_id_and_rev(self):
+        docstr = json.dumps({'key': 'val'})
+        enc = self._encrypt_docstr(docstr, None)
+        key = self._soledad._crypto.doc_passphrase('id')
+        secret = self._soledad._crypto.secret
+        self.assertRaises(
+            WrongMacError, crypto.decrypt_doc_dict,
+            enc, 'id', 'other-rev', key, secret)
+
+    def test_decrypt_legacy_ctr_method(self):
+        docstr = json.dumps({'key': 'val'})
+        key = self._soledad._crypto.doc_passphrase('id')
+        secret = self._soledad._crypto.secret
+        enc = json.loads(crypto.encrypt_docstr(
+            docstr, 'id', 'rev', key, secret))
+        self.assertEqual(MacMethods.HMAC, enc[MAC_METHOD_KEY])
+        self.assertEqual(docstr, self._decrypt_doc_dict(enc))
+
+    def test_encrypt_docs_interoperates_with_single_doc_api(self):
+        """
+        Test that documents encrypted in batch can be decrypted one by one,
+        and the other way around.
+        """
+        secret = self._soledad._crypto.secret
+        docs = [
+            ('id', 'rev', json.dumps({'key': 'val'})),
+            ('id', 'rev', json.dumps({'body': 'lorem ipsum ' * 1000}))]
+        for enc_method in [EncryptionMethods.AES_256_CTR,
+                           EncryptionMethods.AES_256_GCM]:
+            encrypted = crypto.encrypt_docs(
+                docs, secret, compression=CompressionMethods.ZLIB,
+                enc_method=enc_method)
+            enc = [json.loads(envelope) for envelope in encrypted]
+            self.assertEqual(enc_method, enc[0][ENC_METHOD_KEY])
+            self.assertFalse(ENC_COMPRESSION_KEY in enc[0])
+            self.assertEqual(
+                CompressionMethods.ZLIB, enc[1][ENC_COMPRESSION_KEY])
+            self.assertEqual(
+                [docstr for _, _, docstr in docs],
+                [self._decrypt_doc_dict(doc_dict) for doc_dict in enc])
+        enc = [self._encrypt_docstr(docstr, CompressionMethods.ZLIB)
+               for _, _, docstr in docs]
+        decrypted = crypto.decrypt_docs(
+            [('id', 'rev', doc_dict) for doc_dict in enc], secret)
+        self.assertEqual([docstr for _, _, docstr in docs], decrypted)
+
+    def test_decrypt_docs_authenticates_each_doc(self):
+        sol_crypto = self._soledad._crypto
+        encrypted = sol_crypto.encrypt_docs(
+            [('id', 'rev', json.dumps({'key': 'val'}))])
+        self.assertRaises(
+            WrongMacError, sol_crypto.decrypt_docs,
+            [('id', 'other-rev', json.loads(encrypted[0]))])
+
 
 class RecoveryDocumentTestCase(BaseSoledadTest):
 
@@ -223,3 +389,29 @@ class SoledadCryptoAESTestCase(BaseSoledadTest):
             wrongkey = os.urandom(32)
         plaintext = crypto.decrypt_sym(cyphertext, wrongkey, iv)
         self.assertNotEqual('data', plaintext)
+
+
+class SoledadCryptoKeyCacheTestCase(BaseSoledadTest):
+
+    def test_doc_keys_match_derivation(self):
+        secret = os.urandom(128)
+        sol_crypto = crypto.SoledadCrypto(secret)
+        key, mac_key = sol_crypto.doc_keys('id')
+        self.assertEqual(crypto.doc_passphrase('id', secret), key)
+        self.assertEqual(crypto.doc_mac_key('id', secret), mac_key)
+        self.assertEqual(key, sol_crypto.doc_passphrase('id'))
+        self.assertEqual(mac_key, sol_crypto.doc_mac_key('id'))
+
+    def test_doc_keys_cache_is_bounded(self):
+        sol_crypto = crypto.SoledadCrypto(os.urandom(128))
+        sol_crypto.KEY_CACHE_SIZE = 2
+        for doc_id in ['id-1', 'id-2', 'id-1', 'id-3']:
+            sol_crypto.doc_keys(doc_id)
+        self.assertEqual(['id-1', 'id-3'], sol_crypto._keys.keys())
+
+    def test_close_forgets_keys(self):
+        sol_crypto = crypto.SoledadCrypto(os.urandom(128))
+        sol_crypto.doc_keys('id')
+        sol_crypto.close()
+        self.assertIsNone(sol_crypto.secret)
+        self.assertEqual(0, len(sol_crypto._keys))
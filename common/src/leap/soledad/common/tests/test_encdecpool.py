@@ -18,12 +18,26 @@
 Tests for encryption and decryption pool.
 """
 import json
+import threading
 
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError
+from twisted.internet.defer import gatherResults
 from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import succeed
+from twisted.internet.task import deferLater
 
+from leap.soledad.client import encdecpool
+from leap.soledad.client.crypto import SoledadCrypto
+from leap.soledad.client.encdecpool import CryptoDispatcher
 from leap.soledad.client.encdecpool import SyncEncrypterPool
 from leap.soledad.client.encdecpool import SyncDecrypterPool
+from leap.soledad.client.encdecpool import WorkerPool
+from leap.soledad.client.encdecpool import get_worker_pool
 
+from leap.soledad.common.crypto import MAC_KEY
+from leap.soledad.common.crypto import EncryptionMethods
+from leap.soledad.common.crypto import WrongMacError
 from leap.soledad.common.document import SoledadDocument
 from leap.soledad.common.tests.util import BaseSoledadTest
 
@@ -32,6 +46,143 @@ DOC_ID = "mydoc"
 DOC_REV = "rev"
 DOC_CONTENT = {'simple': 'document'}
 
+GCM = EncryptionMethods.AES_256_GCM
+CTR = EncryptionMethods.AES_256_CTR
+
+
+class TestWorkerPool(BaseSoledadTest):
+
+    def test_cancel_and_stop_fail_dropped_tasks(self):
+        """
+        Test that the deferreds of tasks dropped by cancel() and stop() fail
+        instead of never firing.
+        """
+        pool = WorkerPool(size=1)
+        running = pool.apply(self, json.dumps, ({},))
+        queued = pool.apply(self, json.dumps, ({},))
+        pool.cancel(self)
+        pool.stop()
+        return gatherResults([
+            self.assertFailure(running, CancelledError),
+            self.assertFailure(queued, CancelledError)])
+
+    def test_configure_worker_pool(self):
+        """
+        Test that configuring the shared pool of workers replaces it only
+        when the configuration changes.
+        """
+        self.addCleanup(encdecpool.configure_worker_pool)
+        encdecpool.configure_worker_pool(size=1, idle_timeout=5)
+        pool = get_worker_pool()
+        self.assertEqual((1, 5), (pool.size, pool.idle_timeout))
+        encdecpool.configure_worker_pool(size=1, idle_timeout=5)
+        self.assertIs(pool, get_worker_pool())
+        encdecpool.configure_worker_pool(size=2)
+        self.assertEqual(2, get_worker_pool().size)
+
+
+class TestCryptoDispatcher(BaseSoledadTest):
+
+    def test_choose_by_size(self):
+        """
+        Test that the dispatcher chooses where to run tasks by the size of
+        the document.
+        """
+        dispatcher = CryptoDispatcher(
+            inline_max_bytes=10, thread_max_bytes=100)
+        self.assertEqual(CryptoDispatcher.INLINE, dispatcher.choose(10, GCM))
+        self.assertEqual(CryptoDispatcher.THREAD, dispatcher.choose(11, GCM))
+        self.assertEqual(CryptoDispatcher.THREAD, dispatcher.choose(100, GCM))
+        self.assertEqual(
+            CryptoDispatcher.PROCESS, dispatcher.choose(101, GCM))
+
+    def test_choose_no_threads_for_methods_holding_the_gil(self):
+        """
+        Test that documents encrypted with AES-CTR and HMAC are never sent to
+        the thread pool.
+        """
+        dispatcher = CryptoDispatcher(
+            inline_max_bytes=10, thread_max_bytes=100)
+        self.assertEqual(CryptoDispatcher.INLINE, dispatcher.choose(10, CTR))
+        self.assertEqual(CryptoDispatcher.PROCESS, dispatcher.choose(11, CTR))
+        self.assertEqual(
+            CryptoDispatcher.PROCESS, dispatcher.choose(100, CTR))
+
+    def test_choose_process_when_threads_are_busy(self):
+        """
+        Test that medium documents are sent to the worker processes when the
+        thread pool has too many pending tasks.
+        """
+        dispatcher = CryptoDispatcher(
+            inline_max_bytes=10, thread_max_bytes=100)
+        dispatcher._pending_threads = dispatcher.MAX_PENDING_THREADS
+        self.assertEqual(CryptoDispatcher.INLINE, dispatcher.choose(10, GCM))
+        self.assertEqual(CryptoDispatcher.PROCESS, dispatcher.choose(50, GCM))
+
+    @inlineCallbacks
+    def test_calibrate_in_thread(self):
+        """
+        Test that calibration runs outside of the reactor thread, with the
+        given encryption method, and that the default thresholds are used
+        until it finishes.
+        """
+        dispatcher = CryptoDispatcher(
+            inline_max_bytes=10, thread_max_bytes=100)
+        measured = []
+        measure = dispatcher._measure_thresholds
+
+        def _measure(enc_method):
+            measured.append((threading.current_thread(), enc_method))
+            return measure(enc_method)
+
+        dispatcher._measure_thresholds = _measure
+        d = dispatcher.calibrate(GCM)
+        self.assertEqual((10, 100), dispatcher.thresholds(GCM))
+        yield d
+        self.assertEqual(1, len(measured))
+        thread, enc_method = measured[0]
+        self.assertNotEqual(threading.current_thread(), thread)
+        self.assertEqual(GCM, enc_method)
+        inline_max, thread_max = dispatcher.thresholds(GCM)
+        self.assertTrue(inline_max <= thread_max)
+        # other methods keep the default thresholds until calibrated
+        self.assertEqual((10, 100), dispatcher.thresholds(CTR))
+        yield dispatcher.calibrate(CTR)
+        self.assertEqual(0, dispatcher.thresholds(CTR)[1])
+
+    @inlineCallbacks
+    def test_encrypt_doc_in_each_tier(self):
+        """
+        Test that documents are encrypted in every tier.
+        """
+        crypto = SoledadCrypto(self._soledad._crypto.secret, enc_method=GCM)
+        dispatcher = CryptoDispatcher(
+            inline_max_bytes=100, thread_max_bytes=1000)
+        for size in [10, 500, 5000]:
+            doc = SoledadDocument(
+                doc_id=DOC_ID, rev=DOC_REV,
+                json=json.dumps({'content': 'x' * size}))
+            encrypted = yield dispatcher.encrypt_doc(self, crypto, doc)
+            self.assertIn(MAC_KEY, json.loads(encrypted))
+
+    @inlineCallbacks
+    def test_in_process_tiers_use_instance_crypto(self):
+        """
+        Test that documents encrypted inline or in threads use the crypto
+        object of the Soledad instance, and that no copy of the storage
+        secret is kept in the main process.
+        """
+        encdecpool._worker_crypto = None
+        crypto = SoledadCrypto(self._soledad._crypto.secret, enc_method=GCM)
+        dispatcher = CryptoDispatcher(
+            inline_max_bytes=100, thread_max_bytes=1000)
+        for size in [10, 500]:
+            doc = SoledadDocument(
+                doc_id=DOC_ID, rev=DOC_REV,
+                json=json.dumps({'content': 'x' * size}))
+            yield dispatcher.encrypt_doc(self, crypto, doc)
+        self.assertIsNone(encdecpool._worker_crypto)
+
 
 class TestSyncEncrypterPool(BaseSoledadTest):
 
@@ -74,6 +225,165 @@ class TestSyncEncrypterPool(BaseSoledadTest):
         self.assertIsNotNone(encrypted)
         self.assertTrue(attempts < 10)
 
+    def test_enqueue_doc_for_encryption_coalesces_revisions(self):
+        """
+        Test that enqueueing a new revision of a document replaces the one
+        waiting in the queue, and that documents are not enqueued when the
+        queue is full.
+        """
+        self._pool.MAX_QUEUED_DOCS = 2
+        enqueued = [
+            self._pool.enqueue_doc_for_encryption(
+                SoledadDocument(doc_id=doc_id, rev=rev, json='{}'))
+            for doc_id, rev in [
+                ('doc-1', 'rev-1'), ('doc-2', 'rev-1'), ('doc-1', 'rev-2'),
+                ('doc-3', 'rev-1')]]
+        self.assertEqual([True, True, True, False], enqueued)
+        queued = [(doc.doc_id, doc.rev)
+                  for doc in self._pool._encr_queue.values()]
+        self.assertEqual([('doc-1', 'rev-2'), ('doc-2', 'rev-1')], queued)
+
+    def test_encrypting_count_survives_restart(self):
+        """
+        Test that encryptions started before a stop are still accounted for
+        after the pool is started again.
+        """
+        self._pool._encrypting = 1
+        self._pool.stop()
+        self._pool.start()
+        self.assertEqual(1, self._pool._encrypting)
+        self._pool._encryption_done(None)
+        self.assertEqual(0, self._pool._encrypting)
+
+    @inlineCallbacks
+    def test_recover_backlog(self):
+        """
+        Test that documents left in the backlog table are enqueued again, and
+        that entries for superseded revisions are removed.
+        """
+        pool = SyncEncrypterPool(
+            self._soledad._crypto, self._soledad._sync_db)
+        query = "INSERT INTO %s VALUES (?, ?)" % pool.BACKLOG_TABLE_NAME
+        yield pool._runOperation(query, ('doc-1', 'rev-1'))
+        yield pool._runOperation(query, ('doc-2', 'old-rev'))
+        docs = [
+            SoledadDocument(doc_id='doc-1', rev='rev-1', json='{}'),
+            SoledadDocument(doc_id='doc-2', rev='new-rev', json='{}')]
+
+        def get_docs(doc_ids, check_for_conflicts=True):
+            return succeed([doc for doc in docs if doc.doc_id in doc_ids])
+
+        yield pool.recover_backlog(get_docs)
+        self.assertEqual(['doc-1'], pool._encr_queue.keys())
+        rows = yield pool._runQuery(
+            "SELECT doc_id, rev FROM %s" % pool.BACKLOG_TABLE_NAME)
+        self.assertEqual([('doc-1', 'rev-1')], [tuple(row) for row in rows])
+
+    @inlineCallbacks
+    def test_recover_backlog_as_queue_drains(self):
+        """
+        Test that backlog entries of documents that do not fit in the
+        encryption queue are kept, and enqueued once the queue drains.
+        """
+        pool = SyncEncrypterPool(
+            self._soledad._crypto, self._soledad._sync_db)
+        pool.MAX_QUEUED_DOCS = 1
+        query = "INSERT INTO %s VALUES (?, ?)" % pool.BACKLOG_TABLE_NAME
+        docs = [
+            SoledadDocument(doc_id='doc-%d' % i, rev='rev-1', json='{}')
+            for i in (1, 2)]
+        for doc in docs:
+            yield pool._runOperation(query, (doc.doc_id, doc.rev))
+
+        def get_docs(doc_ids, check_for_conflicts=True):
+            return succeed([doc for doc in docs if doc.doc_id in doc_ids])
+
+        yield pool.recover_backlog(get_docs)
+        self.assertEqual(['doc-1'], pool._encr_queue.keys())
+        pool._encr_queue.clear()
+        yield pool._recover_backlog_page()
+        self.assertEqual(['doc-2'], pool._encr_queue.keys())
+        rows = yield pool._runQuery(
+            "SELECT doc_id FROM %s ORDER BY doc_id" % pool.BACKLOG_TABLE_NAME)
+        self.assertEqual(['doc-1', 'doc-2'], [row[0] for row in rows])
+
+    @inlineCallbacks
+    def test_backlog_written_before_encryption(self):
+        """
+        Test that backlog entries are written as soon as documents are
+        enqueued, and that the entry of an encrypted document is removed.
+        """
+        pool = SyncEncrypterPool(
+            self._soledad._crypto, self._soledad._sync_db)
+        for doc_id in ('doc-1', 'doc-2'):
+            pool.enqueue_doc_for_encryption(
+                SoledadDocument(doc_id=doc_id, rev='rev-1', json='{}'))
+        # wait for the flush scheduled by the enqueueing
+        yield deferLater(reactor, 0, pool._write_lock.run, lambda: None)
+        rows = yield pool._runQuery(
+            "SELECT doc_id, rev FROM %s ORDER BY doc_id"
+            % pool.BACKLOG_TABLE_NAME)
+        self.assertEqual(
+            [('doc-1', 'rev-1'), ('doc-2', 'rev-1')],
+            [tuple(row) for row in rows])
+        yield pool._insert_encrypted_local_doc('doc-1', 'rev-1', '{}')
+        rows = yield pool._runQuery(
+            "SELECT doc_id, rev FROM %s" % pool.BACKLOG_TABLE_NAME)
+        self.assertEqual([('doc-2', 'rev-1')], [tuple(row) for row in rows])
+        rows = yield pool._runQuery(
+            "SELECT doc_id, rev FROM %s" % pool.TABLE_NAME)
+        self.assertEqual([('doc-1', 'rev-1')], [tuple(row) for row in rows])
+
+    @inlineCallbacks
+    def test_encrypt_doc_in_batches(self):
+        """
+        Test that documents are encrypted when sent to the workers in more
+        than one batch.
+        """
+        self._pool.BATCH_SIZE = 2
+        docs = [
+            SoledadDocument(
+                doc_id="doc-%d" % i, rev=DOC_REV,
+                json=json.dumps(DOC_CONTENT))
+            for i in xrange(5)]
+        results = yield gatherResults(
+            [self._pool.encrypt_doc(doc) for doc in docs])
+        self.assertEqual(5, len(results))
+        for encrypted in results:
+            self.assertIn(MAC_KEY, json.loads(encrypted))
+
+    def test_encrypt_doc_fails_when_pool_stops(self):
+        """
+        Test that encryptions waiting in a batch fail when the pool stops,
+        instead of never firing.
+        """
+        self._pool._dispatcher = CryptoDispatcher(
+            inline_max_bytes=0, thread_max_bytes=0)
+        doc = SoledadDocument(
+            doc_id=DOC_ID, rev=DOC_REV, json=json.dumps(DOC_CONTENT))
+        d = self._pool.encrypt_doc(doc)
+        self._pool.stop()
+        return self.assertFailure(d, CancelledError)
+
+    @inlineCallbacks
+    def test_workers_shared_between_pools(self):
+        """
+        Test that encrypter pools share the process-wide pool of workers,
+        which outlives them.
+        """
+        crypto = self._soledad._crypto
+        sync_db = self._soledad._sync_db
+        other = SyncEncrypterPool(crypto, sync_db)
+        other.start()
+        self.assertIs(get_worker_pool(), self._pool._pool)
+        self.assertIs(get_worker_pool(), other._pool)
+        other.stop()
+        doc = SoledadDocument(
+            doc_id=DOC_ID, rev=DOC_REV, json=json.dumps(DOC_CONTENT))
+        encrypted = yield self._pool.encrypt_doc(doc)
+        self.assertIn(MAC_KEY, json.loads(encrypted))
+        self.assertTrue(get_worker_pool().running)
+
 
 class TestSyncDecrypterPool(BaseSoledadTest):
 
@@ -155,6 +465,37 @@ class TestSyncDecrypterPool(BaseSoledadTest):
         self._pool.deferred.addCallback(_assert_doc_was_inserted)
         return self._pool.deferred
 
+    def test_insert_received_docs_in_batches(self):
+        """
+        Test that runs of documents that can be inserted in order are
+        inserted in batches when a batch insertion callback is available.
+        """
+        batches = []
+        self._pool._insert_docs_cb = batches.append
+        self._pool.INSERT_BATCH_SIZE = 10
+        many = 25
+        self._pool.start(many)
+
+        # the first document arrives last, so all others wait for it
+        for idx in range(2, many + 1) + [1]:
+            self._pool.insert_received_doc(
+                "doc_id: %d" % idx, "rev: %d" % idx, {'idx': idx}, idx,
+                "trans_id: %d" % idx, idx)
+
+        def _assert_docs_were_inserted_in_batches(_):
+            self.assertEqual([], self._inserted_docs)
+            self.assertEqual([10, 10, 5], [len(b) for b in batches])
+            inserted = [entry for batch in batches for entry in batch]
+            self.assertEqual(
+                range(1, many + 1), [entry[1] for entry in inserted])
+            self.assertEqual(
+                ["doc_id: %d" % idx for idx in range(1, many + 1)],
+                [entry[0].doc_id for entry in inserted])
+
+        self._pool.deferred.addCallback(
+            _assert_docs_were_inserted_in_batches)
+        return self._pool.deferred
+
     def test_insert_encrypted_received_doc(self):
         """
         Test that one encrypted document added to the pool is decrypted and
@@ -223,3 +564,116 @@ class TestSyncDecrypterPool(BaseSoledadTest):
         self._pool.deferred.addCallback(
             _assert_docs_were_decrypted_and_inserted)
         return self._pool.deferred
+
+    def test_insert_encrypted_received_doc_before_start(self):
+        """
+        Test that encrypted documents received before the pool is started are
+        decrypted and inserted once it starts.
+        """
+        crypto = self._soledad._crypto
+        doc = SoledadDocument(
+            doc_id=DOC_ID, rev=DOC_REV, json=json.dumps(DOC_CONTENT))
+        encrypted_content = json.loads(crypto.encrypt_doc(doc))
+
+        self._pool.insert_encrypted_received_doc(
+            DOC_ID, DOC_REV, encrypted_content, 1, "trans_id", 1)
+        self._pool.start(1)
+
+        def _assert_doc_was_decrypted_and_inserted(_):
+            self.assertEqual(self._inserted_docs, [(doc, 1, u"trans_id")])
+
+        self._pool.deferred.addCallback(
+            _assert_doc_was_decrypted_and_inserted)
+        return self._pool.deferred
+
+    def test_decryption_error_fires_errback(self):
+        """
+        Test that errors raised while decrypting a document in a worker are
+        propagated to the deferred of the pool.
+        """
+        crypto = self._soledad._crypto
+        doc = SoledadDocument(
+            doc_id=DOC_ID, rev=DOC_REV, json=json.dumps(DOC_CONTENT))
+        encrypted_content = json.loads(crypto.encrypt_doc(doc))
+        encrypted_content[MAC_KEY] = '1234567890ABCDEF'
+
+        self._pool.start(1)
+        self._pool.insert_encrypted_received_doc(
+            DOC_ID, DOC_REV, encrypted_content, 1, "trans_id", 1)
+
+        d = self._pool.deferred
+        d.addCallback(lambda _: self.fail("decryption should have failed"))
+        d.addErrback(lambda f: f.trap(WrongMacError))
+        d.addCallback(lambda _: self.flushLoggedErrors(WrongMacError))
+        return d
+
+    def test_insert_received_doc_many_with_spill(self):
+        """
+        Test that documents that do not fit in the reorder buffer are spilled
+        to the sync db and still inserted in order.
+        """
+        self._pool = SyncDecrypterPool(
+            self._soledad._crypto,
+            self._soledad._sync_db,
+            source_replica_uid=self._soledad._dbpool.replica_uid,
+            insert_doc_cb=self._insert_doc_cb,
+            max_buffer_bytes=1)
+        many = 10
+        self._pool.start(many)
+
+        # insert docs in reverse order so that all but the first one have to
+        # wait for their predecessors
+        for idx in reversed(xrange(1, many + 1)):
+            self._pool.insert_received_doc(
+                "doc_id: %d" % idx, "rev: %d" % idx, {'idx': idx}, idx,
+                "trans_id: %d" % idx, idx)
+
+        def _assert_docs_were_inserted_in_order(_):
+            self.assertEqual(
+                range(1, many + 1),
+                [gen for doc, gen, trans_id in self._inserted_docs])
+
+        self._pool.deferred.addCallback(_assert_docs_were_inserted_in_order)
+        return self._pool.deferred
+
+    def test_spilled_doc_is_deleted_after_insertion(self):
+        """
+        Test that the pool waits for the deferred returned by the insert
+        callback, and only then deletes a spilled document from the sync db.
+        """
+        spilled_during_insert = []
+
+        def _insert_doc_cb(doc, gen, trans_id):
+            d = self._pool._runQuery(
+                "SELECT doc_id FROM %s" % self._pool.TABLE_NAME)
+            d.addCallback(
+                lambda rows: spilled_during_insert.append(
+                    [row[0] for row in rows]))
+            d.addCallback(
+                lambda _: self._inserted_docs.append((doc, gen, trans_id)))
+            return d
+
+        self._pool = SyncDecrypterPool(
+            self._soledad._crypto,
+            self._soledad._sync_db,
+            source_replica_uid=self._soledad._dbpool.replica_uid,
+            insert_doc_cb=_insert_doc_cb,
+            max_buffer_bytes=1)
+        self._pool.start(2)
+        for idx in (2, 1):
+            self._pool.insert_received_doc(
+                "doc_id: %d" % idx, "rev: %d" % idx, {'idx': idx}, idx,
+                "trans_id: %d" % idx, idx)
+
+        def _assert_spilled_doc_was_deleted_after_insertion(_):
+            self.assertEqual(
+                [1, 2], [entry[1] for entry in self._inserted_docs])
+            self.assertIn("doc_id: 2", spilled_during_insert[1])
+            d = self._pool._runQuery(
+                "SELECT doc_id FROM %s" % self._pool.TABLE_NAME)
+            d.addCallback(lambda rows: self.assertEqual([], rows))
+            return d
+
+        self._pool.deferred.addCallback(
+            _assert_spilled_doc_was_deleted_after_insertion)
+        return self._pool.deferred
@@ -25,6 +25,7 @@ import shutil
 
 from pysqlcipher import dbapi2
 from testscenarios import TestWithScenarios
+from twisted.internet import defer
 
 # u1db stuff.
 from u1db import errors
@@ -36,7 +37,9 @@ from leap.soledad.common import soledad_assert
 from leap.soledad.common.document import SoledadDocument
 from leap.soledad.client.sqlcipher import SQLCipherDatabase
 from leap.soledad.client.sqlcipher import SQLCipherOptions
+from leap.soledad.client.sqlcipher import SQLCipherWriter
 from leap.soledad.client.sqlcipher import DatabaseIsNotEncrypted
+from leap.soledad.client.pragmas import PROFILES
 
 # u1db tests stuff.
 from leap.soledad.common.tests import u1db_tests as tests
@@ -585,6 +588,174 @@ class TestSQLCipherPartialExpandDatabase(tests.TestCase):
             ["key1", "key2", "key3"], ["a", "b*", "*"], ["p", "q*", "*"])
 
 
+class TestSQLCipherBulkWrites(tests.TestCase):
+
+    def setUp(self):
+        self.db = sqlcipher_open(':memory:', PASSWORD)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_create_docs_reports_errors_per_doc(self):
+        self.db.create_index('test', 'key')
+        self.db.create_doc({'key': 'old'}, doc_id='existing')
+        results = self.db.create_docs(
+            [{'key': 'a'}, {'key': 'b'}, {'key': 'c'}],
+            doc_ids=[None, 'existing', 'new'])
+        self.assertEqual([True, False, True], [ok for ok, _ in results])
+        self.assertIsInstance(results[1][1], errors.RevisionConflict)
+        self.assertEqual(
+            sorted(['a', 'c', 'old']),
+            sorted(
+                d.content['key'] for d in self.db.get_from_index('test', '*')))
+
+    def test_put_and_delete_docs(self):
+        docs = [d for _, d in self.db.create_docs([{'n': 1}, {'n': 2}])]
+        docs[0].content = {'n': 3}
+        stale = self.db.get_doc(docs[1].doc_id)
+        stale.rev = 'other:1'
+        results = self.db.put_docs([docs[0], stale])
+        self.assertEqual((True, docs[0].rev), results[0])
+        self.assertIsInstance(results[1][1], errors.RevisionConflict)
+        self.assertEqual({'n': 3}, self.db.get_doc(docs[0].doc_id).content)
+        results = self.db.delete_docs(docs)
+        self.assertEqual([True, True], [ok for ok, _ in results])
+        self.assertEqual(None, self.db.get_doc(docs[1].doc_id))
+
+    def test_only_put_docs_are_enqueued_for_encryption(self):
+        enqueued = []
+
+        class FakeEncrypterPool(object):
+
+            def enqueue_docs_for_encryption(self, docs):
+                enqueued.extend((doc.doc_id, doc.rev) for doc in docs)
+
+        self.db.defer_encryption = True
+        self.db._sync_enc_pool = FakeEncrypterPool()
+        docs = [d for _, d in self.db.create_docs([{'n': 1}, {'n': 2}])]
+        self.assertEqual([(d.doc_id, d.rev) for d in docs], enqueued)
+        del enqueued[:]
+        self.db.delete_docs(docs)
+        self.assertEqual([], enqueued)
+
+    def test_put_docs_rolls_back_on_failure(self):
+        doc = self.db.create_doc({'n': 1})
+        rev = doc.rev
+
+        def failing_put(db, doc):
+            SQLitePartialExpandDatabase.put_doc(db, doc)
+            raise Exception()
+
+        doc.content = {'n': 2}
+        self.assertRaises(Exception, self.db._bulk_write, failing_put, [doc])
+        self.assertEqual(rev, doc.rev)
+        self.assertEqual({'n': 1}, self.db.get_doc(doc.doc_id).content)
+
+    def test_put_docs_if_newer(self):
+        entries = [
+            (SoledadDocument('doc%d' % i, 'other:1', '{"n": %d}' % i),
+             i + 1, 'T-%d' % i)
+            for i in range(3)]
+        states = self.db._put_docs_if_newer(
+            entries, save_conflict=True, replica_uid='other')
+        self.assertEqual(['inserted'] * 3, states)
+        self.assertEqual(
+            (3, 'T-2'), self.db._get_replica_gen_and_trans_id('other'))
+        self.assertEqual({'n': 1}, self.db.get_doc('doc1').content)
+        # a run starting before the recorded generation is refused
+        self.assertRaises(
+            errors.InvalidGeneration, self.db._put_docs_if_newer,
+            [(SoledadDocument('doc3', 'other:1', '{}'), 2, 'T-3')],
+            save_conflict=True, replica_uid='other')
+        self.assertEqual(None, self.db.get_doc('doc3'))
+
+
+class TestSQLCipherPerformanceProfile(tests.TestCase):
+
+    def test_options_use_profile(self):
+        opts = SQLCipherOptions(
+            '/some/path', 'key', is_raw_key=True, profile='bulk-import')
+        self.assertEqual(PROFILES['bulk-import'], opts.profile)
+        self.assertEqual(1024, opts.cipher_page_size)
+        self.assertEqual(
+            PROFILES['bulk-import'].raw_key_kdf_iter, opts.kdf_iter)
+        copy = SQLCipherOptions.copy(opts, path='/other/path')
+        self.assertEqual(opts.profile, copy.profile)
+        self.assertRaises(
+            ValueError, SQLCipherOptions, '/some/path', 'key',
+            profile='unknown')
+
+    def test_profile_applied_to_connections(self):
+        path = os.path.join(self.createTempDir(), 'profile.db')
+        profile = PROFILES['laptop'].copy(wal_autocheckpoint=123)
+        db = SQLCipherDatabase(
+            SQLCipherOptions(path, PASSWORD, profile=profile))
+        c = db._get_sqlite_handle().cursor()
+        c.execute('PRAGMA wal_autocheckpoint')
+        self.assertEqual(123, c.fetchone()[0])
+        c.execute('PRAGMA cache_size')
+        self.assertEqual(-profile.cache_size, c.fetchone()[0])
+        db.close()
+
+
+class TestSQLCipherWriter(tests.TestCase):
+
+    def setUp(self):
+        tests.TestCase.setUp(self)
+        path = os.path.join(self.createTempDir(), 'writer.db')
+        opts = SQLCipherOptions(path, PASSWORD)
+        self.db = SQLCipherDatabase(opts)
+        self.writer = SQLCipherWriter(opts)
+        self.writer.start()
+
+    def tearDown(self):
+        self.writer.stop()
+        self.db.close()
+        tests.TestCase.tearDown(self)
+
+    @defer.inlineCallbacks
+    def test_queued_insertions_run_separately(self):
+        """
+        Test that insertions queued while the writer is busy run one at a
+        time, in order, and that each caller gets the states of its
+        documents.
+        """
+        run = []
+        orig_write = self.writer._write
+
+        def _write(meth, args, kw):
+            run.append((meth, len(args[0])))
+            return orig_write(meth, args, kw)
+
+        self.writer._write = _write
+        deferreds = []
+        for i in range(3):
+            doc = SoledadDocument('doc%d' % i, 'other:1', '{"n": %d}' % i)
+            deferreds.append(self.writer.run(
+                '_put_docs_if_newer', [(doc, i + 1, 'T-%d' % i)],
+                save_conflict=True, replica_uid='other'))
+        results = yield defer.gatherResults(deferreds)
+        self.assertEqual([['inserted']] * 3, results)
+        self.assertEqual([('_put_docs_if_newer', 1)] * 3, run)
+        self.assertEqual({'n': 2}, self.db.get_doc('doc2').content)
+        self.assertEqual(
+            (3, 'T-2'), self.db._get_replica_gen_and_trans_id('other'))
+
+    def test_stop_cancels_queued_writes(self):
+        """
+        Test that writes still queued when the writer stops fail instead of
+        never firing.
+        """
+        # pretend a write is running, so that the next ones are queued
+        self.writer._writing = True
+        doc = SoledadDocument('doc', 'other:1', '{}')
+        d = self.writer.run(
+            '_put_docs_if_newer', [(doc, 1, 'T-1')],
+            save_conflict=True, replica_uid='other')
+        self.writer.stop()
+        return self.assertFailure(d, defer.CancelledError)
+
+
 # -----------------------------------------------------------------------------
 # The following tests come from `u1db.tests.test_open`.
 # -----------------------------------------------------------------------------
@@ -39,6 +39,7 @@ from leap.soledad.client.sqlcipher import SQLCipherDatabase
 
 from leap.soledad.common import couch
 from leap.soledad.common.document import SoledadDocument
+from leap.soledad.server.sync import ServerSyncState
 
 from leap.soledad.common.tests import u1db_tests as tests
 from leap.soledad.common.tests.util import make_sqlcipher_database_for_test
@@ -94,53 +95,102 @@ class TestSoledadParseReceivedDocResponse(SoledadWithCouchServerMixin):
             key, secret)
 
         with self.assertRaises(u1db.errors.BrokenSyncStream):
-            self.target._parse_received_doc_response("[\r\n{},\r\n]")
+            self.target._parse_received_docs_response("[\r\n{},\r\n]")
 
         with self.assertRaises(u1db.errors.BrokenSyncStream):
-            self.target._parse_received_doc_response(
+            self.target._parse_received_docs_response(
                 ('[\r\n{},\r\n{"id": "i", "rev": "r", ' +
                  '"content": %s, "gen": 3, "trans_id": "T-sid"}' +
                  ',\r\n]') % json.dumps(enc_json))
 
     def test_wrong_start(self):
         with self.assertRaises(u1db.errors.BrokenSyncStream):
-            self.target._parse_received_doc_response("{}\r\n]")
+            self.target._parse_received_docs_response("{}\r\n]")
 
         with self.assertRaises(u1db.errors.BrokenSyncStream):
-            self.target._parse_received_doc_response("\r\n{}\r\n]")
+            self.target._parse_received_docs_response("\r\n{}\r\n]")
 
         with self.assertRaises(u1db.errors.BrokenSyncStream):
-            self.target._parse_received_doc_response("")
+            self.target._parse_received_docs_response("")
 
     def test_wrong_end(self):
         with self.assertRaises(u1db.errors.BrokenSyncStream):
-            self.target._parse_received_doc_response("[\r\n{}")
+            self.target._parse_received_docs_response("[\r\n{}")
 
         with self.assertRaises(u1db.errors.BrokenSyncStream):
-            self.target._parse_received_doc_response("[\r\n")
+            self.target._parse_received_docs_response("[\r\n")
 
     def test_missing_comma(self):
         with self.assertRaises(u1db.errors.BrokenSyncStream):
-            self.target._parse_received_doc_response(
+            self.target._parse_received_docs_response(
                 '[\r\n{}\r\n{"id": "i", "rev": "r", '
                 '"content": "c", "gen": 3}\r\n]')
 
     def test_no_entries(self):
         with self.assertRaises(u1db.errors.BrokenSyncStream):
-            self.target._parse_received_doc_response("[\r\n]")
+            self.target._parse_received_docs_response("[\r\n]")
 
     def test_error_in_stream(self):
         with self.assertRaises(u1db.errors.BrokenSyncStream):
-            self.target._parse_received_doc_response(
+            self.target._parse_received_docs_response(
                 '[\r\n{"new_generation": 0},'
                 '\r\n{"error": "unavailable"}\r\n')
 
         with self.assertRaises(u1db.errors.BrokenSyncStream):
-            self.target._parse_received_doc_response(
+            self.target._parse_received_docs_response(
                 '[\r\n{"error": "unavailable"}\r\n')
 
         with self.assertRaises(u1db.errors.BrokenSyncStream):
-            self.target._parse_received_doc_response('[\r\n{"error": "?"}\r\n')
+            self.target._parse_received_docs_response(
+                '[\r\n{"error": "?"}\r\n')
+
+    def test_many_entries(self):
+        new_gen, new_trans_id, number_of_changes, entries = \
+            self.target._parse_received_docs_response(
+                '[\r\n{"new_generation": 2, "new_transaction_id": "T-2", '
+                '"number_of_changes": 2},'
+                '\r\n{"id": "i", "rev": "r", "content": "c", "gen": 1, '
+                '"trans_id": "T-1"},'
+                '\r\n{"id": "j", "rev": "s", "content": "d", "gen": 2, '
+                '"trans_id": "T-2"}\r\n]')
+        self.assertEqual(2, new_gen)
+        self.assertEqual("T-2", new_trans_id)
+        self.assertEqual(2, number_of_changes)
+        self.assertEqual(
+            [("i", "r", "c", 1, "T-1"), ("j", "s", "d", 2, "T-2")],
+            entries)
+
+    def test_stream_fed_in_chunks(self):
+        stream = (
+            '[\r\n{"new_generation": 2, "new_transaction_id": "T-2", '
+            '"number_of_changes": 2},'
+            '\r\n{"id": "i", "rev": "r", "content": "c", "gen": 1, '
+            '"trans_id": "T-1"},'
+            '\r\n{"id": "j", "rev": "s", "content": "d", "gen": 2, '
+            '"trans_id": "T-2"}\r\n]')
+        metadata = []
+        entries = []
+        parser = target.ReceivedDocsParser(
+            metadata.append, lambda *entry: entries.append(entry))
+        for i in xrange(0, len(stream), 5):
+            parser.feed(stream[i:i + 5])
+            if i == 0:
+                # nothing can be parsed before the first line is complete
+                self.assertEqual([], metadata)
+        self.assertEqual((2, "T-2", 2), parser.finish())
+        self.assertEqual(1, len(metadata))
+        self.assertEqual(
+            [("i", "r", "c", 1, "T-1"), ("j", "s", "d", 2, "T-2")],
+            entries)
+
+    def test_truncated_stream(self):
+        parser = target.ReceivedDocsParser(
+            lambda metadata: None, lambda *entry: None)
+        parser.feed(
+            '[\r\n{"new_generation": 2, "new_transaction_id": "T-2", '
+            '"number_of_changes": 2},\r\n{"id": "i"')
+        with self.assertRaises(u1db.errors.BrokenSyncStream):
+            parser.finish()
 
 #
 # functions for TestRemoteSyncTargets
@@ -172,6 +222,34 @@ def make_local_db_and_token_soledad_target(
     return db, st
 
 
+class TestReceiveWindow(tests.TestCase):
+
+    def test_grows_on_success(self):
+        window = target.ReceiveWindow(initial=2, maximum=4)
+        for _ in xrange(10):
+            window.success(0.1)
+        self.assertEqual(4, window.size)
+
+    def test_shrinks_on_failure(self):
+        window = target.ReceiveWindow(initial=8, maximum=8)
+        window.failure()
+        self.assertEqual(4, window.size)
+        # further failures within the same window do not shrink it again
+        window.failure()
+        self.assertEqual(4, window.size)
+
+    def test_shrinks_on_high_latency(self):
+        window = target.ReceiveWindow(initial=8, maximum=8)
+        window.success(0.1)
+        window.success(1.0)
+        self.assertEqual(4, window.size)
+
+    def test_never_below_minimum(self):
+        window = target.ReceiveWindow(initial=1, minimum=1)
+        window.failure()
+        self.assertEqual(1, window.size)
+
+
 class TestSoledadSyncTarget(
         TestWithScenarios,
         SoledadWithCouchServerMixin,
@@ -236,6 +314,46 @@ class TestSoledadSyncTarget(
         self.assertGetEncryptedDoc(
             db, 'doc-here', 'replica:1', '{"value": "here"}', False)
 
+    @defer.inlineCallbacks
+    def test_sync_exchange_send_in_batches(self):
+        """
+        Test that many documents are sent in batches of at most
+        MAX_BATCH_DOCS documents each.
+        """
+        db = self.request_state._create_database('test')
+        remote_target = self.getSyncTarget('test')
+        remote_target.MAX_BATCH_DOCS = 2
+        batches = []
+        _send_batch = remote_target._send_batch
+
+        def count_send_batch(headers, entries):
+            # the first two entries are the opening bracket and the sync
+            # metadata, the rest are documents
+            batches.append(len(entries) - 2)
+            return _send_batch(headers, entries)
+
+        remote_target._send_batch = count_send_batch
+
+        def receive_doc(doc, gen, trans_id):
+            pass
+
+        docs_by_generation = []
+        for i in xrange(5):
+            doc = self.make_document(
+                'doc-%d' % i, 'replica:1', '{"value": %d}' % i)
+            docs_by_generation.append((doc, i + 1, 'T-sid-%d' % i))
+        new_gen, trans_id = yield remote_target.sync_exchange(
+            docs_by_generation, 'replica', last_known_generation=0,
+            last_known_trans_id=None, insert_doc_cb=receive_doc,
+            defer_decryption=False)
+        self.assertEqual(5, new_gen)
+        self.assertEqual([2, 2, 1], batches)
+        for i in xrange(5):
+            self.assertGetEncryptedDoc(
+                db, 'doc-%d' % i, 'replica:1', '{"value": %d}' % i, False)
+        self.assertEqual(
+            (5, 'T-sid-4'), db._get_replica_gen_and_trans_id('replica'))
+
     @defer.inlineCallbacks
     def test_sync_exchange_send_failure_and_retry_scenario(self):
         """
@@ -385,6 +503,154 @@ class TestSoledadSyncTarget(
             (doc.doc_id, doc.rev, '{"value": "there"}', 1),
             other_changes[0][:-1])
 
+    @defer.inlineCallbacks
+    def test_sync_exchange_receive_in_batches(self):
+        """
+        Test that many documents are received in batches of at most
+        MAX_RECEIVE_DOCS documents each.
+        """
+        db = self.request_state._create_database('test')
+        docs = [db.create_doc_from_json('{"value": %d}' % i)
+                for i in xrange(5)]
+        remote_target = self.getSyncTarget('test')
+        remote_target.MAX_RECEIVE_DOCS = 2
+        other_changes = []
+
+        def receive_doc(doc, gen, trans_id):
+            other_changes.append(
+                (doc.doc_id, doc.rev, doc.get_json(), gen))
+
+        new_gen, trans_id = yield remote_target.sync_exchange(
+            [], 'replica', last_known_generation=0, last_known_trans_id=None,
+            insert_doc_cb=receive_doc, defer_decryption=False)
+        self.assertEqual(5, new_gen)
+        self.assertEqual(
+            [(doc.doc_id, doc.rev, '{"value": %d}' % i, i + 1)
+             for i, doc in enumerate(docs)],
+            sorted(other_changes, key=lambda change: change[3]))
+
+    @defer.inlineCallbacks
+    def test_sync_exchange_receive_from_server_without_batches(self):
+        """
+        Test that documents are received one per request from a server that
+        rejects requests for many documents at once.
+        """
+        db = self.request_state._create_database('test')
+        docs = [db.create_doc_from_json('{"value": %d}' % i)
+                for i in xrange(5)]
+        remote_target = self.getSyncTarget('test')
+        remote_target.MAX_RECEIVE_DOCS = 2
+        _http_request = remote_target._http_request
+        rejected = []
+
+        def old_server_http_request(url, method='GET', body=None,
+                                    headers={}, parser=None):
+            if body is not None and '"count"' in body:
+                rejected.append(body)
+                return defer.fail(u1db.errors.HTTPError(
+                    400, '{"error": "bad request"}'))
+            return _http_request(
+                url, method=method, body=body, headers=headers,
+                parser=parser)
+
+        remote_target._http_request = old_server_http_request
+        other_changes = []
+
+        def receive_doc(doc, gen, trans_id):
+            other_changes.append((doc.doc_id, gen))
+
+        new_gen, trans_id = yield remote_target.sync_exchange(
+            [], 'replica', last_known_generation=0, last_known_trans_id=None,
+            insert_doc_cb=receive_doc, defer_decryption=False)
+        self.assertEqual(5, new_gen)
+        self.assertEqual(1, len(rejected))
+        self.assertEqual(
+            [(doc.doc_id, i + 1) for i, doc in enumerate(docs)],
+            sorted(other_changes, key=lambda change: change[1]))
+
+    @defer.inlineCallbacks
+    def test_sync_exchange_receive_short_batch_fails(self):
+        """
+        Test that the sync fails if the server sends fewer documents than
+        requested.
+        """
+        db = self.request_state._create_database('test')
+        for i in xrange(5):
+            db.create_doc_from_json('{"value": %d}' % i)
+        remote_target = self.getSyncTarget('test')
+        remote_target.MAX_RECEIVE_DOCS = 2
+        next_changes_to_return = ServerSyncState.next_changes_to_return
+
+        def drop_last_change(state, received, count=1):
+            gen, trans_id, changes = next_changes_to_return(
+                state, received, count)
+            return gen, trans_id, changes[:-1]
+
+        self.patch(
+            ServerSyncState, 'next_changes_to_return', drop_last_change)
+
+        def receive_doc(doc, gen, trans_id):
+            pass
+
+        d = remote_target.sync_exchange(
+            [], 'replica', last_known_generation=0, last_known_trans_id=None,
+            insert_doc_cb=receive_doc, defer_decryption=False)
+        yield self.assertFailure(d, u1db.errors.BrokenSyncStream)
+
+    @defer.inlineCallbacks
+    def test_sync_exchange_receive_inserts_runs_in_order(self):
+        """
+        Test that documents received by concurrent download requests are
+        inserted in runs, in the order of their generations.
+        """
+        db = self.request_state._create_database('test')
+        docs = [db.create_doc_from_json('{"value": %d}' % i)
+                for i in xrange(7)]
+        remote_target = self.getSyncTarget('test')
+        remote_target.MAX_RECEIVE_DOCS = 2
+        remote_target.INSERT_BATCH_SIZE = 3
+        runs = []
+
+        def receive_docs(entries):
+            runs.append([(doc.doc_id, gen) for doc, gen, _ in entries])
+
+        new_gen, trans_id = yield remote_target.sync_exchange(
+            [], 'replica', last_known_generation=0, last_known_trans_id=None,
+            insert_doc_cb=None, insert_docs_cb=receive_docs,
+            defer_decryption=False)
+        self.assertEqual(7, new_gen)
+        self.assertTrue(all(len(run) <= 3 for run in runs))
+        self.assertEqual(
+            [(doc.doc_id, i + 1) for i, doc in enumerate(docs)],
+            [entry for run in runs for entry in run])
+
+    @defer.inlineCallbacks
+    def test_sync_exchange_receive_inserts_batches_larger_than_a_run(self):
+        """
+        Test that all documents of a download request are inserted when the
+        request returns more documents than fit in a single run.
+        """
+        db = self.request_state._create_database('test')
+        docs = [db.create_doc_from_json('{"value": %d}' % i)
+                for i in xrange(7)]
+        remote_target = self.getSyncTarget('test')
+        remote_target.MAX_RECEIVE_DOCS = 5
+        remote_target.INSERT_BATCH_SIZE = 2
+        runs = []
+
+        def receive_docs(entries):
+            runs.append([(doc.doc_id, gen) for doc, gen, _ in entries])
+
+        new_gen, trans_id = yield remote_target.sync_exchange(
+            [], 'replica', last_known_generation=0, last_known_trans_id=None,
+            insert_doc_cb=None, insert_docs_cb=receive_docs,
+            defer_decryption=False)
+        self.assertEqual(7, new_gen)
+        self.assertTrue(all(len(run) <= 2 for run in runs))
+        self.assertEqual(
+            [(doc.doc_id, i + 1) for i, doc in enumerate(docs)],
+            [entry for run in runs for entry in run])
+
 
 # -----------------------------------------------------------------------------
 # The following tests come from `u1db.tests.test_sync`.
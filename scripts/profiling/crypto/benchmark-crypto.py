@@ -0,0 +1,302 @@
+#!/usr/bin/python
+
+# Micro-benchmarks for the client crypto primitives and for the round trip
+# of documents through the pool of crypto workers.
+#
+# Results are written as JSON, with operations per second, throughput and
+# latency percentiles for each benchmark, document size and number of
+# workers. Results can be compared against a previous run, in which case the
+# script exits with a non-zero status if any benchmark got slower than the
+# allowed threshold.
+#
+# Use it like this:
+#
+#     ./benchmark-crypto.py -o baseline.json
+#     ./benchmark-crypto.py -c baseline.json -t 10
+#     ./benchmark-crypto.py -b encrypt_docstr -s 1K,1M -h
+
+
+import os
+import sys
+import json
+import logging
+import argparse
+import multiprocessing
+
+from timeit import default_timer
+
+from leap.soledad.common import crypto as common_crypto
+from leap.soledad.client import crypto
+from leap.soledad.client.encdecpool import encrypt_docs_task
+from leap.soledad.client.encdecpool import decrypt_docs_task
+
+
+# benchmarking args
+SIZES = '1K,10K,100K,1M,10M,50M'
+WORKERS = '1,2,%d' % multiprocessing.cpu_count()
+MIN_RUNS = 5
+MAX_RUNS = 1000
+MIN_TIME = 1.0  # seconds spent on each benchmark, at least
+THRESHOLD = 10  # percent of ops/s lost before a benchmark is a regression
+
+MB = 1024. ** 2
+UNITS = {'K': 1024, 'M': 1024 ** 2}
+
+SECRET = os.urandom(128)
+DOC_ID = 'benchmark-doc'
+DOC_REV = 'benchmark-rev'
+ENC_METHOD = crypto.DEFAULT_ENC_METHOD
+
+
+# create a logger
+logger = logging.getLogger(__name__)
+LOG_FORMAT = '%(asctime)s %(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+
+
+def parse_size(size):
+    size = size.strip().upper()
+    if size[-1] in UNITS:
+        return int(size[:-1]) * UNITS[size[-1]]
+    return int(size)
+
+
+def get_docstr(size):
+    # hex content compresses about as well as typical documents
+    return json.dumps({'data': os.urandom(size / 2).encode('hex')})
+
+
+#
+# Benchmarks. Each one receives the document size and the number of workers
+# and returns the operation to be timed, or None if it does not apply.
+#
+
+def bench_encrypt_sym(size, workers):
+    key = os.urandom(32)
+    data = os.urandom(size)
+    return lambda: crypto.encrypt_sym(data, key)
+
+
+def bench_decrypt_sym(size, workers):
+    key = os.urandom(32)
+    iv, ciphertext = crypto.encrypt_sym(os.urandom(size), key)
+    return lambda: crypto.decrypt_sym(ciphertext, key, iv)
+
+
+def bench_mac_doc(size, workers):
+    ciphertext = os.urandom(size)
+    return lambda: crypto.mac_doc(
+        DOC_ID, DOC_REV, ciphertext,
+        common_crypto.EncryptionSchemes.SYMKEY,
+        common_crypto.EncryptionMethods.AES_256_CTR, 'iv',
+        common_crypto.MacMethods.HMAC, SECRET)
+
+
+def bench_encrypt_docstr(size, workers):
+    key = crypto.doc_passphrase(DOC_ID, SECRET)
+    docstr = get_docstr(size)
+    return lambda: crypto.encrypt_docstr(
+        docstr, DOC_ID, DOC_REV, key, SECRET)
+
+
+def bench_decrypt_doc_dict(size, workers):
+    key = crypto.doc_passphrase(DOC_ID, SECRET)
+    doc_dict = json.loads(crypto.encrypt_docstr(
+        get_docstr(size), DOC_ID, DOC_REV, key, SECRET))
+    return lambda: crypto.decrypt_doc_dict(
+        doc_dict, DOC_ID, DOC_REV, key, SECRET)
+
+
+def bench_doc_passphrase(size, workers):
+    # key derivation does not depend on the size of the document, and the
+    # uncached derivation is what matters.
+    if size != min(SIZES_IN_RUN):
+        return None
+    return lambda: crypto.doc_passphrase(DOC_ID, SECRET)
+
+
+def bench_pool_round_trip(size, workers):
+    pool = get_pool(workers)
+    docstr = get_docstr(size)
+
+    def round_trip():
+        [(doc_id, doc_rev, content)] = pool.apply(
+            encrypt_docs_task,
+            (SECRET, None, ENC_METHOD, None, [(DOC_ID, DOC_REV, docstr)]))
+        pool.apply(
+            decrypt_docs_task,
+            (SECRET, None, ENC_METHOD, None,
+             [(doc_id, doc_rev, json.loads(content), 1, 'trans-id', 1)]))
+
+    return round_trip
+
+
+BENCHMARKS = [
+    ('encrypt_sym', bench_encrypt_sym),
+    ('decrypt_sym', bench_decrypt_sym),
+    ('mac_doc', bench_mac_doc),
+    ('encrypt_docstr', bench_encrypt_docstr),
+    ('decrypt_doc_dict', bench_decrypt_doc_dict),
+    ('doc_passphrase', bench_doc_passphrase),
+    ('pool_round_trip', bench_pool_round_trip),
+]
+
+# only these benchmarks depend on the number of workers
+POOL_BENCHMARKS = set(['pool_round_trip'])
+
+SIZES_IN_RUN = []
+
+_pools = {}
+
+
+def get_pool(workers):
+    if workers not in _pools:
+        _pools[workers] = multiprocessing.Pool(workers)
+    return _pools[workers]
+
+
+def close_pools():
+    for pool in _pools.values():
+        pool.terminate()
+    _pools.clear()
+
+
+#
+# Running and reporting
+#
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    idx = int(round(p / 100. * (len(samples) - 1)))
+    return samples[idx]
+
+
+def time_op(op, min_runs, max_runs, min_time):
+    samples = []
+    total = 0
+    while len(samples) < max_runs \
+            and (len(samples) < min_runs or total < min_time):
+        start = default_timer()
+        op()
+        elapsed = default_timer() - start
+        samples.append(elapsed)
+        total += elapsed
+    return samples, total
+
+
+def run(names, sizes, workers, min_runs, max_runs, min_time):
+    results = []
+    for name, bench in BENCHMARKS:
+        if name not in names:
+            continue
+        for size in sizes:
+            for n in (workers if name in POOL_BENCHMARKS else [None]):
+                op = bench(size, n)
+                if op is None:
+                    continue
+                samples, total = time_op(op, min_runs, max_runs, min_time)
+                result = {
+                    'benchmark': name,
+                    'size': size,
+                    'workers': n,
+                    'runs': len(samples),
+                    'ops_per_sec': len(samples) / total,
+                    'mb_per_sec': size * len(samples) / total / MB,
+                    'p50': percentile(samples, 50),
+                    'p99': percentile(samples, 99),
+                }
+                logger.info(
+                    '%s size=%d workers=%s: %.1f ops/s, %.2f MB/s, '
+                    'p50=%.6fs, p99=%.6fs' % (
+                        name, size, n, result['ops_per_sec'],
+                        result['mb_per_sec'], result['p50'], result['p99']))
+                results.append(result)
+    close_pools()
+    return results
+
+
+def result_key(result):
+    return result['benchmark'], result['size'], result['workers']
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results against a baseline and return the list of regressions,
+    as tuples of (result, baseline result, change in percent).
+    """
+    baseline = dict((result_key(r), r) for r in baseline)
+    regressions = []
+    for result in results:
+        base = baseline.get(result_key(result))
+        if base is None:
+            continue
+        change = 100. * (
+            result['ops_per_sec'] - base['ops_per_sec']) / base['ops_per_sec']
+        logger.info(
+            '%s size=%d workers=%s: %.1f -> %.1f ops/s (%+.1f%%)' % (
+                result['benchmark'], result['size'], result['workers'],
+                base['ops_per_sec'], result['ops_per_sec'], change))
+        if change < -threshold:
+            regressions.append((result, base, change))
+    return regressions
+
+
+def parse_args():
+    # parse command line
+    parser = argparse.ArgumentParser(
+        description='Benchmark the client crypto primitives.')
+    parser.add_argument(
+        '-b', dest='benchmarks', required=False,
+        default=','.join(name for name, _ in BENCHMARKS),
+        help='comma separated list of benchmarks to run')
+    parser.add_argument(
+        '-s', dest='sizes', required=False, default=SIZES,
+        help='comma separated list of document sizes (e.g. 1K,10M)')
+    parser.add_argument(
+        '-w', dest='workers', required=False, default=WORKERS,
+        help='comma separated list of numbers of workers')
+    parser.add_argument(
+        '-n', dest='min_runs', required=False, default=MIN_RUNS, type=int,
+        help='minimum number of runs of each benchmark')
+    parser.add_argument(
+        '-m', dest='max_runs', required=False, default=MAX_RUNS, type=int,
+        help='maximum number of runs of each benchmark')
+    parser.add_argument(
+        '-T', dest='min_time', required=False, default=MIN_TIME, type=float,
+        help='minimum time in seconds spent on each benchmark')
+    parser.add_argument(
+        '-o', dest='output', required=False, default=None,
+        help='the file to which write the results (default: stdout)')
+    parser.add_argument(
+        '-c', dest='baseline', required=False, default=None,
+        help='a results file to compare against')
+    parser.add_argument(
+        '-t', dest='threshold', required=False, default=THRESHOLD,
+        type=float,
+        help='percentage of ops/s that may be lost before failing')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    names = set(args.benchmarks.split(','))
+    sizes = sorted(parse_size(size) for size in args.sizes.split(','))
+    workers = [int(n) for n in args.workers.split(',')]
+    SIZES_IN_RUN.extend(sizes)
+    results = run(
+        names, sizes, workers, args.min_runs, args.max_runs, args.min_time)
+    output = json.dumps({'results': results}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print output
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            logger.error(
+                '%d benchmarks regressed more than %.1f%%' % (
+                    len(regressions), args.threshold))
+            sys.exit(1)
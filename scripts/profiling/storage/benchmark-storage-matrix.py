@@ -0,0 +1,352 @@
+#!/usr/bin/python
+
+# Benchmark matrix for the local SQLCipher storage.
+#
+# For each combination of cipher page size, cache size, WAL checkpoint
+# interval, synchronous mode and document size, a new SQLCipherDatabase is
+# created and the following workloads are run against it, in order:
+#
+#   create       create documents (with an index on one of their fields)
+#   put          update every document
+#   get          get every document
+#   query        get each document through the index
+#   sync_insert  insert documents received from another replica, in runs of
+#                SYNC_BATCH documents per transaction, like a sync does
+#
+# Throughput and latency percentiles of each workload are reported for each
+# configuration, as a table or as JSON. Results can be compared against a
+# previous run, in which case the script exits with a non-zero status if any
+# workload got slower than the allowed threshold.
+#
+# Use it like this:
+#
+#     ./benchmark-storage-matrix.py -o baseline.json -f json
+#     ./benchmark-storage-matrix.py -c baseline.json -t 10
+#     ./benchmark-storage-matrix.py -p 1024,4096 -w off,50,1000 -s 1K -n 500
+
+
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+import itertools
+
+from timeit import default_timer
+
+from leap.soledad.client.pragmas import PerformanceProfile
+from leap.soledad.client.sqlcipher import SQLCipherDatabase
+from leap.soledad.client.sqlcipher import SQLCipherOptions
+from leap.soledad.common.document import SoledadDocument
+
+
+# benchmarking args
+PAGE_SIZES = '1024,4096'
+CACHE_SIZES = 'default,8192'
+CHECKPOINTS = 'off,50,1000'
+SYNCHRONOUS = 'NORMAL,OFF'
+SIZES = '1K,10K,100K'
+NUM_DOCS = 200
+SYNC_BATCH = 50
+THRESHOLD = 10  # percent of docs/s lost before a workload is a regression
+
+MB = 1024. ** 2
+UNITS = {'K': 1024, 'M': 1024 ** 2}
+
+KEY = os.urandom(32).encode('hex')
+OTHER_REPLICA = 'benchmark-replica'
+INDEX = 'by-number'
+
+WORKLOADS = ['create', 'put', 'get', 'query', 'sync_insert']
+
+
+# create a logger
+logger = logging.getLogger(__name__)
+LOG_FORMAT = '%(asctime)s %(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+
+
+def parse_size(size):
+    size = size.strip().upper()
+    if size[-1] in UNITS:
+        return int(size[:-1]) * UNITS[size[-1]]
+    return int(size)
+
+
+def parse_optional_int(value):
+    value = value.strip().lower()
+    if value in ('default', 'off'):
+        return None
+    return int(value)
+
+
+def get_content(number, size):
+    # hex content is about as compressible as typical documents
+    return {'number': number, 'data': os.urandom(size / 2).encode('hex')}
+
+
+def open_db(path, config):
+    profile = PerformanceProfile(
+        cipher_page_size=config['page_size'],
+        cache_size=config['cache_size'],
+        wal=config['checkpoint'] is not None,
+        wal_autocheckpoint=config['checkpoint'] or 0,
+        synchronous=config['synchronous'])
+    opts = SQLCipherOptions(
+        path, KEY, is_raw_key=True, create=True, profile=profile)
+    return SQLCipherDatabase(opts)
+
+
+#
+# Workloads. Each one receives the database, the documents created so far and
+# the document size, and returns a list of (number of docs, operation) to be
+# timed in order. Contents are generated before the operations are built, so
+# that their generation is not timed.
+#
+
+def workload_create(db, docs, size, num_docs):
+    db.create_index(INDEX, 'number')
+
+    def create(content):
+        docs.append(db.create_doc(content))
+
+    contents = [get_content(number, size) for number in xrange(num_docs)]
+    return [(1, lambda content=content: create(content))
+            for content in contents]
+
+
+def workload_put(db, docs, size, num_docs):
+    def put(doc, content):
+        doc.content = content
+        db.put_doc(doc)
+
+    contents = [get_content(doc.content['number'], size) for doc in docs]
+    return [(1, lambda doc=doc, content=content: put(doc, content))
+            for doc, content in zip(docs, contents)]
+
+
+def workload_get(db, docs, size, num_docs):
+    return [(1, lambda doc=doc: db.get_doc(doc.doc_id)) for doc in docs]
+
+
+def workload_query(db, docs, size, num_docs):
+    return [(1, lambda doc=doc: db.get_from_index(
+        INDEX, str(doc.content['number']))) for doc in docs]
+
+
+def workload_sync_insert(db, docs, size, num_docs):
+    entries = []
+    for number in xrange(num_docs):
+        doc = SoledadDocument(
+            'received-%d' % number, '%s:1' % OTHER_REPLICA,
+            json.dumps(get_content(number, size)))
+        entries.append((doc, number + 1, 'T-%d' % number))
+    batches = [entries[i:i + SYNC_BATCH]
+               for i in xrange(0, len(entries), SYNC_BATCH)]
+    return [(len(batch), lambda batch=batch: db._put_docs_if_newer(
+        batch, save_conflict=True, replica_uid=OTHER_REPLICA))
+        for batch in batches]
+
+
+WORKLOAD_FUNCTIONS = {
+    'create': workload_create,
+    'put': workload_put,
+    'get': workload_get,
+    'query': workload_query,
+    'sync_insert': workload_sync_insert,
+}
+
+
+#
+# Running and reporting
+#
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    idx = int(round(p / 100. * (len(samples) - 1)))
+    return samples[idx]
+
+
+def time_ops(ops):
+    samples = []
+    count = 0
+    for docs, op in ops:
+        start = default_timer()
+        op()
+        samples.append(default_timer() - start)
+        count += docs
+    return samples, count, sum(samples)
+
+
+def run_config(basedir, config, workloads, num_docs):
+    path = os.path.join(tempfile.mkdtemp(dir=basedir), 'benchmark.db')
+    db = open_db(path, config)
+    docs = []
+    results = []
+    try:
+        for name in WORKLOADS:
+            ops = WORKLOAD_FUNCTIONS[name](
+                db, docs, config['size'], num_docs)
+            # documents must be created for the other workloads to run, but
+            # only the requested workloads are reported.
+            samples, count, total = time_ops(ops)
+            if name not in workloads or not samples:
+                continue
+            result = dict(config)
+            result.update({
+                'workload': name,
+                'docs': count,
+                'docs_per_sec': count / total,
+                'mb_per_sec': config['size'] * count / total / MB,
+                'p50': percentile(samples, 50),
+                'p99': percentile(samples, 99),
+            })
+            results.append(result)
+    finally:
+        db.close()
+        shutil.rmtree(os.path.dirname(path))
+    return results
+
+
+def run(basedir, matrix, workloads, num_docs):
+    results = []
+    keys = ['page_size', 'cache_size', 'checkpoint', 'synchronous', 'size']
+    for values in itertools.product(*[matrix[key] for key in keys]):
+        config = dict(zip(keys, values))
+        logger.info('Running %s' % format_config(config))
+        results.extend(run_config(basedir, config, workloads, num_docs))
+    return results
+
+
+def format_config(config):
+    return 'page=%s cache=%s ckpt=%s sync=%s size=%s' % (
+        config['page_size'], config['cache_size'], config['checkpoint'],
+        config['synchronous'], config['size'])
+
+
+def format_table(results):
+    header = '%6s %7s %6s %7s %8s %-12s %10s %8s %10s %10s' % (
+        'page', 'cache', 'ckpt', 'sync', 'size', 'workload', 'docs/s',
+        'MB/s', 'p50 (ms)', 'p99 (ms)')
+    lines = [header, '-' * len(header)]
+    for r in results:
+        lines.append('%6s %7s %6s %7s %8s %-12s %10.1f %8.2f %10.3f %10.3f' % (
+            r['page_size'], r['cache_size'], r['checkpoint'],
+            r['synchronous'], r['size'], r['workload'], r['docs_per_sec'],
+            r['mb_per_sec'], r['p50'] * 1000, r['p99'] * 1000))
+    return '\n'.join(lines)
+
+
+def result_key(result):
+    return (result['page_size'], result['cache_size'], result['checkpoint'],
+            result['synchronous'], result['size'], result['workload'])
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results against a baseline and return the list of regressions,
+    as tuples of (result, baseline result, change in percent).
+    """
+    baseline = dict((result_key(r), r) for r in baseline)
+    regressions = []
+    for result in results:
+        base = baseline.get(result_key(result))
+        if base is None:
+            continue
+        change = 100. * (
+            result['docs_per_sec'] - base['docs_per_sec']) \
+            / base['docs_per_sec']
+        logger.info(
+            '%s %s: %.1f -> %.1f docs/s (%+.1f%%)' % (
+                format_config(result), result['workload'],
+                base['docs_per_sec'], result['docs_per_sec'], change))
+        if change < -threshold:
+            regressions.append((result, base, change))
+    return regressions
+
+
+def parse_args():
+    # parse command line
+    parser = argparse.ArgumentParser(
+        description='Benchmark the local SQLCipher storage with a matrix of '
+                    'configurations.')
+    parser.add_argument(
+        '-p', dest='page_sizes', required=False, default=PAGE_SIZES,
+        help='comma separated list of cipher page sizes')
+    parser.add_argument(
+        '-C', dest='cache_sizes', required=False, default=CACHE_SIZES,
+        help='comma separated list of cache sizes in KiB ("default" for the '
+             'sqlite default)')
+    parser.add_argument(
+        '-w', dest='checkpoints', required=False, default=CHECKPOINTS,
+        help='comma separated list of WAL autocheckpoint intervals in pages '
+             '("off" to disable write-ahead logging)')
+    parser.add_argument(
+        '-y', dest='synchronous', required=False, default=SYNCHRONOUS,
+        help='comma separated list of synchronous modes (OFF, NORMAL, FULL)')
+    parser.add_argument(
+        '-s', dest='sizes', required=False, default=SIZES,
+        help='comma separated list of document sizes (e.g. 1K,1M)')
+    parser.add_argument(
+        '-n', dest='num_docs', required=False, default=NUM_DOCS, type=int,
+        help='number of documents in each workload')
+    parser.add_argument(
+        '-b', dest='workloads', required=False, default=','.join(WORKLOADS),
+        help='comma separated list of workloads to report')
+    parser.add_argument(
+        '-d', dest='basedir', required=False, default=None,
+        help='the directory in which to create the databases')
+    parser.add_argument(
+        '-f', dest='format', required=False, default='table',
+        choices=['table', 'json'], help='the format of the results')
+    parser.add_argument(
+        '-o', dest='output', required=False, default=None,
+        help='the file to which write the results (default: stdout)')
+    parser.add_argument(
+        '-c', dest='baseline', required=False, default=None,
+        help='a JSON results file to compare against')
+    parser.add_argument(
+        '-t', dest='threshold', required=False, default=THRESHOLD,
+        type=float,
+        help='percentage of docs/s that may be lost before failing')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    matrix = {
+        'page_size': [int(p) for p in args.page_sizes.split(',')],
+        'cache_size': [parse_optional_int(c)
+                       for c in args.cache_sizes.split(',')],
+        'checkpoint': [parse_optional_int(w)
+                       for w in args.checkpoints.split(',')],
+        'synchronous': [y.strip().upper()
+                        for y in args.synchronous.split(',')],
+        'size': sorted(parse_size(s) for s in args.sizes.split(',')),
+    }
+    workloads = set(args.workloads.split(','))
+    basedir = tempfile.mkdtemp(dir=args.basedir)
+    try:
+        results = run(basedir, matrix, workloads, args.num_docs)
+    finally:
+        shutil.rmtree(basedir)
+    if args.format == 'json':
+        output = json.dumps({'results': results}, indent=2, sort_keys=True)
+    else:
+        output = format_table(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print output
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            logger.error(
+                '%d workloads regressed more than %.1f%%' % (
+                    len(regressions), args.threshold))
+            sys.exit(1)
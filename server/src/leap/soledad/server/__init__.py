@@ -185,8 +185,8 @@ class HTTPInvocationByMethodWithBody(
         """
         Call an HTTP method of a resource.
 
-        This method was rewritten to allow for a sync flow which uses one POST
-        request for each transferred document (back and forth).
+        This method was rewritten to allow for a sync flow which uses many
+        POST requests for transferring documents (back and forth).
 
         Usual U1DB sync process transfers all documents from client to server
         and back in only one POST request. This is inconvenient for some
@@ -194,6 +194,10 @@ class HTTPInvocationByMethodWithBody(
         process, and possible timeouts for when dealing with large documents
         that have to be retrieved and encrypted/decrypted. Because of those,
         we split the sync process into many POST requests.
+
+        When uploading, the client may pack a batch of documents in the same
+        request. All of them are inserted in order and only one response is
+        sent back after the whole batch has been processed.
         """
         args = urlparse.parse_qsl(self.environ['QUERY_STRING'],
                                   strict_parsing=False)
@@ -234,7 +238,7 @@ class HTTPInvocationByMethodWithBody(
                 line, comma = utils.check_and_strip_comma(line.strip())
                 meth_args = self._lookup('%s_args' % method)
                 meth_args(args, line)
-                # handle incoming documents
+                # handle incoming documents (one or a batch of them)
                 if content_type == 'application/x-soledad-sync-put':
                     meth_put = self._lookup('%s_put' % method)
                     meth_end = self._lookup('%s_end' % method)
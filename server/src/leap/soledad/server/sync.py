@@ -171,27 +171,45 @@ class ServerSyncState(object):
             number_of_changes = value['number_of_changes']
         return gen, trans_id, number_of_changes
 
-    def next_change_to_return(self, received):
+    def next_changes_to_return(self, received, count=1):
         """
-        Return the next change to be returned to the source syncing replica.
+        Return the next changes to be returned to the source syncing replica.
+
+        All requested changes are fetched with a single range query on the
+        changes_to_return view.
 
         :param received: How many documents the source replica has already
                          received during the current sync process.
         :type received: int
+        :param count: The maximum number of changes to return.
+        :type count: int
+
+        :return: The generation and transaction id of the target database
+                 which will be synced, and a list of (doc_id, gen, trans_id)
+                 tuples with the next changes to return.
+        :rtype: tuple
         """
         ddoc_path = ['_design', 'syncs', '_view', 'changes_to_return']
         resource = self._db._database.resource(*ddoc_path)
         response = resource.get_json(
-            key=self._key(
-                [self._source_replica_uid, self._sync_id, received]))
+            startkey=self._key(
+                [self._source_replica_uid, self._sync_id, received]),
+            endkey=self._key(
+                [self._source_replica_uid, self._sync_id,
+                 received + count - 1]))
         data = response[2]
-        if not data['rows']:
-            return None, None, None
-        value = data['rows'][0]['value']
-        gen = value['gen']
-        trans_id = value['trans_id']
-        next_change_to_return = value['next_change_to_return']
-        return gen, trans_id, tuple(next_change_to_return)
+        gen = None
+        trans_id = None
+        changes = []
+        for row in data['rows']:
+            value = row['value']
+            # the view emits empty values when there are no changes at all
+            if not value:
+                continue
+            gen = value['gen']
+            trans_id = value['trans_id']
+            changes.append(tuple(value['next_change_to_return']))
+        return gen, trans_id, changes
 
 
 class SyncExchange(sync.SyncExchange):
@@ -219,7 +237,7 @@ class SyncExchange(sync.SyncExchange):
         self._sync_state = ServerSyncState(
             self._db, self.source_replica_uid, sync_id)
 
-    def find_changes_to_return(self, received):
+    def find_changes_to_return(self, received, count=1):
         """
         Find changes to return.
 
@@ -230,6 +248,9 @@ class SyncExchange(sync.SyncExchange):
         :param received: How many documents the source replica has already
                          received during the current sync process.
         :type received: int
+        :param count: The maximum number of changes that will be returned in
+                      the current request.
+        :type count: int
 
         :return: the generation of this database, which the caller can
                  consider themselves to be synchronized after processing
@@ -254,30 +275,33 @@ class SyncExchange(sync.SyncExchange):
                 new_gen, new_trans_id, changes_to_return)
             number_of_changes = len(changes_to_return)
         # query server for stored changes
-        _, _, next_change_to_return = \
-            self._sync_state.next_change_to_return(received)
+        _, _, next_changes_to_return = \
+            self._sync_state.next_changes_to_return(received, count)
         self.new_gen = new_gen
         self.new_trans_id = new_trans_id
-        # and append one change
-        self.change_to_return = next_change_to_return
+        # and append the requested changes
+        self.changes_to_return = next_changes_to_return
         return self.new_gen, number_of_changes
 
-    def return_one_doc(self, return_doc_cb):
+    def return_docs(self, return_doc_cb):
         """
-        Return one changed document and its last change generation to the
-        source syncing replica by invoking the callback return_doc_cb.
+        Return the changed documents found by find_changes_to_return and their
+        last change generation to the source syncing replica by invoking the
+        callback return_doc_cb.
 
-        This is called once for each document to be transferred from target to
-        source.
+        This is called once for each batch of documents to be transferred
+        from target to source.
 
         :param return_doc_cb: is a callback used to return the documents with
                               their last change generation to the target
                               replica.
         :type return_doc_cb: callable(doc, gen, trans_id)
         """
-        if self.change_to_return is not None:
-            changed_doc_id, gen, trans_id = self.change_to_return
-            doc = self._db.get_doc(changed_doc_id, include_deleted=True)
+        if not self.changes_to_return:
+            return
+        changed_doc_ids = [doc_id for doc_id, _, _ in self.changes_to_return]
+        docs = self._db.get_docs(changed_doc_ids, include_deleted=True)
+        for doc, (_, gen, trans_id) in zip(docs, self.changes_to_return):
             return_doc_cb(doc, gen, trans_id)
 
     def insert_doc_from_source(
@@ -395,14 +419,16 @@ class SyncResource(http_app.SyncResource):
             doc, gen, trans_id, number_of_docs=number_of_docs,
             doc_idx=doc_idx, sync_id=self._sync_id)
 
-    @http_app.http_method(received=int, content_as_args=True)
-    def post_get(self, received):
+    @http_app.http_method(received=int, count=int, content_as_args=True)
+    def post_get(self, received, count=1):
         """
-        Return one syncing document to the client.
+        Return a batch of syncing documents to the client.
 
         :param received: How many documents have already been received by the
                          client on the current sync session.
         :type received: int
+        :param count: The maximum number of documents to return.
+        :type count: int
         """
 
         def send_doc(doc, gen, trans_id):
@@ -410,8 +436,10 @@ class SyncResource(http_app.SyncResource):
                          gen=gen, trans_id=trans_id)
             self.responder.stream_entry(entry)
 
+        if count < 1:
+            raise http_app.BadRequest()
         new_gen, number_of_changes = \
-            self.sync_exch.find_changes_to_return(received)
+            self.sync_exch.find_changes_to_return(received, count=count)
         self.responder.content_type = 'application/x-u1db-sync-response'
         self.responder.start_response(200)
         self.responder.start_stream(),
@@ -423,14 +451,14 @@ class SyncResource(http_app.SyncResource):
         if self.replica_uid is not None:
             header['replica_uid'] = self.replica_uid
         self.responder.stream_entry(header)
-        self.sync_exch.return_one_doc(send_doc)
+        self.sync_exch.return_docs(send_doc)
         self.responder.end_stream()
         self.responder.finish_response()
 
     def post_end(self):
         """
         Return the current generation and transaction_id after inserting one
-        incoming document.
+        incoming document or a batch of them.
         """
         self.responder.content_type = 'application/x-soledad-sync-response'
         self.responder.start_response(200)